@@ -0,0 +1,195 @@
+"""shared_topology.py
+    Shared-topology batching for the power-grid datasets (UK, IEEE24, IEEE39, IEEE118).
+
+    Every graph of these datasets is the same bus topology minus the lines removed by
+    its contingency. A dataset is stored once as the base (directed) edge list plus
+    per-graph edge masks [S, E], node features [S, N, F] and edge features [S, E, D].
+    A batch is either a SharedTopologyBatch, on which the GNN_basic models run their
+    convolutions over the base edge list directly (gnn/shared_forward.py), or a PyG
+    Batch built by offsetting the base edge list and applying the masks, for the
+    other models. In both cases no Data object is collated per graph, and the edges of
+    a graph are kept in their original order, so that the model sees exactly the same
+    inputs as with the PyG DataLoader.
+"""
+import math
+import os
+import mat73
+import numpy as np
+import torch
+from torch_geometric.data import Batch
+from dataset.pow_dataset import index_edgeorder
+from gnn.shared_forward import SharedTopologyBatch
+
+
+def load_base_topology(dataset):
+    """Directed base edge list [2, 2M] of a power grid: branch list and its flipped copy."""
+    edge_order = mat73.loadmat(os.path.join(dataset.raw_dir, "blist.mat"))
+    branches = index_edgeorder(edge_order).reshape(-1, 2).type(torch.long)
+    return torch.cat((branches, torch.fliplr(branches)), 0).t().contiguous()
+
+
+def occurrence_rank(keys):
+    """Rank of each entry among the previous entries with the same key (0 for the first one)."""
+    # numpy stable sort: torch.argsort(stable=True) needs torch>=1.13
+    order = torch.from_numpy(np.argsort(keys.cpu().numpy(), kind="stable"))
+    sorted_keys = keys[order]
+    idx = torch.arange(len(keys))
+    start = torch.ones(len(keys), dtype=torch.bool)
+    start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_start = torch.cummax(torch.where(start, idx, 0), dim=0).values
+    rank = torch.empty_like(idx)
+    rank[order] = idx - group_start
+    return rank
+
+
+class SharedTopologyStore(object):
+    def __init__(self, base_edge_index, x, edge_attr, edge_mask, y):
+        self.edge_index = base_edge_index  # [2, E]
+        self.x = x  # [S, N, F]
+        self.edge_attr = edge_attr  # [S, E, D]
+        self.edge_mask = edge_mask  # [S, E], True if the line is in service
+        self.y = y  # [S]
+        self.num_graphs, self.num_nodes, self.num_node_features = x.shape
+
+    def __len__(self):
+        return self.num_graphs
+
+    @classmethod
+    def from_dataset(cls, dataset, base_edge_index=None):
+        if base_edge_index is None:
+            base_edge_index = load_base_topology(dataset)
+        base_edge_index = base_edge_index.cpu()
+        num_base = base_edge_index.shape[1] // 2
+
+        xs, half_edges, half_attrs, flip_attrs, graph_ids, ys = [], [], [], [], [], []
+        for i in range(len(dataset)):
+            data = dataset[i]
+            num_half = data.edge_index.shape[1] // 2
+            edge_index = data.edge_index.cpu()
+            if not torch.equal(
+                edge_index[:, num_half:], edge_index[:, :num_half].flip(0)
+            ):
+                raise ValueError(
+                    f"Graph {i} is not made of a branch list and its flipped copy."
+                )
+            xs.append(data.x.cpu())
+            half_edges.append(edge_index[:, :num_half])
+            half_attrs.append(data.edge_attr[:num_half].cpu())
+            flip_attrs.append(data.edge_attr[num_half:].cpu())
+            graph_ids.append(torch.full((num_half,), i, dtype=torch.long))
+            ys.append(data.y.cpu().view(-1))
+        if len(set([x.shape for x in xs])) > 1:
+            raise ValueError("The graphs do not share the same set of buses.")
+        x = torch.stack(xs)
+        num_nodes = x.shape[1]
+        half_edges, graph_ids = torch.cat(half_edges, 1), torch.cat(graph_ids)
+        half_attrs, flip_attrs = torch.cat(half_attrs), torch.cat(flip_attrs)
+
+        # parallel lines share their end buses: match edges on (end buses, occurrence rank)
+        base_key = (
+            base_edge_index[0, :num_base] * num_nodes + base_edge_index[1, :num_base]
+        )
+        edge_key = half_edges[0] * num_nodes + half_edges[1]
+        base_rank = occurrence_rank(base_key)
+        edge_rank = occurrence_rank(graph_ids * num_nodes**2 + edge_key)
+        num_ranks = int(max(base_rank.max(), edge_rank.max())) + 1
+        base_code, order = torch.sort(base_key * num_ranks + base_rank)
+        edge_code = edge_key * num_ranks + edge_rank
+        pos = torch.searchsorted(base_code, edge_code).clamp(max=num_base - 1)
+        if not torch.equal(base_code[pos], edge_code):
+            raise ValueError("Some lines are not part of the base topology.")
+        base_pos = order[pos]
+        same_graph = graph_ids[1:] == graph_ids[:-1]
+        if (base_pos[1:][same_graph] <= base_pos[:-1][same_graph]).any():
+            raise ValueError(
+                "The lines of a graph are not ordered as the base topology."
+            )
+
+        num_graphs = len(xs)
+        edge_mask = torch.zeros((num_graphs, 2 * num_base), dtype=torch.bool)
+        edge_mask[graph_ids, base_pos] = True
+        edge_mask[graph_ids, base_pos + num_base] = True
+        edge_attr = torch.zeros((num_graphs, 2 * num_base, half_attrs.shape[1]))
+        edge_attr[graph_ids, base_pos] = half_attrs.float()
+        edge_attr[graph_ids, base_pos + num_base] = flip_attrs.float()
+        return cls(base_edge_index, x, edge_attr, edge_mask, torch.cat(ys))
+
+    def _edge_masks(self, indices, edge_keep=None, edge_weight=None):
+        """Keep mask [B, E] and edge weights [B, E] (None for ones) over the base edges."""
+        mask = self.edge_mask[indices]
+        keep = mask
+        if edge_keep is not None:
+            keep = torch.zeros_like(mask)
+            keep[mask] = torch.cat([k.cpu().bool().view(-1) for k in edge_keep])
+        weight = None
+        if edge_weight is not None:
+            weight = torch.zeros(mask.shape)
+            weight[mask] = torch.cat([w.cpu().float().view(-1) for w in edge_weight])
+        return keep, weight
+
+    def get_batch(self, indices, edge_keep=None, edge_weight=None, x=None):
+        """PyG Batch of the graphs `indices`.
+
+        edge_keep and edge_weight are optional lists of per-graph tensors over the edges of
+        each graph (in the order of the graph's edge_index); x optionally replaces the node
+        features with a [B, N, F] tensor.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        num_graphs, N = len(indices), self.num_nodes
+        keep, weight = self._edge_masks(indices, edge_keep, edge_weight)
+        offset = torch.arange(num_graphs) * N
+        edge_index = self.edge_index[None] + offset[:, None, None]
+        batch = Batch(
+            x=(self.x[indices] if x is None else x.cpu()).reshape(
+                -1, self.num_node_features
+            ),
+            edge_index=edge_index.permute(1, 0, 2)[:, keep],
+            edge_attr=self.edge_attr[indices][keep],
+            y=self.y[indices],
+            batch=torch.arange(num_graphs).repeat_interleave(N),
+        )
+        if weight is not None:
+            batch.edge_weight = weight[keep]
+        batch._num_graphs = num_graphs
+        return batch
+
+    def get_dense_batch(self, indices, edge_keep=None, edge_weight=None, x=None):
+        """SharedTopologyBatch of the graphs `indices`, same arguments as get_batch."""
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        keep, weight = self._edge_masks(indices, edge_keep, edge_weight)
+        return SharedTopologyBatch(
+            self.edge_index,
+            self.x[indices] if x is None else x.cpu(),
+            self.edge_attr[indices],
+            keep,
+            edge_weight=weight,
+            y=self.y[indices],
+        )
+
+
+class SharedTopologyLoader(object):
+    """Drop-in replacement of the PyG DataLoader over a subset of a SharedTopologyStore.
+
+    Yields SharedTopologyBatch objects, or PyG Batch objects if dense is False (for
+    models that do not support shared_forward).
+    """
+
+    def __init__(self, store, indices, batch_size, shuffle=False, dense=True):
+        self.store = store
+        self.dense = dense
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices))]
+        for i in range(0, len(indices), self.batch_size):
+            if self.dense:
+                yield self.store.get_dense_batch(indices[i : i + self.batch_size])
+            else:
+                yield self.store.get_batch(indices[i : i + self.batch_size])
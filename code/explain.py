@@ -18,7 +18,9 @@ from evaluate.fidelity import (
     fidelity_prob_inv,
 )
 from utils.io_utils import check_dir
-from utils.gen_utils import list_to_dict
+from utils.gen_utils import list_to_dict, prepare_data
+from utils.graph_utils import CachedAdjacency
+from gnn.shared_forward import supports_shared_topology
 from dataset.syn_utils.gengroundtruth import get_ground_truth_syn
 from evaluate.accuracy import (
     get_explanation_syn,
@@ -33,8 +35,18 @@ from evaluate.mask_utils import (
 from explainer.node_explainer import *
 from explainer.graph_explainer import *
 from pathlib import Path
+from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 
+# explainers that only query the model (no gradients) and can run on an inference backend
+INFERENCE_ONLY_EXPLAINERS = [
+    "random",
+    "distance",
+    "pagerank",
+    "occlusion",
+    "pgmexplainer",
+    "subgraphx",
+]
 
 class Explain(object):
     def __init__(
@@ -46,8 +58,10 @@ class Explain(object):
         explainer_params,
         save_dir=None,
         save_name="mask",
+        inference_model=None,
     ):
         self.model = model
+        self.inference_model = model if inference_model is None else inference_model
         self.dataset = dataset  # train_mask, eval_mask, test_mask
         self.data = dataset.data
         self.dataset_name = explainer_params["dataset_name"]
@@ -58,9 +72,32 @@ class Explain(object):
         if self.save_dir is not None:
             check_dir(self.save_dir)
 
-        self.explainer_params = explainer_params
+        # explainer_stats collects per-instance statistics of the explainers (e.g. stop_epoch)
+        self.explainer_stats = {}
+        # explainer_cache holds the state the explainers share across instances (e.g. rewards)
+        self.explainer_cache = {}
+        self.explainer_params = {
+            **explainer_params,
+            "explainer_stats": self.explainer_stats,
+            "explainer_cache": self.explainer_cache,
+        }
         self.graph_classification = eval(explainer_params["graph_classification"])
         self.task = "_graph" if self.graph_classification else "_node"
+        self.shared_topology = None
+        if self.graph_classification and eval(
+            explainer_params.get("shared_topology", "False")
+        ):
+            # the power-grid datasets depend on mat73
+            from dataset.pow_utils.shared_topology import SharedTopologyStore
+
+            self.shared_topology = SharedTopologyStore.from_dataset(self.dataset)
+        if not self.graph_classification:
+            # repeated forwards on the same graph reuse its normalised adjacency
+            for m in [self.model, self.inference_model]:
+                if hasattr(m, "set_adj_cache"):
+                    m.set_adj_cache(
+                        CachedAdjacency(self.data.edge_index, self.data.num_nodes)
+                    )
 
         self.list_test_idx = list_test_idx
         self.explainer_name = explainer_params["explainer_name"]
@@ -394,13 +431,17 @@ class Explain(object):
         )
 
     def related_pred_graph(self, edge_masks, node_feat_masks):
+        if self.shared_topology is not None:
+            return self.related_pred_graph_shared(edge_masks, node_feat_masks)
         related_preds = []
         for i in range(len(self.explained_y)):
             explained_y_idx = self.explained_y[i]
             data = self.dataset[explained_y_idx]
             data = data.to(self.device)
             data.batch = torch.zeros(data.x.shape[0], dtype=int, device=data.x.device)
-            ori_prob_idx = self.model.get_prob(data).cpu().detach().numpy()[0]
+            ori_prob_idx = (
+                self.inference_model.get_prob(data).cpu().detach().numpy()[0]
+            )
             if node_feat_masks[0] is not None:
                 if node_feat_masks[i].ndim == 0:
                     # if type of node feat mask is 'feature'
@@ -451,9 +492,11 @@ class Explain(object):
                 else:
                     raise ValueError("Unknown mask nature: {}".format(self.mask_nature))
 
-            masked_prob_idx = self.model.get_prob(masked_data).cpu().detach().numpy()[0]
+            masked_prob_idx = (
+                self.inference_model.get_prob(masked_data).cpu().detach().numpy()[0]
+            )
             maskout_prob_idx = (
-                self.model.get_prob(maskout_data).cpu().detach().numpy()[0]
+                self.inference_model.get_prob(maskout_data).cpu().detach().numpy()[0]
             )
 
             true_label = data.y.cpu().item()
@@ -474,10 +517,95 @@ class Explain(object):
         related_preds = list_to_dict(related_preds)
         return related_preds
 
+    def related_pred_graph_shared(self, edge_masks, node_feat_masks, batch_size=256):
+        """Same as related_pred_graph, with the graphs batched over their shared topology."""
+        store = self.shared_topology
+        if supports_shared_topology(self.inference_model):
+            get_batch = store.get_dense_batch
+        else:
+            get_batch = store.get_batch
+        related_preds = []
+        for start in range(0, len(self.explained_y), batch_size):
+            ids = range(start, min(start + batch_size, len(self.explained_y)))
+            graph_idx = [self.explained_y[i] for i in ids]
+            x = store.x[graph_idx]
+            if node_feat_masks[0] is not None:
+                node_feat_mask = [
+                    torch.Tensor(node_feat_masks[i]).reshape(-1)
+                    if node_feat_masks[i].ndim == 0
+                    else torch.Tensor(node_feat_masks[i])
+                    for i in ids
+                ]
+                x_masked = torch.stack([x[k] * m for k, m in enumerate(node_feat_mask)])
+                x_maskout = torch.stack(
+                    [x[k] * (1 - m) for k, m in enumerate(node_feat_mask)]
+                )
+            else:
+                x_masked, x_maskout = x, x
+
+            masked, maskout = [], []
+            for k, i in enumerate(ids):
+                num_edges = int(store.edge_mask[graph_idx[k]].sum())
+                if (
+                    (edge_masks[i] is not None)
+                    and (hasattr(edge_masks[i], "__len__"))
+                    and (len(edge_masks[i]) > 0)
+                ):
+                    edge_mask = torch.Tensor(edge_masks[i])
+                else:
+                    edge_mask = None
+                if self.mask_nature == "hard":
+                    if edge_mask is None:
+                        # no explanation: both graphs keep all their edges
+                        masked.append(torch.ones(num_edges, dtype=torch.bool))
+                        maskout.append(torch.ones(num_edges, dtype=torch.bool))
+                        continue
+                    masked.append(edge_mask > 0)
+                    maskout.append(edge_mask <= 0)
+                elif self.mask_nature in ["hard_full", "soft"]:
+                    if edge_mask is None:
+                        masked.append(torch.ones(num_edges))
+                        maskout.append(torch.ones(num_edges))
+                        continue
+                    if self.mask_nature == "hard_full":
+                        edge_mask = torch.where(edge_mask > 0, 1, 0).float()
+                    masked.append(edge_mask)
+                    maskout.append(1 - edge_mask)
+                else:
+                    raise ValueError("Unknown mask nature: {}".format(self.mask_nature))
+            mask_arg = "edge_keep" if self.mask_nature == "hard" else "edge_weight"
+            masked_batch = get_batch(graph_idx, x=x_masked, **{mask_arg: masked})
+            maskout_batch = get_batch(graph_idx, x=x_maskout, **{mask_arg: maskout})
+
+            ori_probs = self.inference_model.get_prob(
+                get_batch(graph_idx).to(self.device)
+            )
+            masked_probs = self.inference_model.get_prob(masked_batch.to(self.device))
+            maskout_probs = self.inference_model.get_prob(
+                maskout_batch.to(self.device)
+            )
+            ori_probs = ori_probs.cpu().detach().numpy()
+            masked_probs = masked_probs.cpu().detach().numpy()
+            maskout_probs = maskout_probs.cpu().detach().numpy()
+            for k, explained_y_idx in enumerate(graph_idx):
+                related_preds.append(
+                    {
+                        "explained_y_idx": explained_y_idx,
+                        "masked": masked_probs[k],
+                        "maskout": maskout_probs[k],
+                        "origin": ori_probs[k],
+                        "true_label": store.y[explained_y_idx].item(),
+                        "pred_label": np.argmax(ori_probs[k]),
+                    }
+                )
+
+        related_preds = list_to_dict(related_preds)
+        return related_preds
+
     def related_pred_node(self, edge_masks, node_feat_masks):
         related_preds = []
         data = self.data
-        ori_probs = self.model.get_prob(data=self.data)
+        ori_probs = self.inference_model.get_prob(data=self.data)
         for i in range(len(self.explained_y)):
             if node_feat_masks[0] is not None:
                 if node_feat_masks[i].ndim == 0:
@@ -532,8 +660,12 @@ class Explain(object):
                 else:
                     raise ValueError("Unknown mask nature: {}".format(self.mask_nature))
 
-            masked_probs = self.model.get_prob(masked_data).cpu().detach().numpy()[0]
-            maskout_probs = self.model.get_prob(maskout_data).cpu().detach().numpy()[0]
+            masked_probs = (
+                self.inference_model.get_prob(masked_data).cpu().detach().numpy()[0]
+            )
+            maskout_probs = (
+                self.inference_model.get_prob(maskout_data).cpu().detach().numpy()[0]
+            )
 
             explained_y_idx = self.explained_y[i]
             ori_prob_idx = ori_probs[explained_y_idx].cpu().detach().numpy()
@@ -565,7 +697,7 @@ class Explain(object):
             target = self.model(data=data).argmax(-1).item()
         start_time = time.time()
         edge_mask, node_feat_mask = self.explain_function(
-            self.model, data, target, self.device, **self.explainer_params
+            self.explained_model, data, target, self.device, **self.explainer_params
         )
         end_time = time.time()
         duration_seconds = end_time - start_time
@@ -575,20 +707,45 @@ class Explain(object):
             duration_seconds,
         )
 
-    def _compute_node(self, explained_y_idx):
+    def _compute_graph_batch(self, explained_y_idxs):
+        data_list = [self.dataset[idx].to(self.device) for idx in explained_y_idxs]
         if self.focus == "phenomenon":
-            targets = self.data.y
+            targets = torch.cat([data.y.view(-1) for data in data_list])
         else:
-            self.model.eval()
-            data = self.data.to(self.device)
-            out = self.model(data=data)
-            targets = torch.LongTensor(out.argmax(dim=1).detach().cpu().numpy()).to(
-                self.device
-            )
+            batch = Batch.from_data_list(data_list)
+            targets = self.model(data=batch).argmax(-1)
+        start_time = time.time()
+        masks = self.explain_batch_function(
+            self.explained_model,
+            data_list,
+            targets,
+            self.device,
+            **self.explainer_params,
+        )
+        end_time = time.time()
+        # the computation time of the batch is shared by its instances
+        duration_seconds = (end_time - start_time) / len(explained_y_idxs)
+        return [
+            (edge_mask, node_feat_mask, duration_seconds)
+            for edge_mask, node_feat_mask in masks
+        ]
+
+    def _get_targets_node(self):
+        if self.focus == "phenomenon":
+            return self.data.y
+        self.model.eval()
+        data = self.data.to(self.device)
+        out = self.model(data=data)
+        return torch.LongTensor(out.argmax(dim=1).detach().cpu().numpy()).to(
+            self.device
+        )
+
+    def _compute_node(self, explained_y_idx):
+        targets = self._get_targets_node()
         start_time = time.time()
         edge_mask, node_feat_mask = self.explain_function(
-            self.model,
-            self.data,
+            self.explained_model,
+            self.explained_data,
             explained_y_idx,
             targets[explained_y_idx],
             self.device,
@@ -602,8 +759,53 @@ class Explain(object):
             duration_seconds,
         )
 
+    def _compute_node_batch(self, explained_y_idxs):
+        targets = self._get_targets_node()
+        start_time = time.time()
+        masks = self.explain_batch_function(
+            self.explained_model,
+            self.explained_data,
+            explained_y_idxs,
+            targets[explained_y_idxs],
+            self.device,
+            **self.explainer_params,
+        )
+        end_time = time.time()
+        # the computation time of the batch is shared by its instances
+        duration_seconds = (end_time - start_time) / len(explained_y_idxs)
+        return [
+            (edge_mask, node_feat_mask, duration_seconds)
+            for edge_mask, node_feat_mask in masks
+        ]
+
+    def _compute_masks(self, explained_y):
+        """Yield (explained_y_idx, edge_mask, node_feat_mask, duration_seconds)."""
+        batch_size = self.explainer_params.get("explained_batch_size", 1)
+        if (self.explain_batch_function is None) or (batch_size <= 1):
+            for explained_y_idx in explained_y:
+                result = eval("self._compute" + self.task)(explained_y_idx)
+                yield (explained_y_idx, *result)
+            return
+        for i in range(0, len(explained_y), batch_size):
+            chunk = list(explained_y[i : i + batch_size])
+            results = eval("self._compute" + self.task + "_batch")(chunk)
+            for explained_y_idx, result in zip(chunk, results):
+                yield (explained_y_idx, *result)
+
     def compute_mask(self):
         self.explain_function = eval("explain_" + self.explainer_name + self.task)
+        # explainers with a batched variant can explain several instances at once
+        self.explain_batch_function = globals().get(
+            "explain_" + self.explainer_name + self.task + "_batch"
+        )
+        self.explained_model = (
+            self.inference_model
+            if self.explainer_name in INFERENCE_ONLY_EXPLAINERS
+            else self.model
+        )
+        if not self.graph_classification:
+            # prepared once per run: the explainers share the tensors of the graph
+            self.explained_data = prepare_data(self.data, self.device)
         print("Computing masks using " + self.explainer_name + " explainer.")
         if (self.save_dir is not None) and (
             Path(os.path.join(self.save_dir, self.save_name)).is_file()
@@ -623,10 +825,12 @@ class Explain(object):
                 [],
                 [],
             )
-            for explained_y_idx in init_explained_y:
-                edge_mask, node_feat_mask, duration_seconds = eval(
-                    "self._compute" + self.task
-                )(explained_y_idx)
+            for (
+                explained_y_idx,
+                edge_mask,
+                node_feat_mask,
+                duration_seconds,
+            ) in self._compute_masks(init_explained_y):
                 if (
                     (edge_mask is not None)
                     and (hasattr(edge_mask, "__len__"))
@@ -773,7 +977,7 @@ def avg_scores(scores):
     return avg_scores
 
 
-def explain_main(dataset, model, device, args, unseen=False):
+def explain_main(dataset, model, device, args, unseen=False, inference_model=None):
     args.dataset = dataset
     if unseen:
         args.pred_type = "mix"
@@ -798,6 +1002,7 @@ def explain_main(dataset, model, device, args, unseen=False):
         if args.mask_save_dir == "None"
         else os.path.join(args.mask_save_dir, args.dataset_name, args.explainer_name),
         save_name=mask_save_name,
+        inference_model=inference_model,
     )
 
     (
@@ -820,6 +1025,13 @@ def explain_main(dataset, model, device, args, unseen=False):
         "pred_type": args.pred_type,
         "time": float(format(np.mean(computation_time), ".4f")),
         "device": str(device),
+        "backend": args.backend,
+        "inference_precision": args.inference_precision,
+        **getattr(explainer.inference_model, "parity", {}),
+        **{
+            name: float(np.mean(values))
+            for name, values in explainer.explainer_stats.items()
+        },
     }
 
     if (edge_masks is None) or (not edge_masks):
@@ -12,8 +12,8 @@ from typing import Optional
 import torch
 from tqdm import tqdm
 
-from torch_geometric.data import Data
-from torch_geometric.nn import MessagePassing
+from torch_geometric.data import Batch, Data
+from torch_geometric.nn import MessagePassing, global_add_pool, global_mean_pool
 from torch_geometric.utils import k_hop_subgraph, to_networkx
 
 EPS = 1e-15
@@ -97,8 +97,9 @@ class GNNExplainer(torch.nn.Module):
         self.feat_mask_type = feat_mask_type
         self.coeffs.update(kwargs)
 
-    def __set_masks__(self, x, edge_index, init="normal"):
+    def __set_masks__(self, x, edge_index, init="normal", batch=None):
         (N, F), E = x.size(), edge_index.size(1)
+        num_graphs = 1 if batch is None else int(batch.max()) + 1
 
         std = 0.1
         if self.feat_mask_type == "individual_feature":
@@ -106,9 +107,16 @@ class GNNExplainer(torch.nn.Module):
         elif self.feat_mask_type == "scalar":
             self.node_feat_mask = torch.nn.Parameter(torch.randn(N, 1) * std)
         else:
-            self.node_feat_mask = torch.nn.Parameter(torch.randn(1, F) * std)
+            self.node_feat_mask = torch.nn.Parameter(torch.randn(num_graphs, F) * std)
 
-        std = torch.nn.init.calculate_gain("relu") * sqrt(2.0 / (2 * N))
+        if batch is None:
+            std = torch.nn.init.calculate_gain("relu") * sqrt(2.0 / (2 * N))
+        else:
+            # each graph of the batch keeps the initialisation scale of its own size
+            num_nodes = torch.bincount(batch, minlength=num_graphs)[batch[edge_index[0]]]
+            std = torch.nn.init.calculate_gain("relu") * torch.sqrt(
+                2.0 / (2 * num_nodes.float().cpu())
+            )
         self.edge_mask = torch.nn.Parameter(torch.randn(E) * std)
         if not self.allow_edge_mask:
             self.edge_mask.requires_grad_(False)
@@ -482,6 +490,104 @@ class GNNExplainer(torch.nn.Module):
         return ax, G
 
 
+class EarlyStopping(object):
+    """Stop the mask optimisation once it has converged.
+
+    An epoch is stale if the loss did not improve by more than loss_tol (relative to the
+    best loss so far) and no mask entry (after sigmoid) moved by more than mask_tol. The
+    optimisation stops after `patience` stale epochs in a row, but not before min_epochs.
+
+    For a batch of explanations, `step` takes the loss of each explanation and, for each
+    mask, the explanation of its rows: stale epochs are counted per explanation, and
+    `stopped` and `stop_epochs` tell which explanations have converged, and when.
+    """
+
+    def __init__(self, patience, min_epochs=100, loss_tol=1e-4, mask_tol=1e-3):
+        self.patience = patience
+        self.min_epochs = min_epochs
+        self.loss_tol = loss_tol
+        self.mask_tol = mask_tol
+        self.best_loss = None
+        self.prev_masks = None
+        self.num_stale = None
+        self.stopped = None
+        self.stop_epochs = None
+
+    def _moved(self, masks, mask_batches, num_explanations):
+        moved = torch.zeros(num_explanations, dtype=torch.bool)
+        for mask, prev_mask, rows in zip(masks, self.prev_masks, mask_batches):
+            if mask.numel() == 0:
+                continue
+            change = (mask - prev_mask).abs().reshape(mask.shape[0], -1).amax(dim=1)
+            if rows is None:
+                rows = torch.zeros(mask.shape[0], dtype=torch.long)
+            moved_rows = rows.cpu()[change > self.mask_tol]
+            moved |= torch.bincount(moved_rows, minlength=num_explanations) > 0
+        return moved
+
+    def step(self, epoch, loss, masks, mask_batches=None):
+        loss = torch.as_tensor(loss, dtype=torch.float).detach().cpu().view(-1)
+        masks = [m.detach().sigmoid().cpu() for m in masks]
+        if mask_batches is None:
+            mask_batches = [None] * len(masks)
+        if self.best_loss is None:
+            improved = torch.ones(len(loss), dtype=torch.bool)
+            self.best_loss = loss
+            self.num_stale = torch.zeros(len(loss), dtype=torch.long)
+            self.stopped = torch.zeros(len(loss), dtype=torch.bool)
+            self.stop_epochs = torch.zeros(len(loss), dtype=torch.long)
+        else:
+            improved = loss < self.best_loss - self.loss_tol * self.best_loss.abs()
+            self.best_loss = torch.min(self.best_loss, loss)
+        if self.prev_masks is None:
+            moved = torch.ones(len(loss), dtype=torch.bool)
+        else:
+            moved = self._moved(masks, mask_batches, len(loss))
+        self.prev_masks = masks
+        self.num_stale = torch.where(
+            improved | moved, torch.zeros_like(self.num_stale), self.num_stale + 1
+        )
+        if epoch >= self.min_epochs:
+            newly_stopped = ~self.stopped & (self.num_stale >= self.patience)
+            self.stop_epochs[newly_stopped] = epoch
+            self.stopped |= newly_stopped
+        return bool(self.stopped.all())
+
+
+def warm_start_logits(scores):
+    """Edge mask logits from the (non-negative or signed) edge scores of another explainer.
+
+    The absolute scores are rescaled to [0.1, 0.9], away from the flat tails of the sigmoid.
+    """
+    m = torch.as_tensor(scores, dtype=torch.float).abs()
+    m = m / m.max().clamp(min=EPS) if m.numel() > 0 else m
+    return torch.logit(0.1 + 0.8 * m)
+
+
+def get_optimisation_params(**kwargs):
+    """Number of epochs and early stopping settings of TargetedGNNExplainer from the args."""
+    return {
+        "epochs": kwargs.get("gnnexplainer_epochs", 1000),
+        "patience": kwargs.get("gnnexplainer_patience"),
+        "min_epochs": kwargs.get("gnnexplainer_min_epochs", 100),
+        "loss_tol": kwargs.get("gnnexplainer_loss_tol", 1e-4),
+        "mask_tol": kwargs.get("gnnexplainer_mask_tol", 1e-3),
+    }
+
+
+def record_stop_epoch(explainer, **kwargs):
+    """Append the epoch reached by explainer to the explainer_stats of the run, if any.
+
+    After a batched explanation, explainer.stop_epoch is the list of the epochs of the graphs.
+    """
+    stats = kwargs.get("explainer_stats")
+    if stats is not None:
+        stop_epochs = explainer.stop_epoch
+        if not isinstance(stop_epochs, list):
+            stop_epochs = [stop_epochs]
+        stats.setdefault("stop_epoch", []).extend(stop_epochs)
+
+
 class TargetedGNNExplainer(GNNExplainer):
     def __init__(
         self,
@@ -494,6 +600,10 @@ class TargetedGNNExplainer(GNNExplainer):
         allow_edge_mask: bool = True,
         allow_node_mask: bool = True,
         log: bool = True,
+        patience: Optional[int] = None,
+        min_epochs: int = 100,
+        loss_tol: float = 1e-4,
+        mask_tol: float = 1e-3,
         **kwargs,
     ):
         super(TargetedGNNExplainer, self).__init__(
@@ -508,6 +618,28 @@ class TargetedGNNExplainer(GNNExplainer):
             **kwargs,
         )
         self.allow_node_mask = allow_node_mask
+        # early stopping is disabled if patience is None
+        self.patience = patience
+        self.min_epochs = min_epochs
+        self.loss_tol = loss_tol
+        self.mask_tol = mask_tol
+        self.stop_epoch = None
+
+    def __early_stopping__(self):
+        self.stop_epoch = self.epochs
+        if self.patience is None:
+            return None
+        return EarlyStopping(
+            self.patience,
+            min_epochs=self.min_epochs,
+            loss_tol=self.loss_tol,
+            mask_tol=self.mask_tol,
+        )
+
+    def __warm_start__(self, init_edge_mask):
+        # set the edge mask from the logits of a cheaper explainer's mask
+        with torch.no_grad():
+            self.edge_mask.copy_(init_edge_mask.to(self.edge_mask.device))
 
     def __loss__(self, node_idx, log_logits, target_class):
         loss = -log_logits[node_idx, target_class]
@@ -527,14 +659,17 @@ class TargetedGNNExplainer(GNNExplainer):
 
         return loss
 
-    def explain_graph_with_target(self, x, edge_index, edge_attr, target):
+    def explain_graph_with_target(
+        self, x, edge_index, edge_attr, target, init_edge_mask=None
+    ):
         r"""Learns and returns a node feature mask and an edge mask that play a
         crucial role to explain the prediction made by the GNN for a graph.
 
         Args:
             x (Tensor): The node feature matrix.
             edge_index (LongTensor): The edge indices.
-            **kwargs (optional): Additional arguments passed to the GNN module.
+            init_edge_mask (Tensor, optional): Scores of the edges from another
+                explainer, used to warm-start the edge mask.
 
         :rtype: (:class:`Tensor`, :class:`Tensor`)
         """
@@ -546,7 +681,7 @@ class TargetedGNNExplainer(GNNExplainer):
         batch = torch.zeros(x.shape[0], dtype=int, device=x.device)
 
         # Get the initial prediction.
-        if target is not None:
+        if target is None:
             with torch.no_grad():
                 out = self.model(x, edge_index, edge_attr, batch)
                 if self.return_type == "regression":
@@ -561,6 +696,8 @@ class TargetedGNNExplainer(GNNExplainer):
                 pred_label = target
         self.__set_masks__(x, edge_index)
         self.to(x.device)
+        if init_edge_mask is not None:
+            self.__warm_start__(warm_start_logits(init_edge_mask))
         if self.allow_edge_mask:
             if self.allow_node_mask:
                 parameters = [self.node_feat_mask, self.edge_mask]
@@ -574,6 +711,7 @@ class TargetedGNNExplainer(GNNExplainer):
             pbar = tqdm(total=self.epochs)
             pbar.set_description("Explain graph")
 
+        early_stopping = self.__early_stopping__()
         for epoch in range(1, self.epochs + 1):
             optimizer.zero_grad()
             if self.allow_node_mask:
@@ -593,6 +731,11 @@ class TargetedGNNExplainer(GNNExplainer):
 
             if self.log:  # pragma: no cover
                 pbar.update(1)
+            if early_stopping is not None and early_stopping.step(
+                epoch, loss.item(), parameters
+            ):
+                self.stop_epoch = epoch
+                break
 
         if self.log:  # pragma: no cover
             pbar.close()
@@ -603,8 +746,168 @@ class TargetedGNNExplainer(GNNExplainer):
         self.__clear_masks__()
         return node_feat_mask, edge_mask
 
+    def __batch_loss__(self, log_logits, target_class, batch, edge_batch):
+        # losses of explain_graph_with_target for each graph of the batch
+        num_graphs = log_logits.size(0)
+        graphs = torch.arange(num_graphs, device=log_logits.device)
+        loss = -log_logits[graphs, target_class]
+
+        if self.allow_edge_mask:
+            m = self.edge_mask.sigmoid()[:, None]
+            size = global_add_pool(m, edge_batch, size=num_graphs).view(-1)
+            loss = loss + self.coeffs["edge_size"] * size
+            ent = -m * torch.log(m + EPS) - (1 - m) * torch.log(1 - m + EPS)
+            ent = global_mean_pool(ent, edge_batch, size=num_graphs).view(-1)
+            loss = loss + self.coeffs["edge_ent"] * ent
+
+        if self.allow_node_mask:
+            m = self.node_feat_mask.sigmoid()
+            row_batch = graphs if self.feat_mask_type == "feature" else batch
+            if self.coeffs["node_feat_reduction"] == "sum":
+                size = global_add_pool(m, row_batch, size=num_graphs).sum(-1)
+            else:
+                size = global_mean_pool(m, row_batch, size=num_graphs).mean(-1)
+            loss = loss + self.coeffs["node_feat_size"] * size
+            ent = -m * torch.log(m + EPS) - (1 - m) * torch.log(1 - m + EPS)
+            ent = global_mean_pool(ent, row_batch, size=num_graphs).mean(-1)
+            loss = loss + self.coeffs["node_feat_ent"] * ent
+
+        return loss
+
+    def __freeze__(self, parameters, mask_batches, stopped, values):
+        # keep the masks of the converged graphs at their value when they stopped
+        with torch.no_grad():
+            for parameter, rows, value in zip(parameters, mask_batches, values):
+                frozen = stopped.to(rows.device)[rows]
+                parameter[frozen] = value[frozen]
+
+    def explain_graphs_with_target(self, data_list, targets, init_edge_masks=None):
+        r"""Batched version of :meth:`explain_graph_with_target`: the masks of all the
+        graphs of :attr:`data_list` are learned together, with a single optimizer on the
+        sum of the per-graph losses. The graphs are independent and Adam updates each
+        mask entry separately, so this is equivalent to explaining them one by one. With
+        early stopping, each graph stops on its own loss and masks: the masks of a
+        converged graph are frozen while the other graphs are optimised, and
+        :attr:`stop_epoch` is the list of the epochs of the graphs.
+
+        Args:
+            data_list (list of Data): The graphs to explain.
+            targets (Tensor): The target class of each graph.
+            init_edge_masks (list of Tensor, optional): Scores of the edges of each
+                graph from another explainer, used to warm-start the edge masks.
+
+        :rtype: list of (:class:`Tensor`, :class:`Tensor`)
+        """
+
+        self.model.eval()
+        self.__clear_masks__()
+
+        data = Batch.from_data_list(data_list)
+        x, edge_index, edge_attr, batch = (
+            data.x,
+            data.edge_index,
+            data.edge_attr,
+            data.batch,
+        )
+        edge_batch = batch[edge_index[0]]
+
+        # Get the initial prediction.
+        if targets is None:
+            with torch.no_grad():
+                out = self.model(x, edge_index, edge_attr, batch)
+                if self.return_type == "regression":
+                    prediction = out
+                else:
+                    log_logits = self.__to_log_prob__(out)
+                    pred_label = log_logits.argmax(dim=-1)
+        else:
+            if self.return_type == "regression":
+                prediction = targets
+            else:
+                pred_label = targets
+        self.__set_masks__(x, edge_index, batch=batch)
+        self.to(x.device)
+        if init_edge_masks is not None:
+            init_edge_mask = torch.cat([warm_start_logits(m) for m in init_edge_masks])
+            self.__warm_start__(init_edge_mask)
+        if self.allow_edge_mask:
+            if self.allow_node_mask:
+                parameters = [self.node_feat_mask, self.edge_mask]
+            else:
+                parameters = [self.edge_mask]
+        else:
+            parameters = [self.node_feat_mask]
+        optimizer = torch.optim.Adam(parameters, lr=self.lr)
+        # graph of the rows of each mask
+        graphs = torch.arange(len(data_list), device=x.device)
+        row_batch = graphs if self.feat_mask_type == "feature" else batch
+        mask_batches = [
+            row_batch if p is self.node_feat_mask else edge_batch for p in parameters
+        ]
+
+        if self.log:  # pragma: no cover
+            pbar = tqdm(total=self.epochs)
+            pbar.set_description(f"Explain {len(data_list)} graphs")
+
+        early_stopping = self.__early_stopping__()
+        for epoch in range(1, self.epochs + 1):
+            optimizer.zero_grad()
+            if self.allow_node_mask:
+                node_feat_mask = self.node_feat_mask.sigmoid()
+                if self.feat_mask_type == "feature":
+                    node_feat_mask = node_feat_mask[batch]
+                h = x * node_feat_mask
+            else:
+                h = x
+            out = self.model(
+                h, edge_index, edge_attr * self.edge_mask.sigmoid()[:, None], batch
+            )
+            if self.return_type == "regression":
+                loss = self.__batch_loss__(out, prediction, batch, edge_batch)
+            else:
+                log_logits = self.__to_log_prob__(out)
+                loss = self.__batch_loss__(log_logits, pred_label, batch, edge_batch)
+            loss.sum().backward()
+            stopped = None if early_stopping is None else early_stopping.stopped
+            if stopped is not None and stopped.any():
+                values = [p.detach().clone() for p in parameters]
+                optimizer.step()
+                self.__freeze__(parameters, mask_batches, stopped, values)
+            else:
+                optimizer.step()
+
+            if self.log:  # pragma: no cover
+                pbar.update(1)
+            if early_stopping is not None and early_stopping.step(
+                epoch, loss.detach(), parameters, mask_batches
+            ):
+                break
+
+        if self.log:  # pragma: no cover
+            pbar.close()
+        self.stop_epoch = [self.epochs] * len(data_list)
+        if early_stopping is not None and early_stopping.stopped is not None:
+            stop_epochs = torch.where(
+                early_stopping.stopped,
+                early_stopping.stop_epochs,
+                torch.full_like(early_stopping.stop_epochs, self.epochs),
+            )
+            self.stop_epoch = stop_epochs.tolist()
+
+        node_feat_masks = self.node_feat_mask.detach().sigmoid()
+        if self.feat_mask_type != "feature":
+            node_feat_masks = node_feat_masks.split(data.ptr.diff().tolist())
+        edge_masks = self.edge_mask.detach().sigmoid()
+        edge_masks = edge_masks.split([d.edge_index.size(1) for d in data_list])
+
+        self.__clear_masks__()
+        return [
+            (node_feat_mask.squeeze(), edge_mask)
+            for node_feat_mask, edge_mask in zip(node_feat_masks, edge_masks)
+        ]
+
     def explain_node_with_target(
-        self, node_idx, x, edge_index, edge_attr, target, **kwargs
+        self, node_idx, x, edge_index, edge_attr, target, init_edge_mask=None, **kwargs
     ):
         r"""Learns and returns a node feature mask and an edge mask that play a
         crucial role to explain the prediction made by the GNN for node
@@ -614,6 +917,8 @@ class TargetedGNNExplainer(GNNExplainer):
             node_idx (int): The node to explain.
             x (Tensor): The node feature matrix.
             edge_index (LongTensor): The edge indices.
+            init_edge_mask (Tensor, optional): Scores of the edges from another
+                explainer, used to warm-start the edge mask.
             **kwargs (optional): Additional arguments passed to the GNN module.
 
         :rtype: (:class:`Tensor`, :class:`Tensor`)
@@ -655,6 +960,9 @@ class TargetedGNNExplainer(GNNExplainer):
 
         self.__set_masks__(x, edge_index)
         self.to(x.device)
+        if init_edge_mask is not None:
+            init_edge_mask = torch.as_tensor(init_edge_mask)[hard_edge_mask.cpu()]
+            self.__warm_start__(warm_start_logits(init_edge_mask))
 
         if self.allow_edge_mask:
             if self.allow_node_mask:
@@ -669,6 +977,7 @@ class TargetedGNNExplainer(GNNExplainer):
             pbar = tqdm(total=self.epochs)
             pbar.set_description(f"Explain node {node_idx}")
 
+        early_stopping = self.__early_stopping__()
         for epoch in range(1, self.epochs + 1):
             optimizer.zero_grad()
             if self.allow_node_mask:
@@ -688,6 +997,11 @@ class TargetedGNNExplainer(GNNExplainer):
 
             if self.log:  # pragma: no cover
                 pbar.update(1)
+            if early_stopping is not None and early_stopping.step(
+                epoch, loss.item(), parameters
+            ):
+                self.stop_epoch = epoch
+                break
 
         if self.log:  # pragma: no cover
             pbar.close()
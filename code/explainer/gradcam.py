@@ -15,6 +15,7 @@ from captum._utils.gradient import (
 from captum._utils.typing import TargetType
 from captum.attr import LayerGradCam
 from torch import Tensor
+from torch_geometric.nn import global_mean_pool
 
 
 class GraphLayerGradCam(LayerGradCam):
@@ -60,3 +61,48 @@ class GraphLayerGradCam(LayerGradCam):
         if relu_attributions:
             scaled_acts = tuple(F.relu(scaled_act) for scaled_act in scaled_acts)
         return _format_output(len(scaled_acts) > 1, scaled_acts)
+
+
+def multi_layer_grad_cam(
+    forward_func,
+    layers,
+    inputs,
+    target,
+    additional_forward_args=(),
+    average_over_nodes=False,
+    batch=None,
+):
+    """Grad-CAM of all `layers` from a single forward and a single backward pass.
+
+    Returns one [num_nodes, 1] tensor per layer. With average_over_nodes=True the
+    gradients are averaged over the nodes as in GraphLayerGradCam (over the nodes of
+    each graph if batch is given), otherwise each node uses its own gradients as in
+    captum's LayerGradCam. target is a class or one class per output row.
+    """
+    layer_evals = {}
+
+    def save_output(module, input, output):
+        layer_evals[module] = output
+
+    handles = [layer.register_forward_hook(save_output) for layer in layers]
+    try:
+        output = forward_func(inputs, *additional_forward_args)
+    finally:
+        for handle in handles:
+            handle.remove()
+    evals = [layer_evals[layer] for layer in layers]
+    rows = torch.arange(output.shape[0], device=output.device)
+    grads = torch.autograd.grad(output[rows, target].sum(), evals, allow_unused=True)
+
+    scaled_acts = []
+    for layer_grad, layer_eval in zip(grads, evals):
+        if layer_grad is None:
+            layer_grad = torch.zeros_like(layer_eval)
+        if average_over_nodes and batch is not None:
+            layer_grad = global_mean_pool(layer_grad, batch)[batch]
+        elif average_over_nodes:
+            layer_grad = torch.mean(layer_grad, dim=0, keepdim=True)
+        scaled_acts.append(
+            torch.sum(layer_grad * layer_eval, dim=1, keepdim=True).detach()
+        )
+    return scaled_acts
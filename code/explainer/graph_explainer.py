@@ -11,7 +11,7 @@ import argparse
 from copy import deepcopy
 from captum.attr import IntegratedGradients, Saliency
 from torch.autograd import Variable
-from torch_geometric.data import Data
+from torch_geometric.data import Batch, Data
 from torch_geometric.utils import to_networkx, to_dense_adj
 #from explainer.gnnlrp import GNN_LRP
 from explainer.pgexplainer import PGExplainer
@@ -25,15 +25,28 @@ from utils.gen_utils import (
     from_adj_to_edge_index,
     get_neighbourhood,
     normalize_adj,
+    prepare_data,
     sample_large_graph,
 )
 from utils.io_utils import write_to_json
+from utils.graph_utils import leave_one_out_batch
 from gnn.model import GCNConv, GATConv, GINEConv, TransformerConv
 
-from explainer.gnnexplainer import TargetedGNNExplainer
+from explainer.gnnexplainer import (
+    TargetedGNNExplainer,
+    get_optimisation_params,
+    record_stop_epoch,
+)
 from explainer.pgmexplainer import Graph_Explainer
-from explainer.subgraphx import SubgraphX
-from explainer.gradcam import GraphLayerGradCam
+from explainer.subgraphx import (
+    SubgraphX,
+    get_reward_cache,
+    get_rng,
+    record_reward_cache_stats,
+    record_reward_variance,
+)
+from explainer.gradcam import multi_layer_grad_cam
+from explainer.integrated_gradients import get_integrated_gradients
 from explainer.cfgnnexplainer import CFExplainer
 from explainer.graphcfe import GraphCFE, train, test, baseline_cf, add_list_in_dict, compute_counterfactual
 from explainer.gflowexplainer import GFlowExplainer, gflow_parse_args
@@ -61,15 +74,11 @@ def get_all_convolution_layers(model):
     return layers
 
 
-def gpu_to_cpu(data, device):
-    data.x = torch.FloatTensor(data.x.cpu().numpy().copy()).to(device)
-    data.edge_index = torch.LongTensor(data.edge_index.cpu().numpy().copy()).to(device)
-    data.edge_attr = torch.FloatTensor(data.edge_attr.cpu().numpy().copy()).to(device)
-    return data
-
-
-def model_forward_graph(x, model, edge_index, edge_attr):
-    out = model(x, edge_index, edge_attr)
+def model_forward_graph(x, model, edge_index, edge_attr, batch=None):
+    if batch is None:
+        out = model(x, edge_index, edge_attr)
+    else:
+        out = model(x, edge_index, edge_attr, batch)
     return out
 
 
@@ -104,13 +113,9 @@ def explain_sa_graph(model, data, target, device, **kwargs):
 
 
 def explain_ig_graph(model, data, target, device, **kwargs):
-    ig = IntegratedGradients(model_forward_graph)
-    input_mask = data.x.clone().requires_grad_(True).to(device)
-    ig_mask = ig.attribute(
-        input_mask,
-        target=target,
-        additional_forward_args=(model, data.edge_index, data.edge_attr),
-        internal_batch_size=input_mask.shape[0],
+    ig = get_integrated_gradients(model, **kwargs)
+    (ig_mask,), _ = ig.attribute(
+        [(data.x.to(device), data.edge_index, data.edge_attr, target, 0)]
     )
     node_feat_mask = ig_mask.cpu().detach().numpy()
     node_attr = node_feat_mask.sum(axis=1)
@@ -126,28 +131,26 @@ def explain_occlusion_graph(model, data, target, device, **kwargs):
         target = pred_probs.argmax()
     else:
         pred_prob = 1
-    g = to_networkx(data)
-    edge_occlusion_mask = np.ones(data.num_edges, dtype=bool)
+    # leave-one-edge-out copies of the graph are scored by chunks in a single forward
+    batch_size = kwargs.get("perturbation_batch_size", 256)
     edge_mask = np.zeros(data.num_edges)
-    edge_index_numpy = data.edge_index.cpu().numpy()
-    for i in range(data.num_edges):
-        # if include_edges is not None and not include_edges[i].item():
-        # continue
-        u, v = list(edge_index_numpy[:, i])
-        if (u, v) in g.edges():
-            edge_occlusion_mask[i] = False
-            prob = model(
-                data.x,
-                data.edge_index[:, edge_occlusion_mask],
-                data.edge_attr[edge_occlusion_mask],
-            )[0][target].item()
-            edge_mask[i] = pred_prob - prob
-            edge_occlusion_mask[i] = True
+    with torch.no_grad():
+        for start in range(0, data.num_edges, batch_size):
+            removed_edges = torch.arange(
+                start, min(start + batch_size, data.num_edges), device=data.x.device
+            )
+            x, edge_index, edge_attr, batch = leave_one_out_batch(
+                data.x, data.edge_index, data.edge_attr, removed_edges
+            )
+            probs = model(x, edge_index, edge_attr, batch)[:, target]
+            edge_mask[start : start + len(removed_edges)] = (
+                pred_prob - probs.view(-1).cpu().numpy()
+            )
     return edge_mask.astype("float"), None
 
 
 def explain_basic_gnnexplainer_graph(model, data, target, device, **kwargs):
-    data = gpu_to_cpu(data, device)
+    data = prepare_data(data, device)
     explainer = TargetedGNNExplainer(
         model,
         num_hops=kwargs["num_layers"],
@@ -170,32 +173,72 @@ def explain_basic_gnnexplainer_graph(model, data, target, device, **kwargs):
 
 
 def explain_gnnexplainer_graph(model, data, target, device, **kwargs):
-    data = gpu_to_cpu(data, device)
+    data = prepare_data(data, device)
     explainer = TargetedGNNExplainer(
         model,
         num_hops=kwargs["num_layers"],
         return_type="prob",
-        epochs=1000,
         edge_ent=kwargs["edge_ent"],
         edge_size=kwargs["edge_size"],
         allow_edge_mask=True,
         allow_node_mask=True,
         device=device,
+        **get_optimisation_params(**kwargs),
     )
+    init_edge_mask = None
+    if kwargs.get("gnnexplainer_init", "random") == "saliency":
+        init_edge_mask, _ = explain_sa_graph(model, data, target, device)
     node_feat_mask, edge_mask = explainer.explain_graph_with_target(
         x=data.x,
         edge_index=data.edge_index,
         edge_attr=data.edge_attr,
         target=target,
+        init_edge_mask=init_edge_mask,
     )
+    record_stop_epoch(explainer, **kwargs)
     edge_mask = edge_mask.cpu().detach().numpy()
     node_feat_mask = node_feat_mask.cpu().detach().numpy()
     return edge_mask, node_feat_mask
 
 
+def explain_gnnexplainer_graph_batch(model, data_list, targets, device, **kwargs):
+    explainer = TargetedGNNExplainer(
+        model,
+        num_hops=kwargs["num_layers"],
+        return_type="prob",
+        edge_ent=kwargs["edge_ent"],
+        edge_size=kwargs["edge_size"],
+        allow_edge_mask=True,
+        allow_node_mask=True,
+        device=device,
+        **get_optimisation_params(**kwargs),
+    )
+    data_list = [data.to(device) for data in data_list]
+    init_edge_masks = None
+    if kwargs.get("gnnexplainer_init", "random") == "saliency":
+        init_edge_masks = [
+            edge_mask
+            for edge_mask, _ in explain_sa_graph_batch(model, data_list, targets, device)
+        ]
+    masks = explainer.explain_graphs_with_target(
+        data_list, targets, init_edge_masks=init_edge_masks
+    )
+    record_stop_epoch(explainer, **kwargs)
+    return [
+        (edge_mask.cpu().detach().numpy(), node_feat_mask.cpu().detach().numpy())
+        for node_feat_mask, edge_mask in masks
+    ]
+
+
 def explain_pgmexplainer_graph(model, data, target, device, **kwargs):
     explainer = Graph_Explainer(
-        model, data.edge_index, data.edge_attr, data.x, device=device, print_result=0
+        model,
+        data.edge_index,
+        data.edge_attr,
+        data.x,
+        device=device,
+        print_result=0,
+        batch_size=kwargs.get("perturbation_batch_size", 256),
     )
     explanation = explainer.explain(
         num_samples=1000,
@@ -212,6 +255,8 @@ def explain_pgmexplainer_graph(model, data, target, device, **kwargs):
 
 
 def explain_subgraphx_graph(model, data, target, device, **kwargs):
+    reward_cache = get_reward_cache(**kwargs)
+    hits, misses = reward_cache.hits, reward_cache.misses
     subgraphx = SubgraphX(
         model,
         kwargs["num_classes"],
@@ -223,9 +268,14 @@ def explain_subgraphx_graph(model, data, target, device, **kwargs):
         expand_atoms=14,
         high2low=True,
         sample_num=50,
-        reward_method="mc_shapley",
+        reward_method=kwargs.get("subgraphx_reward_method", "mc_shapley"),
         subgraph_building_method="zero_filling",
         local_radius=4,
+        rng=get_rng(**kwargs),
+        reward_cache=reward_cache,
+        n_parallel=kwargs.get("subgraphx_parallel_rollouts", 1),
+        l_shapley_budget=kwargs.get("subgraphx_l_shapley_budget", 2**12),
+        max_batch_nodes=kwargs.get("max_batch_nodes", 2**16),
     )
     edge_mask = subgraphx.explain(
         data.x,
@@ -234,32 +284,93 @@ def explain_subgraphx_graph(model, data, target, device, **kwargs):
         max_nodes=kwargs["num_top_edges"],
         label=target,
     )
+    record_reward_cache_stats(reward_cache, hits, misses, **kwargs)
+    record_reward_variance(subgraphx.reward_variances, **kwargs)
     return edge_mask.astype("float"), None
 
 
 def explain_gradcam_graph(model, data, target, device, **kwargs):
     # Captum default implementation of LayerGradCam does not average over nodes for different channels because of
     # different assumptions on tensor shapes
+    # All the layers are hooked at once: one forward and one backward pass
     input_mask = data.x.clone().requires_grad_(True).to(device)
-    layers = get_all_convolution_layers(model)
-    node_attrs = []
-    for layer in layers:
-        layer_gc = GraphLayerGradCam(model_forward_graph, layer)
-        node_attr = layer_gc.attribute(
-            input_mask,
-            target=target,
-            additional_forward_args=(
-                model,
-                data.edge_index,
-                data.edge_attr,
-            ),
-        )
-        node_attrs.append(node_attr.squeeze().cpu().detach().numpy())
+    layer_attrs = multi_layer_grad_cam(
+        model_forward_graph,
+        get_all_convolution_layers(model),
+        input_mask,
+        target,
+        additional_forward_args=(model, data.edge_index, data.edge_attr),
+        average_over_nodes=True,
+    )
+    node_attrs = [attr.squeeze().cpu().numpy() for attr in layer_attrs]
     node_attr = np.array(node_attrs).mean(axis=0)
     edge_mask = sigmoid(node_attr_to_edge(data.edge_index, node_attr))
     return edge_mask.astype("float"), None
 
 
+#### Batched gradient explainers ####
+def split_node_attrs(batch, node_feat_mask):
+    """Split a [num_nodes, F] array of a Batch into the per-graph arrays."""
+    ptr = batch.ptr.cpu().numpy()
+    return [node_feat_mask[ptr[i] : ptr[i + 1]] for i in range(len(ptr) - 1)]
+
+
+def explain_sa_graph_batch(model, data_list, targets, device, **kwargs):
+    batch = Batch.from_data_list(data_list).to(device)
+    input_mask = batch.x.clone().requires_grad_(True)
+    out = model_forward_graph(
+        input_mask, model, batch.edge_index, batch.edge_attr, batch.batch
+    )
+    rows = torch.arange(out.shape[0], device=out.device)
+    # the graphs are independent: the gradient of the sum is the per-graph gradient
+    (saliency_mask,) = torch.autograd.grad(out[rows, targets].sum(), input_mask)
+    masks = []
+    for data, node_feat_mask in zip(
+        data_list, split_node_attrs(batch, saliency_mask.cpu().numpy())
+    ):
+        node_attr = node_feat_mask.sum(axis=1)
+        edge_mask = node_attr_to_edge(data.edge_index, node_attr)
+        masks.append((edge_mask.astype("float"), node_feat_mask.astype("float")))
+    return masks
+
+
+def explain_ig_graph_batch(model, data_list, targets, device, **kwargs):
+    ig = get_integrated_gradients(model, **kwargs)
+    ig_masks, _ = ig.attribute(
+        [
+            (data.x.to(device), data.edge_index, data.edge_attr, target, 0)
+            for data, target in zip(data_list, targets)
+        ]
+    )
+    masks = []
+    for data, ig_mask in zip(data_list, ig_masks):
+        node_feat_mask = ig_mask.cpu().detach().numpy()
+        node_attr = node_feat_mask.sum(axis=1)
+        edge_mask = node_attr_to_edge(data.edge_index, node_attr)
+        masks.append((edge_mask.astype("float"), node_feat_mask.astype("float")))
+    return masks
+
+
+def explain_gradcam_graph_batch(model, data_list, targets, device, **kwargs):
+    batch = Batch.from_data_list(data_list).to(device)
+    input_mask = batch.x.clone().requires_grad_(True)
+    layer_attrs = multi_layer_grad_cam(
+        model_forward_graph,
+        get_all_convolution_layers(model),
+        input_mask,
+        targets,
+        additional_forward_args=(model, batch.edge_index, batch.edge_attr, batch.batch),
+        average_over_nodes=True,
+        batch=batch.batch,
+    )
+    node_attr = np.array([attr[:, 0].cpu().numpy() for attr in layer_attrs]).mean(axis=0)
+    masks = []
+    for data, graph_node_attr in zip(data_list, split_node_attrs(batch, node_attr)):
+        edge_mask = sigmoid(node_attr_to_edge(data.edge_index, graph_node_attr))
+        masks.append((edge_mask.astype("float"), None))
+    return masks
+
+
 def explain_pgexplainer_graph(model, data, target, device, **kwargs):
     seed = kwargs['seed']
     pgexplainer = PGExplainer(
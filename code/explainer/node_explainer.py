@@ -2,12 +2,13 @@ import os
 import networkx as nx
 import numpy as np
 from scipy import sparse
+from scipy.sparse import csgraph
 import torch
 import torch.nn.functional as F
-from captum.attr import IntegratedGradients, LayerGradCam, Saliency
+from captum.attr import IntegratedGradients, Saliency
 from gnn.model import GCNConv, GATConv, GINEConv, TransformerConv
 from torch_geometric.data import Data
-from torch_geometric.utils import to_networkx
+from torch_geometric.utils import k_hop_subgraph, to_networkx
 from utils.gen_utils import (
     filter_existing_edges,
     from_edge_index_to_adj_torch,
@@ -16,13 +17,29 @@ from utils.gen_utils import (
     from_adj_to_edge_index,
     get_neighbourhood,
     normalize_adj,
+    prepare_data,
     sample_large_graph,
 )
+from utils.graph_utils import edge_index_to_csr, leave_one_out_batch
 #import numpy_indexed as npi
-from explainer.gnnexplainer import GNNExplainer, TargetedGNNExplainer
+from explainer.gnnexplainer import (
+    GNNExplainer,
+    TargetedGNNExplainer,
+    get_optimisation_params,
+    record_stop_epoch,
+)
 from explainer.pgexplainer import PGExplainer
 from explainer.pgmexplainer import Node_Explainer
-from explainer.subgraphx import SubgraphX
+from explainer.subgraphx import (
+    SubgraphX,
+    get_reward_cache,
+    get_rng,
+    record_reward_cache_stats,
+    record_reward_variance,
+)
+from explainer.gradcam import multi_layer_grad_cam
+from explainer.pagerank import personalized_pagerank, personalized_pagerank_push
+from explainer.integrated_gradients import get_integrated_gradients
 
 
 def balance_mask_undirected(edge_mask, edge_index):
@@ -57,10 +74,10 @@ def model_forward_node(x, model, edge_index, edge_attr, node_idx):
 
 
 def node_attr_to_edge(edge_index, node_mask):
-    edge_mask = np.zeros(edge_index.shape[1])
-    edge_mask += node_mask[edge_index[0].cpu().numpy()]
-    edge_mask += node_mask[edge_index[1].cpu().numpy()]
-    return edge_mask
+    # node_mask [N] or [B, N]: one gather for all the edges (and masks)
+    row, col = edge_index.cpu().numpy()
+    node_mask = np.asarray(node_mask, dtype=float)
+    return node_mask[..., row] + node_mask[..., col]
 
 
 def get_all_convolution_layers(model):
@@ -84,33 +101,63 @@ def explain_random_node(model, data, node_idx, target, device, **kwargs):
 
 
 def explain_distance_node(model, data, node_idx, target, device, **kwargs):
-    data = Data(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr)
-    g = to_networkx(data)
-    length = nx.shortest_path_length(g, target=node_idx)
+    return explain_distance_node_batch(
+        model, data, [node_idx], [target], device, **kwargs
+    )[0]
 
-    def get_attr(node):
-        if node in length:
-            return 1 / (length[node] + 1)
-        return 0
 
-    edge_sources = data.edge_index[1].cpu().numpy()
-    return np.array([get_attr(node) for node in edge_sources]).astype("float"), None
+def explain_distance_node_batch(model, data, node_indices, targets, device, **kwargs):
+    # hop distances of all the nodes to the explained nodes (along the edge directions),
+    # i.e. from the explained nodes in the reversed graph, with one multi-source search
+    adj_t = edge_index_to_csr(
+        data.edge_index,
+        data.num_nodes,
+        transpose=True,
+        cache=kwargs.get("explainer_cache"),
+    )
+    max_depth = kwargs.get("distance_max_depth")
+    length = csgraph.dijkstra(
+        adj_t,
+        directed=True,
+        indices=np.array([int(node_idx) for node_idx in node_indices]),
+        unweighted=True,
+        limit=np.inf if max_depth is None else max_depth,
+    )
+    # unreachable nodes (infinite distance) get 0
+    node_attr = 1 / (length + 1)
+    edge_masks = node_attr[:, data.edge_index[1].cpu().numpy()]
+    return [(edge_mask.astype("float"), None) for edge_mask in edge_masks]
 
 
 def explain_pagerank_node(model, data, node_idx, target, device, **kwargs):
-    data = Data(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr)
-    g = to_networkx(data)
-    pagerank = nx.pagerank(g, personalization={node_idx: 1})
+    return explain_pagerank_node_batch(
+        model, data, [node_idx], [target], device, **kwargs
+    )[0]
 
-    node_attr = np.zeros(data.x.shape[0])
-    for node, value in pagerank.items():
-        node_attr[node] = value
-    edge_mask = node_attr_to_edge(data.edge_index, node_attr)
-    return edge_mask.astype("float"), None
+
+def explain_pagerank_node_batch(model, data, node_indices, targets, device, **kwargs):
+    adj = edge_index_to_csr(
+        data.edge_index, data.num_nodes, cache=kwargs.get("explainer_cache")
+    )
+    node_indices = [int(node_idx) for node_idx in node_indices]
+    push_eps = kwargs.get("pagerank_push_eps")
+    if push_eps is None:
+        node_attr = personalized_pagerank(
+            adj, node_indices, tol=kwargs.get("pagerank_tol", 1e-6)
+        )
+    else:
+        node_attr = np.stack(
+            [
+                personalized_pagerank_push(adj, node_idx, eps=push_eps)
+                for node_idx in node_indices
+            ]
+        )
+    edge_masks = node_attr_to_edge(data.edge_index, node_attr)
+    return [(edge_mask.astype("float"), None) for edge_mask in edge_masks]
 
 
 def explain_basic_gnnexplainer_node(model, data, node_idx, target, device, **kwargs):
-    data = gpu_to_cpu(data, device)
+    data = prepare_data(data, device)
     explainer = TargetedGNNExplainer(
         model,
         num_hops=kwargs["num_layers"],
@@ -138,22 +185,16 @@ def explain_basic_gnnexplainer_node(model, data, node_idx, target, device, **kwa
 def explain_gradcam_node(model, data, node_idx, target, device, **kwargs):
     # Captum default implementation of LayerGradCam does not average over nodes for different channels because of
     # different assumptions on tensor shapes
+    # All the layers are hooked at once: one forward and one backward pass
     input_mask = data.x.clone().requires_grad_(True).to(device)
-    layers = get_all_convolution_layers(model)
-    node_attrs = []
-    for layer in layers:
-        layer_gc = LayerGradCam(model_forward_node, layer)
-        node_attr = layer_gc.attribute(
-            input_mask,
-            target=target,
-            additional_forward_args=(
-                model,
-                data.edge_index,
-                data.edge_attr,
-                node_idx,
-            ),
-        )
-        node_attrs.append(node_attr.squeeze().cpu().detach().numpy())
+    layer_attrs = multi_layer_grad_cam(
+        model_forward_node,
+        get_all_convolution_layers(model),
+        input_mask,
+        target,
+        additional_forward_args=(model, data.edge_index, data.edge_attr, node_idx),
+    )
+    node_attrs = [attr.squeeze().cpu().numpy() for attr in layer_attrs]
     node_attr = np.array(node_attrs).mean(axis=0)
     edge_mask = node_attr_to_edge(data.edge_index, node_attr)
     return edge_mask.astype("float"), None
@@ -176,85 +217,179 @@ def explain_sa_node(model, data, node_idx, target, device, **kwargs):
 
 
 def explain_ig_node(model, data, node_idx, target, device, **kwargs):
-    ig = IntegratedGradients(model_forward_node)
-    input_mask = data.x.clone().requires_grad_(True).to(device)
-    ig_mask = ig.attribute(
-        input_mask,
-        target=target,
-        additional_forward_args=(model, data.edge_index, data.edge_attr, node_idx),
-        internal_batch_size=input_mask.shape[0],
+    # attributions are computed on the (num_layers+1)-hop subgraph, they are zero elsewhere
+    subset, sub_edge_index, mapping, sub_edge_mask = k_hop_subgraph(
+        int(node_idx),
+        kwargs["num_layers"] + 1,
+        data.edge_index,
+        relabel_nodes=True,
+        num_nodes=data.num_nodes,
     )
+    ig = get_integrated_gradients(model, node_level=True, **kwargs)
+    (sub_ig_mask,), _ = ig.attribute(
+        [
+            (
+                data.x[subset].to(device),
+                sub_edge_index,
+                data.edge_attr[sub_edge_mask],
+                target,
+                mapping.item(),
+            )
+        ]
+    )
+    ig_mask = torch.zeros_like(data.x)
+    ig_mask[subset] = sub_ig_mask.detach()
     node_feat_mask = ig_mask.cpu().detach().numpy()
     node_attr = node_feat_mask.sum(axis=1)
     edge_mask = node_attr_to_edge(data.edge_index, node_attr)
     return edge_mask.astype("float"), node_feat_mask.astype("float")
 
 
+def node_output_gradients(model, data, node_indices, targets, device):
+    """Gradients of the target outputs of several nodes w.r.t. x, from a single forward."""
+    x = data.x.clone().to(device).requires_grad_(True)
+    out = model(x, data.edge_index, edge_attr=data.edge_attr)
+    outputs = out[
+        torch.as_tensor(node_indices, device=out.device),
+        torch.as_tensor(targets, device=out.device),
+    ]
+    try:
+        # one vector-Jacobian product per explained node, vectorized with vmap
+        (grads,) = torch.autograd.grad(
+            outputs,
+            x,
+            grad_outputs=torch.eye(len(outputs), device=outputs.device),
+            retain_graph=True,
+            is_grads_batched=True,
+        )
+        return list(grads)
+    except (RuntimeError, TypeError):
+        # some message passing ops have no batching rule, and torch<1.11 has no
+        # is_grads_batched argument (TypeError): one backward per node
+        grads = []
+        for i in range(len(outputs)):
+            (grad,) = torch.autograd.grad(outputs[i], x, retain_graph=True)
+            grads.append(grad)
+        return grads
+
+
+def explain_sa_node_batch(model, data, node_indices, targets, device, **kwargs):
+    masks = []
+    for grad in node_output_gradients(model, data, node_indices, targets, device):
+        node_feat_mask = grad.cpu().numpy()
+        node_attr = node_feat_mask.sum(axis=1)
+        edge_mask = node_attr_to_edge(data.edge_index, node_attr)
+        masks.append((edge_mask.astype("float"), node_feat_mask.astype("float")))
+    return masks
+
+
+def explain_ig_node_batch(model, data, node_indices, targets, device, **kwargs):
+    queries, subsets = [], []
+    for node_idx, target in zip(node_indices, targets):
+        subset, sub_edge_index, mapping, sub_edge_mask = k_hop_subgraph(
+            int(node_idx),
+            kwargs["num_layers"] + 1,
+            data.edge_index,
+            relabel_nodes=True,
+            num_nodes=data.num_nodes,
+        )
+        queries.append(
+            (
+                data.x[subset].to(device),
+                sub_edge_index,
+                data.edge_attr[sub_edge_mask],
+                target,
+                mapping.item(),
+            )
+        )
+        subsets.append(subset)
+    ig = get_integrated_gradients(model, node_level=True, **kwargs)
+    sub_ig_masks, _ = ig.attribute(queries)
+    masks = []
+    for subset, sub_ig_mask in zip(subsets, sub_ig_masks):
+        ig_mask = torch.zeros_like(data.x)
+        ig_mask[subset] = sub_ig_mask.detach()
+        node_feat_mask = ig_mask.cpu().numpy()
+        node_attr = node_feat_mask.sum(axis=1)
+        edge_mask = node_attr_to_edge(data.edge_index, node_attr)
+        masks.append((edge_mask.astype("float"), node_feat_mask.astype("float")))
+    return masks
+
+
 def explain_occlusion_node(model, data, node_idx, target, device, **kwargs):
-    depth_limit = kwargs["num_layers"] + 1
-    data = Data(x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr)
+    num_layers = kwargs["num_layers"]
+    node_idx = int(node_idx)
+    # The prediction of node_idx only depends on its (num_layers+1)-hop subgraph: the
+    # extra hop keeps the degree normalisation of the num_layers-hop nodes exact.
+    subset, sub_edge_index, mapping, sub_edge_mask = k_hop_subgraph(
+        node_idx,
+        num_layers + 1,
+        data.edge_index,
+        relabel_nodes=True,
+        num_nodes=data.num_nodes,
+    )
+    x, edge_attr = data.x[subset], data.edge_attr[sub_edge_mask]
+    center = mapping.item()
     if target is None:
         pred_probs = (
-            model(data.x, data.edge_index, data.edge_attr)[node_idx]
-            .cpu()
-            .detach()
-            .numpy()
+            model(x, sub_edge_index, edge_attr)[center].cpu().detach().numpy()
         )
         pred_prob = pred_probs.max()
         target = pred_probs.argmax()
     else:
         pred_prob = 1
-    g = to_networkx(data)
-    subgraph_nodes = []
-    for k, v in nx.shortest_path_length(g, target=node_idx).items():
-        if v < depth_limit:
-            subgraph_nodes.append(k)
-    subgraph = g.subgraph(subgraph_nodes)
-    edge_occlusion_mask = np.ones(data.num_edges, dtype=bool)
+    # occluded edges: edges between nodes at most num_layers hops away from node_idx
+    hop_nodes, _, _, _ = k_hop_subgraph(
+        node_idx, num_layers, data.edge_index, num_nodes=data.num_nodes
+    )
+    in_hop = torch.zeros(data.num_nodes, dtype=torch.bool, device=hop_nodes.device)
+    in_hop[hop_nodes] = True
+    row, col = data.edge_index[:, sub_edge_mask]
+    candidates = torch.where(in_hop[row] & in_hop[col])[0]
+    global_edges = torch.where(sub_edge_mask)[0].cpu().numpy()
+
+    batch_size = kwargs.get("perturbation_batch_size", 256)
     edge_mask = np.zeros(data.num_edges)
-    edge_index_numpy = data.edge_index.cpu().numpy()
-    for i in range(data.num_edges):
-        # if include_edges is not None and not include_edges[i].item():
-        # continue
-        u, v = list(edge_index_numpy[:, i])
-        if (u, v) in subgraph.edges():
-            edge_occlusion_mask[i] = False
-            prob = model(
-                data.x,
-                data.edge_index[:, edge_occlusion_mask],
-                data.edge_attr[edge_occlusion_mask],
-            )[node_idx][target].item()
-            edge_mask[i] = pred_prob - prob
-            edge_occlusion_mask[i] = True
+    with torch.no_grad():
+        for start in range(0, len(candidates), batch_size):
+            removed_edges = candidates[start : start + batch_size]
+            x_b, edge_index_b, edge_attr_b, batch = leave_one_out_batch(
+                x, sub_edge_index, edge_attr, removed_edges
+            )
+            out = model(x_b, edge_index_b, edge_attr_b, batch)
+            centers = (
+                torch.arange(len(removed_edges), device=out.device) * len(subset)
+                + center
+            )
+            probs = out[centers, target].view(-1).cpu().numpy()
+            edge_mask[global_edges[removed_edges.cpu().numpy()]] = pred_prob - probs
     return edge_mask.astype("float"), None
 
 
-def gpu_to_cpu(data, device):
-    data.x = torch.FloatTensor(data.x.cpu().numpy().copy()).to(device)
-    data.edge_index = torch.LongTensor(data.edge_index.cpu().numpy().copy()).to(device)
-    data.edge_attr = torch.FloatTensor(data.edge_attr.cpu().numpy().copy()).to(device)
-    return data
-
-
 def explain_gnnexplainer_node(model, data, node_idx, target, device, **kwargs):
-    data = gpu_to_cpu(data, device)
+    data = prepare_data(data, device)
     explainer = TargetedGNNExplainer(
         model,
         num_hops=kwargs["num_layers"],
-        epochs=1000,
         edge_ent=kwargs["edge_ent"],
         edge_size=kwargs["edge_size"],
         allow_edge_mask=True,
         allow_node_mask=True,
         device=device,
+        **get_optimisation_params(**kwargs),
     )
+    init_edge_mask = None
+    if kwargs.get("gnnexplainer_init", "random") == "saliency":
+        init_edge_mask, _ = explain_sa_node(model, data, node_idx, target, device)
     node_feat_mask, edge_mask = explainer.explain_node_with_target(
         node_idx,
         x=data.x,
         edge_index=data.edge_index,
         edge_attr=data.edge_attr,
         target=target,
+        init_edge_mask=init_edge_mask,
     )
+    record_stop_epoch(explainer, **kwargs)
     edge_mask = edge_mask.cpu().detach().numpy()
     # 1 node feature mask for all the nodes.
     node_feat_mask = node_feat_mask.cpu().detach().numpy()
@@ -270,6 +405,7 @@ def explain_pgmexplainer_node(model, data, node_idx, target, device, **kwargs):
         kwargs["num_layers"],
         device=device,
         print_result=0,
+        batch_size=kwargs.get("perturbation_batch_size", 256),
     )
     explanation = explainer.explain(
         node_idx,
@@ -287,6 +423,8 @@ def explain_pgmexplainer_node(model, data, node_idx, target, device, **kwargs):
 
 
 def explain_subgraphx_node(model, data, node_idx, target, device, **kwargs):
+    reward_cache = get_reward_cache(**kwargs)
+    hits, misses = reward_cache.hits, reward_cache.misses
     subgraphx = SubgraphX(
         model,
         kwargs["num_classes"],
@@ -298,9 +436,14 @@ def explain_subgraphx_node(model, data, node_idx, target, device, **kwargs):
         expand_atoms=14,
         high2low=True,
         sample_num=50,
-        reward_method="mc_shapley",
+        reward_method=kwargs.get("subgraphx_reward_method", "mc_shapley"),
         subgraph_building_method="zero_filling",
         local_radius=4,
+        rng=get_rng(**kwargs),
+        reward_cache=reward_cache,
+        n_parallel=kwargs.get("subgraphx_parallel_rollouts", 1),
+        l_shapley_budget=kwargs.get("subgraphx_l_shapley_budget", 2**12),
+        max_batch_nodes=kwargs.get("max_batch_nodes", 2**16),
     )
     edge_mask = subgraphx.explain(
         data.x,
@@ -310,6 +453,8 @@ def explain_subgraphx_node(model, data, node_idx, target, device, **kwargs):
         label=target,
         node_idx=node_idx,
     )
+    record_reward_cache_stats(reward_cache, hits, misses, **kwargs)
+    record_reward_variance(subgraphx.reward_variances, **kwargs)
     return edge_mask.astype("float"), None
 
 
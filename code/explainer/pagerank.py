@@ -0,0 +1,72 @@
+from collections import deque
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+
+def transition_matrix(adj):
+    """Transposed random-walk matrix P^T of a binary CSR adjacency, and its sinks."""
+    out_degree = np.asarray(adj.sum(axis=1), dtype=float).ravel()
+    inv_degree = np.divide(
+        1.0, out_degree, out=np.zeros_like(out_degree), where=out_degree > 0
+    )
+    P_t = (sparse.diags(inv_degree) @ adj).T.tocsr()
+    return P_t, out_degree == 0
+
+
+def personalized_pagerank(adj, sources, alpha=0.85, tol=1e-6, max_iter=100):
+    """Personalized PageRank of the one-hot personalization vectors of sources.
+
+    Power iteration on the [N, B] matrix of all the personalization vectors at once,
+    with the conventions of nx.pagerank: the mass of dangling nodes goes back to the
+    personalization vector, and a column has converged when its l1 change is below
+    N * tol. Converged columns are no longer updated. Returns a [B, N] array.
+    """
+    num_nodes = adj.shape[0]
+    P_t, dangling = transition_matrix(adj)
+    sources = np.asarray(sources, dtype=int)
+    personalization = np.zeros((num_nodes, len(sources)))
+    personalization[sources, np.arange(len(sources))] = 1.0
+    x = np.full((num_nodes, len(sources)), 1.0 / num_nodes)
+    active = np.arange(len(sources))
+    for _ in range(max_iter):
+        x_last, p = x[:, active], personalization[:, active]
+        x_new = alpha * (P_t @ x_last + x_last[dangling].sum(axis=0) * p)
+        x_new += (1 - alpha) * p
+        x[:, active] = x_new
+        err = np.abs(x_new - x_last).sum(axis=0)
+        active = active[err >= num_nodes * tol]
+        if len(active) == 0:
+            return x.T
+    raise nx.PowerIterationFailedConvergence(max_iter)
+
+
+def personalized_pagerank_push(adj, source, alpha=0.85, eps=1e-7):
+    """Approximate personalized PageRank of source by local forward pushes.
+
+    The residual of a node is pushed to its out-neighbours while it is above
+    eps * out_degree, so that the cost does not depend on the size of the graph. As with
+    personalized_pagerank, the mass of dangling nodes goes back to source.
+    """
+    num_nodes = adj.shape[0]
+    out_degree = np.diff(adj.indptr)
+    ppr, residual = np.zeros(num_nodes), np.zeros(num_nodes)
+    residual[source] = 1.0
+    queue = deque([source])
+    while queue:
+        u = queue.popleft()
+        r = residual[u]
+        if r <= eps * max(out_degree[u], 1):
+            continue
+        ppr[u] += (1 - alpha) * r
+        residual[u] = 0.0
+        if out_degree[u] == 0:
+            neighbours, push = np.array([source]), alpha * r
+        else:
+            neighbours = adj.indices[adj.indptr[u] : adj.indptr[u + 1]]
+            push = alpha * r / out_degree[u]
+        residual[neighbours] += push
+        over = residual[neighbours] > eps * np.maximum(out_degree[neighbours], 1)
+        queue.extend(neighbours[over].tolist())
+    return ppr
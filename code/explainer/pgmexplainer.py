@@ -1,9 +1,53 @@
 import numpy as np
-import pandas as pd
 import torch
-from pgmpy.estimators.CITests import chi_square
+from scipy import stats
 from scipy.special import softmax
 from torch_geometric.utils import k_hop_subgraph
+from utils.graph_utils import repeat_graph_batch
+
+def chi_square_tests(samples, target_column):
+    """Pearson chi-square independence tests of every column of samples [S, K] against
+    target_column [S], in a single pass.
+
+    Same results as pgmpy's chi_square(X, Y, [], data, boolean=False) on each column, i.e.
+    scipy's chi2_contingency on the table of observed values (empty rows and columns are
+    dropped, Yates' correction when dof == 1, chi2 = 0 and p = 1 when dof == 0).
+    Returns the arrays chi2, p_values and dof of the K tests.
+    """
+    samples = np.asarray(samples)
+    num_samples, num_columns = samples.shape
+    _, x_codes = np.unique(samples, return_inverse=True)
+    x_codes = x_codes.reshape(num_samples, num_columns)
+    y_values, y_codes = np.unique(np.asarray(target_column), return_inverse=True)
+
+    observed = np.zeros((num_columns, x_codes.max() + 1, len(y_values)))
+    np.add.at(
+        observed,
+        (np.arange(num_columns)[None, :], x_codes, y_codes.reshape(-1)[:, None]),
+        1,
+    )
+    row_sums = observed.sum(axis=2, keepdims=True)
+    col_sums = observed.sum(axis=1, keepdims=True)
+    expected = row_sums * col_sums / num_samples
+    nonempty_rows = row_sums[:, :, 0] > 0
+    dof = (nonempty_rows.sum(axis=1) - 1) * (len(y_values) - 1)
+
+    # Yates' correction for continuity
+    yates = (dof == 1)[:, None, None]
+    diff = expected - observed
+    observed = np.where(
+        yates, observed + np.sign(diff) * np.minimum(0.5, np.abs(diff)), observed
+    )
+    terms = np.divide(
+        (observed - expected) ** 2,
+        expected,
+        out=np.zeros_like(expected),
+        where=expected > 0,
+    )
+    chi2 = np.where(dof > 0, terms.sum(axis=(1, 2)), 0.0)
+    p_values = np.where(dof > 0, stats.chi2.sf(chi2, np.maximum(dof, 1)), 1.0)
+    return chi2, p_values, dof
+
 
 ###### Node Classification ######
 
@@ -19,6 +63,7 @@ class Node_Explainer:
         device=None,
         mode=0,
         print_result=1,
+        batch_size=256,
     ):
         self.model = model
         self.model.eval()
@@ -29,6 +74,7 @@ class Node_Explainer:
         self.device = device
         self.mode = mode
         self.print_result = print_result
+        self.batch_size = batch_size
 
     def perturb_features_on_node(self, feature_matrix, node_idx, random=0, mode=0):
         # return a random perturbed feature matrix
@@ -64,97 +110,73 @@ class Node_Explainer:
         p_threshold=0.05,
         pred_threshold=0.1,
     ):
+        target = int(target)
         neighbors, _, _, _ = k_hop_subgraph(node_idx, self.num_layers, self.edge_index)
         neighbors = neighbors.cpu().detach().numpy()
 
         if node_idx not in neighbors:
             neighbors = np.append(neighbors, node_idx)
 
-        pred_torch = self.model(self.X, self.edge_index, self.edge_attr).cpu()
-        soft_pred = np.asarray(
-            [
-                softmax(np.asarray(pred_torch[node_].data))
-                for node_ in range(self.X.shape[0])
-            ]
+        # The predictions of the neighbors only depend on the (2*num_layers+1)-hop
+        # subgraph of node_idx: the extra hop keeps the degree normalisation exact.
+        subset, sub_edge_index, _, sub_edge_mask = k_hop_subgraph(
+            int(node_idx),
+            2 * self.num_layers + 1,
+            self.edge_index,
+            relabel_nodes=True,
+            num_nodes=self.X.shape[0],
         )
-
-        pred_node = np.asarray(pred_torch[node_idx].data)
-        label_node = np.argmax(pred_node)
-        soft_pred_node = softmax(pred_node)
-
-        Samples = []
-        Pred_Samples = []
-
-        for iteration in range(num_samples):
-
-            X_perturb = self.X.cpu().detach().numpy()
-            sample = []
-            for node in neighbors:
-                seed = np.random.randint(2)
-                if seed == 1:
-                    latent = 1
-                    X_perturb = self.perturb_features_on_node(
-                        X_perturb, node, random=seed
-                    )
-                else:
-                    latent = 0
-                sample.append(latent)
-
-            X_perturb_torch = torch.tensor(X_perturb, dtype=torch.float).to(self.device)
-            pred_perturb_torch = self.model(
-                X_perturb_torch, self.edge_index, self.edge_attr
-            ).cpu()
-            soft_pred_perturb = np.asarray(
-                [
-                    softmax(np.asarray(pred_perturb_torch[node_].data))
-                    for node_ in range(self.X.shape[0])
-                ]
+        sub_edge_attr = self.edge_attr[sub_edge_mask]
+        sub_X = self.X[subset].cpu().detach().numpy()
+        sub_neighbors = np.searchsorted(subset.cpu().numpy(), neighbors)
+
+        with torch.no_grad():
+            pred_torch = self.model(
+                torch.tensor(sub_X, dtype=torch.float).to(self.device),
+                sub_edge_index,
+                sub_edge_attr,
             )
+        soft_pred = pred_torch.softmax(dim=-1).cpu().numpy()[sub_neighbors]
 
-            sample_bool = []
-            for node in neighbors:
-                if (soft_pred_perturb[node, target] + pred_threshold) < soft_pred[
-                    node, target
-                ]:
-                    sample_bool.append(1)
-                else:
-                    sample_bool.append(0)
-
-            Samples.append(sample)
-            Pred_Samples.append(sample_bool)
-
-        Samples = np.asarray(Samples)
-        Pred_Samples = np.asarray(Pred_Samples)
-        Combine_Samples = Samples - Samples
-        for s in range(Samples.shape[0]):
-            Combine_Samples[s] = np.asarray(
-                [
-                    Samples[s, i] * 10 + Pred_Samples[s, i] + 1
-                    for i in range(Samples.shape[1])
-                ]
-            )
+        # Samples[s, i] = 1 if the features of neighbors[i] are replaced by random 0-1
+        # features in sample s (mode 0 of perturb_features_on_node)
+        Samples = np.random.randint(2, size=(num_samples, len(neighbors)))
+        random_features = np.random.randint(
+            2, size=(num_samples, len(neighbors), sub_X.shape[1])
+        )
+        X_perturb = np.repeat(sub_X[None], num_samples, axis=0)
+        sample_idx, neighbor_idx = np.nonzero(Samples)
+        X_perturb[sample_idx, sub_neighbors[neighbor_idx]] = random_features[
+            sample_idx, neighbor_idx
+        ]
 
-        data_pgm = pd.DataFrame(Combine_Samples)
-        data_pgm = data_pgm.rename(
-            columns={0: "A", 1: "B"}
-        )  # Trick to use chi_square test on first two data columns
-        ind_ori_to_sub = dict(zip(neighbors, list(data_pgm.columns)))
-
-        p_values = []
-        for node in neighbors:
-            if node == node_idx:
-                p = 0  # p<0.05 => we are confident that we can reject the null hypothesis (i.e. the prediction is the same after perturbing the neighbouring node
-                # => this neighbour has no influence on the prediction - should not be in the explanation)
-            else:
-                chi2, p, _ = chi_square(
-                    ind_ori_to_sub[node],
-                    ind_ori_to_sub[node_idx],
-                    [],
-                    data_pgm,
-                    boolean=False,
-                    significance_level=0.05,
-                )
-            p_values.append(p)
+        soft_pred_perturb = np.zeros((num_samples, len(neighbors)))
+        for start in range(0, num_samples, self.batch_size):
+            xs = torch.tensor(
+                X_perturb[start : start + self.batch_size], dtype=torch.float
+            ).to(self.device)
+            x, edge_index, edge_attr, batch = repeat_graph_batch(
+                xs, sub_edge_index, sub_edge_attr
+            )
+            with torch.no_grad():
+                out = self.model(x, edge_index, edge_attr, batch)
+            probs = out.softmax(dim=-1)[:, target].view(len(xs), -1)
+            soft_pred_perturb[start : start + len(xs)] = probs[
+                :, torch.as_tensor(sub_neighbors, device=probs.device)
+            ].cpu().numpy()
+        Pred_Samples = (
+            soft_pred_perturb + pred_threshold < soft_pred[None, :, target]
+        ).astype(int)
+
+        Combine_Samples = Samples * 10 + Pred_Samples + 1
+
+        _, p_values, _ = chi_square_tests(
+            Combine_Samples, Combine_Samples[:, neighbors == node_idx][:, 0]
+        )
+        p_values = list(p_values)
+        # p<0.05 => we are confident that we can reject the null hypothesis (i.e. the prediction is the same after perturbing the neighbouring node
+        # => this neighbour has no influence on the prediction - should not be in the explanation)
+        p_values[int(np.nonzero(neighbors == node_idx)[0][0])] = 0
 
         pgm_stats = dict(zip(neighbors, p_values))
         return pgm_stats
@@ -190,6 +212,7 @@ class Graph_Explainer:
         print_result=1,
         snorm_n=None,
         snorm_e=None,
+        batch_size=256,
     ):
         self.model = model
         self.model.eval()
@@ -203,85 +226,82 @@ class Graph_Explainer:
         self.perturb_mode = perturb_mode
         self.perturb_indicator = perturb_indicator
         self.print_result = print_result
+        self.batch_size = batch_size
+        self.X_mean = np.mean(self.X_feat, axis=0)
+        self.X_max = np.max(self.X_feat, axis=0)
+
+    def perturb_features(self, perturb_array):
+        # perturbed values of the rows perturb_array [K, F] of the feature matrix
+        if self.perturb_mode == "mean":
+            return np.broadcast_to(self.X_mean, perturb_array.shape)
+        elif self.perturb_mode == "zero":
+            return np.zeros_like(perturb_array)
+        elif self.perturb_mode == "max":
+            return np.broadcast_to(self.X_max, perturb_array.shape)
+        elif self.perturb_mode == "uniform":
+            epsilon = 0.05 * self.X_max
+            perturb_array = perturb_array + np.random.uniform(
+                low=-epsilon, high=epsilon, size=perturb_array.shape
+            )
+            return np.clip(perturb_array, 0, self.X_max)
+        return perturb_array
+
+    def predict_proba(self, X_perturb):
+        # class probabilities of the graph for each perturbed feature matrix [S, N, F]
+        probs = []
+        for start in range(0, len(X_perturb), self.batch_size):
+            xs = torch.tensor(
+                X_perturb[start : start + self.batch_size], dtype=torch.float
+            ).to(self.device)
+            x, edge_index, edge_attr, batch = repeat_graph_batch(
+                xs, self.edge_index, self.edge_attr
+            )
+            with torch.no_grad():
+                out = self.model(x, edge_index, edge_attr, batch)
+            probs.append(out.softmax(dim=-1).cpu().numpy())
+        return np.concatenate(probs)
 
     def perturb_features_on_node(self, feature_matrix, node_idx, random=0):
 
         X_perturb = feature_matrix.copy()
-        perturb_array = X_perturb[node_idx].copy()
-        epsilon = 0.05 * np.max(self.X_feat, axis=0)
         seed = np.random.randint(2)
-
-        if random == 1:
-            if seed == 1:
-                for i in range(perturb_array.shape[0]):
-                    if self.perturb_mode == "mean":
-                        perturb_array[i] = np.mean(feature_matrix[:, i])
-                    elif self.perturb_mode == "zero":
-                        perturb_array[i] = 0
-                    elif self.perturb_mode == "max":
-                        perturb_array[i] = np.max(feature_matrix[:, i])
-                    elif self.perturb_mode == "uniform":
-                        perturb_array[i] = perturb_array[i] + np.random.uniform(
-                            low=-epsilon[i], high=epsilon[i]
-                        )
-                        if perturb_array[i] < 0:
-                            perturb_array[i] = 0
-                        elif perturb_array[i] > np.max(self.X_feat, axis=0)[i]:
-                            perturb_array[i] = np.max(self.X_feat, axis=0)[i]
-
-        X_perturb[node_idx] = perturb_array
-
+        if random == 1 and seed == 1:
+            X_perturb[[node_idx]] = self.perturb_features(X_perturb[[node_idx]])
         return X_perturb
 
     def batch_perturb_features_on_node(
         self, num_samples, index_to_perturb, percentage, p_threshold, pred_threshold
     ):
         X_torch = torch.tensor(self.X_feat, dtype=torch.float).to(self.device)
-        pred_torch = self.model(X_torch, self.edge_index, self.edge_attr).cpu()
+        with torch.no_grad():
+            pred_torch = self.model(X_torch, self.edge_index, self.edge_attr).cpu()
         soft_pred = np.asarray(softmax(np.asarray(pred_torch[0].data)))
         pred_label = np.argmax(soft_pred)
         num_nodes = self.X_feat.shape[0]
-        Samples = []
-        for iteration in range(num_samples):
-            X_perturb = self.X_feat.copy()
-            sample = []
-            for node in range(num_nodes):
-                if node in index_to_perturb:
-                    seed = np.random.randint(100)
-                    if seed < percentage:
-                        latent = 1
-                        X_perturb = self.perturb_features_on_node(
-                            X_perturb, node, random=latent
-                        )
-                    else:
-                        latent = 0
-                else:
-                    latent = 0
-                sample.append(latent)
-
-            X_perturb_torch = torch.tensor(X_perturb, dtype=torch.float).to(self.device)
-            pred_perturb_torch = self.model(
-                X_perturb_torch, self.edge_index, self.edge_attr
-            ).cpu()
-            soft_pred_perturb = np.asarray(
-                softmax(np.asarray(pred_perturb_torch[0].data))
-            )
-            pred_change = np.max(soft_pred) - soft_pred_perturb[pred_label]
 
-            sample.append(pred_change)
-            Samples.append(sample)
+        # latent[s, node] = 1 if node is selected for perturbation in sample s. As in
+        # perturb_features_on_node, a selected node is actually perturbed with prob. 1/2.
+        can_perturb = np.zeros(num_nodes, dtype=bool)
+        can_perturb[np.asarray(list(index_to_perturb), dtype=int)] = True
+        latent = (
+            np.random.randint(100, size=(num_samples, num_nodes)) < percentage
+        ) & can_perturb
+        perturbed = latent & (np.random.randint(2, size=(num_samples, num_nodes)) == 1)
+        X_perturb = np.repeat(self.X_feat[None], num_samples, axis=0)
+        X_perturb[perturbed] = self.perturb_features(X_perturb[perturbed])
+
+        soft_pred_perturb = self.predict_proba(X_perturb)
+        pred_change = np.max(soft_pred) - soft_pred_perturb[:, pred_label]
+        Samples = np.concatenate((latent, pred_change[:, None]), axis=1)
 
-        Samples = np.asarray(Samples)
         if self.perturb_indicator == "abs":
             Samples = np.abs(Samples)
 
         top = int(num_samples / 8)
         top_idx = np.argsort(Samples[:, num_nodes])[-top:]
-        for i in range(num_samples):
-            if i in top_idx:
-                Samples[i, num_nodes] = 1
-            else:
-                Samples[i, num_nodes] = 0
+        is_top = np.zeros(num_samples)
+        is_top[top_idx] = 1
+        Samples[:, num_nodes] = is_top
 
         return Samples
 
@@ -307,20 +327,10 @@ class Graph_Explainer:
             pred_threshold,
         )
 
-        data = pd.DataFrame(Samples)
-
-        p_values = []
+        # The entry for the graph classification data is at "num_nodes"
+        _, p_values, _ = chi_square_tests(Samples[:, :num_nodes], Samples[:, num_nodes])
         candidate_nodes = []
 
-        target = (
-            num_nodes  # The entry for the graph classification data is at "num_nodes"
-        )
-        for node in range(num_nodes):
-            chi2, p, _ = chi_square(
-                node, target, [], data, boolean=False, significance_level=0.05
-            )
-            p_values.append(p)
-
         number_candidates = top_node
         candidate_nodes = np.argpartition(p_values, number_candidates)[
             0:number_candidates
@@ -330,19 +340,9 @@ class Graph_Explainer:
         Samples = self.batch_perturb_features_on_node(
             num_samples, candidate_nodes, percentage, p_threshold, pred_threshold
         )
-        data = pd.DataFrame(Samples)
-
-        p_values = []
-        dependent_nodes = []
-
-        target = num_nodes
-        for node in range(num_nodes):
-            chi2, p, _ = chi_square(
-                node, target, [], data, boolean=False, significance_level=0.05
-            )
-            p_values.append(p)
-            if p < p_threshold:
-                dependent_nodes.append(node)
+        _, p_values, _ = chi_square_tests(Samples[:, :num_nodes], Samples[:, num_nodes])
+        p_values = list(p_values)
+        dependent_nodes = list(np.nonzero(np.asarray(p_values) < p_threshold)[0])
 
         top_p = np.min((top_node, num_nodes - 1))
         ind_top_p = np.argpartition(p_values, top_p)[0:top_p]
@@ -11,7 +11,8 @@ from torch_geometric.data import Data, Batch, Dataset, DataLoader
 def GnnNetsGC2valueFunc(gnnNets, target_class):
     def value_func(data):
         with torch.no_grad():
-            logits = gnnNets(data.x, data.edge_index)
+            # the subgraph batches have no edge_attr: the kwargs path defaults it to ones
+            logits = gnnNets(x=data.x, edge_index=data.edge_index, batch=data.batch)
             probs = F.softmax(logits, dim=-1)
             score = probs[:, target_class]
         return score
@@ -78,8 +79,41 @@ def marginal_contribution(
     include_mask: np.array,
     value_func,
     subgraph_build_func,
+    max_batch_nodes=2**16,
 ):
     """Calculate the marginal value for each pair. Here exclude_mask and include_mask are node mask."""
+    batched_build_func = BATCHED_GRAPH_BUILD_FUNCS.get(subgraph_build_func)
+    if batched_build_func is None:
+        return marginal_contribution_dataloader(
+            data, exclude_mask, include_mask, value_func, subgraph_build_func
+        )
+    device = data.x.device
+    num_samples = exclude_mask.shape[0]
+    node_masks = torch.cat(
+        [
+            torch.as_tensor(exclude_mask, dtype=torch.float32, device=device),
+            torch.as_tensor(include_mask, dtype=torch.float32, device=device),
+        ]
+    )
+    chunk_size = max(1, max_batch_nodes // max(data.num_nodes, 1))
+    values = []
+    for i in range(0, node_masks.shape[0], chunk_size):
+        batch_data = batched_build_func(
+            data.x, data.edge_index, node_masks[i : i + chunk_size]
+        )
+        values.append(value_func(batch_data))
+    values = torch.cat(values, dim=0)
+    return values[num_samples:] - values[:num_samples]
+
+
+def marginal_contribution_dataloader(
+    data: Data,
+    exclude_mask: np.array,
+    include_mask: np.array,
+    value_func,
+    subgraph_build_func,
+):
+    """marginal_contribution of custom subgraph building functions, with a DataLoader"""
     marginal_subgraph_dataset = MarginalSubgraphDataset(
         data, exclude_mask, include_mask, subgraph_build_func
     )
@@ -114,60 +148,245 @@ def graph_build_split(X, edge_index, node_mask: np.array):
     return ret_X, ret_edge_index
 
 
+def repeat_edge_index(edge_index, num_nodes, num_graphs):
+    """edge_index of num_graphs copies of a graph of num_nodes nodes, graph by graph"""
+    offset = torch.arange(num_graphs, device=edge_index.device) * num_nodes
+    edge_index = edge_index[None] + offset[:, None, None]
+    return edge_index.permute(1, 0, 2).reshape(2, -1)
+
+
+def batched_graph_build_zero_filling(X, edge_index, node_masks):
+    """graph_build_zero_filling of all the node masks [B, N], as a single Batch"""
+    num_graphs, num_nodes = node_masks.shape
+    return Batch(
+        x=(X[None] * node_masks[:, :, None]).reshape(-1, X.shape[-1]),
+        edge_index=repeat_edge_index(edge_index, num_nodes, num_graphs),
+        batch=torch.arange(num_graphs, device=X.device).repeat_interleave(num_nodes),
+    )
+
+
+def batched_graph_build_split(X, edge_index, node_masks):
+    """graph_build_split of all the node masks [B, N], as a single Batch"""
+    num_graphs, num_nodes = node_masks.shape
+    row, col = edge_index
+    edge_mask = (node_masks[:, row] == 1) & (node_masks[:, col] == 1)
+    return Batch(
+        x=X.repeat(num_graphs, 1),
+        edge_index=repeat_edge_index(edge_index, num_nodes, num_graphs)[
+            :, edge_mask.reshape(-1)
+        ],
+        batch=torch.arange(num_graphs, device=X.device).repeat_interleave(num_nodes),
+    )
+
+
+BATCHED_GRAPH_BUILD_FUNCS = {
+    graph_build_zero_filling: batched_graph_build_zero_filling,
+    graph_build_split: batched_graph_build_split,
+}
+
+
+def sample_exclude_masks(players, base_mask, sample_num, rng=None):
+    """Exclude masks [sample_num, num_nodes] of the Monte-Carlo Shapley estimates.
+
+    Each sample is a random permutation of the players and of the coalition (as a single
+    player): the players placed before the coalition are added to base_mask. All the
+    permutations are drawn at once, as the order of a random matrix whose last column is
+    the coalition. rng is a np.random.Generator or RandomState (default: np.random).
+    """
+    rng = np.random if rng is None else rng
+    players = np.asarray(players, dtype=int)
+    ranks = rng.random((sample_num, len(players) + 1))
+    base_mask = np.asarray(base_mask, dtype=float)
+    exclude_mask = np.repeat(base_mask[None], sample_num, axis=0)
+    exclude_mask[:, players] = np.maximum(
+        exclude_mask[:, players], ranks[:, :-1] < ranks[:, -1:]
+    )
+    return exclude_mask
+
+
+def get_local_region(graph, coalition, local_radius):
+    """nodes within local_radius - 1 hops of the coalition"""
+    local_region = copy.copy(coalition)
+    for k in range(local_radius - 1):
+        k_neiborhoood = []
+        for node in local_region:
+            k_neiborhoood += list(graph.neighbors(node))
+        local_region += k_neiborhoood
+        local_region = list(set(local_region))
+    return local_region
+
+
 def l_shapley(
     coalition: list,
     data: Data,
     local_radius: int,
     value_func: str,
     subgraph_building_method="zero_filling",
+    budget=2**12,
+    rng=None,
+    return_variance=False,
+    max_batch_nodes=2**16,
 ):
-    """shapley value where players are local neighbor nodes"""
+    """shapley value where players are local neighbor nodes
+
+    The subsets of the k players around the coalition are enumerated if 2^k <= budget.
+    Otherwise the marginal contributions are estimated by stratified sampling: about
+    budget / (k + 1) subsets of each size (all of them if there are fewer), the shapley
+    value being the mean over the sizes of the mean contribution of each size. If
+    return_variance, the variance of the estimate is returned too (0 if exact).
+    """
     graph = to_networkx(data)
     num_nodes = graph.number_of_nodes()
     subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    rng = np.random if rng is None else rng
 
-    local_region = copy.copy(coalition)
-    for k in range(local_radius - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
-
-    set_exclude_masks = []
-    set_include_masks = []
-    nodes_around = [node for node in local_region if node not in coalition]
+    local_region = get_local_region(graph, coalition, local_radius)
+    nodes_around = np.array(
+        [node for node in local_region if node not in coalition], dtype=int
+    )
     num_nodes_around = len(nodes_around)
+    exact = 2**num_nodes_around <= budget
+    samples_per_size = max(2, budget // (num_nodes_around + 1))
 
+    base_mask = np.ones(num_nodes)
+    base_mask[local_region] = 0.0
+    set_exclude_masks = []
+    strata = []  # (number of subsets, whether they are all the subsets of the size)
     for subset_len in range(0, num_nodes_around + 1):
-        node_exclude_subsets = combinations(nodes_around, subset_len)
-        for node_exclude_subset in node_exclude_subsets:
-            set_exclude_mask = np.ones(num_nodes)
-            set_exclude_mask[local_region] = 0.0
-            if node_exclude_subset:
-                set_exclude_mask[list(node_exclude_subset)] = 1.0
-            set_include_mask = set_exclude_mask.copy()
-            set_include_mask[coalition] = 1.0
-
-            set_exclude_masks.append(set_exclude_mask)
-            set_include_masks.append(set_include_mask)
-
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    num_players = len(nodes_around) + 1
-    num_player_in_set = (
-        num_players - 1 + len(coalition) - (1 - exclude_mask).sum(axis=1)
-    )
-    p = num_players
-    S = num_player_in_set
-    coeffs = torch.tensor(1.0 / comb(p, S) / (p - S + 1e-6))
+        if exact or comb(num_nodes_around, subset_len) <= samples_per_size:
+            subsets = np.array(
+                list(combinations(range(num_nodes_around), subset_len)), dtype=int
+            ).reshape(comb(num_nodes_around, subset_len, exact=True), subset_len)
+            strata.append((len(subsets), True))
+        else:
+            ranks = rng.random((samples_per_size, num_nodes_around))
+            subsets = np.argsort(ranks, axis=1)[:, :subset_len]
+            strata.append((samples_per_size, False))
+        set_exclude_mask = np.repeat(base_mask[None], len(subsets), axis=0)
+        rows = np.repeat(np.arange(len(subsets)), subset_len)
+        set_exclude_mask[rows, nodes_around[subsets].reshape(-1)] = 1.0
+        set_exclude_masks.append(set_exclude_mask)
+
+    exclude_mask = np.concatenate(set_exclude_masks, axis=0)
+    include_mask = exclude_mask.copy()
+    include_mask[:, coalition] = 1.0
 
     marginal_contributions = marginal_contribution(
-        data, exclude_mask, include_mask, value_func, subgraph_build_func
+        data,
+        exclude_mask,
+        include_mask,
+        value_func,
+        subgraph_build_func,
+        max_batch_nodes=max_batch_nodes,
     )
+    marginal_contributions = marginal_contributions.reshape(-1).cpu().numpy()
+    sections = np.cumsum([size for size, _ in strata])[:-1]
+
+    # every size has the same total shapley weight 1 / (k + 1)
+    num_players = num_nodes_around + 1
+    l_shapley_value, variance = 0.0, 0.0
+    for values, (size, is_exact) in zip(
+        np.split(marginal_contributions, sections), strata
+    ):
+        l_shapley_value += values.mean() / num_players
+        if not is_exact:
+            variance += values.var(ddof=1) / size / num_players**2
+    if return_variance:
+        return float(l_shapley_value), float(variance)
+    return float(l_shapley_value)
+
+
+def mc_shapley_masks(coalition, num_nodes, sample_num=1000, rng=None):
+    """sampled exclude and include masks of the monte carlo shapley value"""
+    players = np.setdiff1d(np.arange(num_nodes), coalition)
+    exclude_mask = sample_exclude_masks(players, np.zeros(num_nodes), sample_num, rng)
+    include_mask = exclude_mask.copy()
+    include_mask[:, coalition] = 1.0
+    return exclude_mask, include_mask
+
+
+def mc_l_shapley_masks(
+    coalition, graph, local_radius, sample_num=1000, node_idx=-1, rng=None
+):
+    """sampled exclude and include masks of the monte carlo l_shapley value, where the
+    target node (if node_idx != -1) is kept in both subgraphs"""
+    num_nodes = graph.number_of_nodes()
+    local_region = get_local_region(graph, coalition, local_radius)
+    players = [node for node in local_region if node not in coalition]
+    base_mask = np.ones(num_nodes)
+    base_mask[local_region] = 0.0
+    exclude_mask = sample_exclude_masks(players, base_mask, sample_num, rng)
+    if node_idx != -1:
+        exclude_mask[:, node_idx] = 1.0
+    include_mask = exclude_mask.copy()
+    include_mask[:, coalition] = 1.0  # include the node_idx
+    return exclude_mask, include_mask
+
+
+def mean_marginal_contributions(
+    data, masks, value_func, subgraph_build_func, max_batch_nodes=2**16
+):
+    """mean marginal contribution of each (exclude_mask, include_mask) pair of masks,
+    with the subgraphs of all the pairs scored together"""
+    exclude_mask = np.concatenate([exclude for exclude, _ in masks], axis=0)
+    include_mask = np.concatenate([include for _, include in masks], axis=0)
+    marginal_contributions = marginal_contribution(
+        data,
+        exclude_mask,
+        include_mask,
+        value_func,
+        subgraph_build_func,
+        max_batch_nodes=max_batch_nodes,
+    )
+    sections = np.cumsum([exclude.shape[0] for exclude, _ in masks])[:-1]
+    marginal_contributions = marginal_contributions.reshape(-1).cpu().numpy()
+    return [
+        float(values.mean()) for values in np.split(marginal_contributions, sections)
+    ]
 
-    l_shapley_value = (marginal_contributions.squeeze().cpu() * coeffs).sum().item()
-    return l_shapley_value
+
+def mc_shapley_batch(
+    coalitions: list,
+    data: Data,
+    value_func: str,
+    subgraph_building_method="zero_filling",
+    sample_num=1000,
+    rng=None,
+    max_batch_nodes=2**16,
+) -> list:
+    """mc_shapley of several coalitions of the same graph"""
+    subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    masks = [
+        mc_shapley_masks(coalition, data.num_nodes, sample_num, rng)
+        for coalition in coalitions
+    ]
+    return mean_marginal_contributions(
+        data, masks, value_func, subgraph_build_func, max_batch_nodes
+    )
+
+
+def mc_l_shapley_batch(
+    coalitions: list,
+    data: Data,
+    local_radius: int,
+    value_func: str,
+    node_idx: int = -1,
+    subgraph_building_method="zero_filling",
+    sample_num=1000,
+    rng=None,
+    max_batch_nodes=2**16,
+) -> list:
+    """mc_l_shapley (NC_mc_l_shapley if node_idx != -1) of several coalitions of the
+    same graph"""
+    graph = to_networkx(data)
+    subgraph_build_func = get_graph_build_func(subgraph_building_method)
+    masks = [
+        mc_l_shapley_masks(coalition, graph, local_radius, sample_num, node_idx, rng)
+        for coalition in coalitions
+    ]
+    return mean_marginal_contributions(
+        data, masks, value_func, subgraph_build_func, max_batch_nodes
+    )
 
 
 def mc_shapley(
@@ -176,38 +395,19 @@ def mc_shapley(
     value_func: str,
     subgraph_building_method="zero_filling",
     sample_num=1000,
+    rng=None,
+    max_batch_nodes=2**16,
 ) -> float:
     """monte carlo sampling approximation of the shapley value"""
-    subset_build_func = get_graph_build_func(subgraph_building_method)
-
-    num_nodes = data.num_nodes
-    node_indices = np.arange(num_nodes)
-    coalition_placeholder = num_nodes
-    set_exclude_masks = []
-    set_include_masks = []
-
-    for example_idx in range(sample_num):
-        subset_nodes_from = [node for node in node_indices if node not in coalition]
-        random_nodes_permutation = np.array(subset_nodes_from + [coalition_placeholder])
-        random_nodes_permutation = np.random.permutation(random_nodes_permutation)
-        split_idx = np.where(random_nodes_permutation == coalition_placeholder)[0][0]
-        selected_nodes = random_nodes_permutation[:split_idx]
-        set_exclude_mask = np.zeros(num_nodes)
-        set_exclude_mask[selected_nodes] = 1.0
-        set_include_mask = set_exclude_mask.copy()
-        set_include_mask[coalition] = 1.0
-
-        set_exclude_masks.append(set_exclude_mask)
-        set_include_masks.append(set_include_mask)
-
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(
-        data, exclude_mask, include_mask, value_func, subset_build_func
-    )
-    mc_shapley_value = marginal_contributions.mean().item()
-
-    return mc_shapley_value
+    return mc_shapley_batch(
+        [coalition],
+        data,
+        value_func,
+        subgraph_building_method,
+        sample_num,
+        rng,
+        max_batch_nodes=max_batch_nodes,
+    )[0]
 
 
 def mc_l_shapley(
@@ -217,46 +417,20 @@ def mc_l_shapley(
     value_func: str,
     subgraph_building_method="zero_filling",
     sample_num=1000,
+    rng=None,
+    max_batch_nodes=2**16,
 ) -> float:
     """monte carlo sampling approximation of the l_shapley value"""
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
-    subgraph_build_func = get_graph_build_func(subgraph_building_method)
-
-    local_region = copy.copy(coalition)
-    for k in range(local_radius - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
-
-    coalition_placeholder = num_nodes
-    set_exclude_masks = []
-    set_include_masks = []
-    for example_idx in range(sample_num):
-        subset_nodes_from = [node for node in local_region if node not in coalition]
-        random_nodes_permutation = np.array(subset_nodes_from + [coalition_placeholder])
-        random_nodes_permutation = np.random.permutation(random_nodes_permutation)
-        split_idx = np.where(random_nodes_permutation == coalition_placeholder)[0][0]
-        selected_nodes = random_nodes_permutation[:split_idx]
-        set_exclude_mask = np.ones(num_nodes)
-        set_exclude_mask[local_region] = 0.0
-        set_exclude_mask[selected_nodes] = 1.0
-        set_include_mask = set_exclude_mask.copy()
-        set_include_mask[coalition] = 1.0
-
-        set_exclude_masks.append(set_exclude_mask)
-        set_include_masks.append(set_include_mask)
-
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(
-        data, exclude_mask, include_mask, value_func, subgraph_build_func
-    )
-
-    mc_l_shapley_value = (marginal_contributions).mean().item()
-    return mc_l_shapley_value
+    return mc_l_shapley_batch(
+        [coalition],
+        data,
+        local_radius,
+        value_func,
+        subgraph_building_method=subgraph_building_method,
+        sample_num=sample_num,
+        rng=rng,
+        max_batch_nodes=max_batch_nodes,
+    )[0]
 
 
 def gnn_score(
@@ -286,48 +460,21 @@ def NC_mc_l_shapley(
     node_idx: int = -1,
     subgraph_building_method="zero_filling",
     sample_num=1000,
+    rng=None,
+    max_batch_nodes=2**16,
 ) -> float:
     """monte carlo approximation of l_shapley where the target node is kept in both subgraph"""
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
-    subgraph_build_func = get_graph_build_func(subgraph_building_method)
-
-    local_region = copy.copy(coalition)
-    for k in range(local_radius - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
-
-    coalition_placeholder = num_nodes
-    set_exclude_masks = []
-    set_include_masks = []
-    for example_idx in range(sample_num):
-        subset_nodes_from = [node for node in local_region if node not in coalition]
-        random_nodes_permutation = np.array(subset_nodes_from + [coalition_placeholder])
-        random_nodes_permutation = np.random.permutation(random_nodes_permutation)
-        split_idx = np.where(random_nodes_permutation == coalition_placeholder)[0][0]
-        selected_nodes = random_nodes_permutation[:split_idx]
-        set_exclude_mask = np.ones(num_nodes)
-        set_exclude_mask[local_region] = 0.0
-        set_exclude_mask[selected_nodes] = 1.0
-        if node_idx != -1:
-            set_exclude_mask[node_idx] = 1.0
-        set_include_mask = set_exclude_mask.copy()
-        set_include_mask[coalition] = 1.0  # include the node_idx
-
-        set_exclude_masks.append(set_exclude_mask)
-        set_include_masks.append(set_include_mask)
-
-    exclude_mask = np.stack(set_exclude_masks, axis=0)
-    include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(
-        data, exclude_mask, include_mask, value_func, subgraph_build_func
-    )
-
-    mc_l_shapley_value = (marginal_contributions).mean().item()
-    return mc_l_shapley_value
+    return mc_l_shapley_batch(
+        [coalition],
+        data,
+        local_radius,
+        value_func,
+        node_idx=node_idx,
+        subgraph_building_method=subgraph_building_method,
+        sample_num=sample_num,
+        rng=rng,
+        max_batch_nodes=max_batch_nodes,
+    )[0]
 
 
 def sparsity(coalition: list, data: Data, subgraph_building_method="zero_filling"):
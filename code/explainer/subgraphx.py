@@ -1,12 +1,16 @@
 import copy
+import hashlib
 import math
 import os
-from collections import Counter
+from collections import OrderedDict
 from functools import partial
 from typing import Callable, Dict, List, Optional, Tuple
 
 import networkx as nx
+import numpy as np
+import scipy.sparse as sp
 import torch
+from scipy.sparse.csgraph import connected_components
 from torch import Tensor
 from torch_geometric.data import Batch, Data
 from torch_geometric.nn.conv import MessagePassing
@@ -19,11 +23,162 @@ from explainer.shapley import (
     gnn_score,
     l_shapley,
     mc_l_shapley,
+    mc_l_shapley_batch,
     mc_shapley,
+    mc_shapley_batch,
     sparsity,
 )
 
 
+def coalition_key(coalition):
+    """Canonical hashable key of a coalition: the same set of nodes gives the same key."""
+    return frozenset(coalition)
+
+
+def graph_hash(data, node_idx=None):
+    """Hash of the features and the structure of a graph (and of the explained node)."""
+    h = hashlib.sha1()
+    for item in [data.x, data.edge_index, getattr(data, "edge_attr", None)]:
+        if item is not None:
+            h.update(item.detach().cpu().numpy().tobytes())
+    h.update(str(node_idx).encode())
+    return h.hexdigest()
+
+
+class RewardCache(object):
+    """Bounded LRU cache of the coalition rewards, shared by rollouts and explain calls.
+
+    Keys are (graph hash, coalition key, label, reward config).
+    """
+
+    def __init__(self, max_size=2**16):
+        self.max_size = max_size
+        self.rewards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.rewards)
+
+    def get(self, key):
+        if key in self.rewards:
+            self.rewards.move_to_end(key)
+            self.hits += 1
+            return self.rewards[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, reward):
+        self.rewards[key] = reward
+        self.rewards.move_to_end(key)
+        while len(self.rewards) > self.max_size:
+            self.rewards.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size": len(self.rewards),
+        }
+
+
+def get_reward_cache(**kwargs):
+    """RewardCache of the run, created on first use in its explainer_cache (if any)."""
+    max_size = kwargs.get("subgraphx_reward_cache_size", 2**16)
+    shared = kwargs.get("explainer_cache")
+    if shared is None:
+        return RewardCache(max_size)
+    return shared.setdefault("subgraphx_reward_cache", RewardCache(max_size))
+
+
+def get_rng(**kwargs):
+    """Random generator of the run, seeded once and kept in its explainer_cache (if any).
+
+    The monte carlo sampling of the explained instances then draws from one stream,
+    instead of restarting the same seeded stream for every instance.
+    """
+    shared = kwargs.get("explainer_cache")
+    if shared is None:
+        return np.random.default_rng(kwargs.get("seed", 0))
+    if "rng" not in shared:
+        shared["rng"] = np.random.default_rng(kwargs.get("seed", 0))
+    return shared["rng"]
+
+
+def record_reward_cache_stats(reward_cache, hits, misses, **kwargs):
+    """Append the hit rate of the lookups since (hits, misses) to explainer_stats."""
+    stats = kwargs.get("explainer_stats")
+    if stats is None:
+        return
+    new_hits, new_misses = reward_cache.hits - hits, reward_cache.misses - misses
+    stats.setdefault("reward_cache_hit_rate", []).append(
+        new_hits / max(new_hits + new_misses, 1)
+    )
+
+
+def record_reward_variance(variances, **kwargs):
+    """Append the mean variance of the sampled rewards of an explanation to explainer_stats."""
+    stats = kwargs.get("explainer_stats")
+    if stats is None or not variances:
+        return
+    stats.setdefault("l_shapley_variance", []).append(float(np.mean(variances)))
+
+
+def graph_to_csr(graph, num_nodes):
+    """Symmetric binary CSR adjacency of a networkx graph with nodes 0..num_nodes-1."""
+    edges = np.asarray(list(graph.edges()), dtype=np.int64).reshape(-1, 2)
+    row = np.concatenate((edges[:, 0], edges[:, 1]))
+    col = np.concatenate((edges[:, 1], edges[:, 0]))
+    adj = sp.coo_matrix(
+        (np.ones(len(row)), (row, col)), shape=(num_nodes, num_nodes)
+    ).tocsr()
+    adj.data[:] = 1
+    return adj
+
+
+def prune_coalition(adj, coalition, removed_nodes, target=None):
+    """Main connected component of a coalition after removing each of removed_nodes.
+
+    All the prunings are evaluated in one sweep, on the block diagonal matrix of the pruned
+    copies of the coalition subgraph. The main component is the one containing target if
+    given, otherwise the largest one; ties go to the component with the smallest node, as
+    with the order of nx.connected_components. Returns one sorted coalition per removed node.
+    """
+    if len(removed_nodes) == 0:
+        return []
+    coalition = np.asarray(coalition)
+    num_copies, k = len(removed_nodes), len(coalition)
+    sub_adj = adj[coalition][:, coalition]
+    keep = np.ones((num_copies, k))
+    keep[np.arange(num_copies), np.searchsorted(coalition, removed_nodes)] = 0
+    keep_diag = sp.diags(keep.reshape(-1))
+    pruned_adj = (
+        keep_diag
+        @ sp.kron(sp.identity(num_copies, format="csr"), sub_adj, format="csr")
+        @ keep_diag
+    )
+    _, labels = connected_components(pruned_adj, directed=False)
+    labels = labels.reshape(num_copies, k)
+    kept = keep.astype(bool)
+
+    if target is not None:
+        main_labels = labels[:, np.searchsorted(coalition, target)]
+    else:
+        sizes = np.bincount(labels[kept], minlength=labels.max() + 1)
+        node_sizes = np.where(kept, sizes[labels], 0)
+        is_largest = node_sizes == node_sizes.max(axis=1, keepdims=True)
+        # first (smallest) node of each copy that belongs to a largest component
+        main_labels = labels[np.arange(num_copies), np.argmax(is_largest, axis=1)]
+    in_main = (labels == main_labels[:, None]) & kept
+    return [coalition[row].tolist() for row in in_main]
+
+
 def find_closest_node_result(results, max_nodes):
     """return the highest reward tree_node with its subgraph is smaller than max_nodes"""
     results = sorted(results, key=lambda x: len(x.coalition))
@@ -36,6 +191,13 @@ def find_closest_node_result(results, max_nodes):
     return result_node
 
 
+def l_shapley_reward(coalition, data, variances, **kwargs):
+    """l_shapley of the coalition, appending the variance of the estimate to variances"""
+    value, variance = l_shapley(coalition, data, return_variance=True, **kwargs)
+    variances.append(variance)
+    return value
+
+
 def reward_func(
     reward_method,
     value_func,
@@ -43,6 +205,10 @@ def reward_func(
     local_radius=4,
     sample_num=100,
     subgraph_building_method="zero_filling",
+    rng=None,
+    l_shapley_budget=2**12,
+    max_batch_nodes=2**16,
+    variances=None,
 ):
     if reward_method.lower() == "gnn_score":
         return partial(
@@ -57,14 +223,30 @@ def reward_func(
             value_func=value_func,
             subgraph_building_method=subgraph_building_method,
             sample_num=sample_num,
+            rng=rng,
+            max_batch_nodes=max_batch_nodes,
         )
 
     elif reward_method.lower() == "l_shapley":
+        if variances is not None:
+            return partial(
+                l_shapley_reward,
+                variances=variances,
+                local_radius=local_radius,
+                value_func=value_func,
+                subgraph_building_method=subgraph_building_method,
+                budget=l_shapley_budget,
+                rng=rng,
+                max_batch_nodes=max_batch_nodes,
+            )
         return partial(
             l_shapley,
             local_radius=local_radius,
             value_func=value_func,
             subgraph_building_method=subgraph_building_method,
+            budget=l_shapley_budget,
+            rng=rng,
+            max_batch_nodes=max_batch_nodes,
         )
 
     elif reward_method.lower() == "mc_l_shapley":
@@ -74,6 +256,8 @@ def reward_func(
             value_func=value_func,
             subgraph_building_method=subgraph_building_method,
             sample_num=sample_num,
+            rng=rng,
+            max_batch_nodes=max_batch_nodes,
         )
 
     elif reward_method.lower() == "nc_mc_l_shapley":
@@ -85,20 +269,104 @@ def reward_func(
             value_func=value_func,
             subgraph_building_method=subgraph_building_method,
             sample_num=sample_num,
+            rng=rng,
+            max_batch_nodes=max_batch_nodes,
         )
 
     else:
         raise NotImplementedError
 
 
-def compute_scores(score_func, children):
-    results = []
-    for child in children:
-        if child.P == 0:
-            score = score_func(child.coalition, child.data)
+def batch_reward_func(
+    reward_method,
+    value_func,
+    node_idx=None,
+    local_radius=4,
+    sample_num=100,
+    subgraph_building_method="zero_filling",
+    rng=None,
+    l_shapley_budget=2**12,
+    max_batch_nodes=2**16,
+    variances=None,
+):
+    """Reward function of a list of coalitions of the same graph: the subgraphs sampled
+    for all the coalitions are scored together for the monte carlo methods."""
+    if reward_method.lower() == "mc_shapley":
+        return partial(
+            mc_shapley_batch,
+            value_func=value_func,
+            subgraph_building_method=subgraph_building_method,
+            sample_num=sample_num,
+            rng=rng,
+            max_batch_nodes=max_batch_nodes,
+        )
+
+    elif reward_method.lower() in ["mc_l_shapley", "nc_mc_l_shapley"]:
+        if reward_method.lower() == "nc_mc_l_shapley":
+            assert node_idx is not None, " Wrong node idx input "
         else:
-            score = child.P
-        results.append(score)
+            node_idx = -1
+        return partial(
+            mc_l_shapley_batch,
+            local_radius=local_radius,
+            value_func=value_func,
+            node_idx=node_idx,
+            subgraph_building_method=subgraph_building_method,
+            sample_num=sample_num,
+            rng=rng,
+            max_batch_nodes=max_batch_nodes,
+        )
+
+    score_func = reward_func(
+        reward_method,
+        value_func,
+        node_idx=node_idx,
+        local_radius=local_radius,
+        sample_num=sample_num,
+        subgraph_building_method=subgraph_building_method,
+        rng=rng,
+        l_shapley_budget=l_shapley_budget,
+        max_batch_nodes=max_batch_nodes,
+        variances=variances,
+    )
+    return lambda coalitions, data: [
+        score_func(coalition, data) for coalition in coalitions
+    ]
+
+
+def compute_scores(
+    score_func, children, reward_cache=None, reward_key=None, batch_score_func=None
+):
+    """Rewards of the children, the unscored ones being scored in one batch_score_func
+    call if given. Children with the same coalition are scored once."""
+    reward_key = () if reward_key is None else reward_key
+    results = [child.P for child in children]
+    pending = {}
+    for i, child in enumerate(children):
+        if child.P != 0:
+            continue
+        key = (*reward_key[:1], coalition_key(child.coalition), *reward_key[1:])
+        score = None if reward_cache is None else reward_cache.get(key)
+        if score is None:
+            pending.setdefault(key, []).append(i)
+        else:
+            results[i] = score
+
+    if batch_score_func is not None and pending:
+        indices = [idx[0] for idx in pending.values()]
+        scores = batch_score_func(
+            [children[i].coalition for i in indices], children[indices[0]].data
+        )
+    else:
+        scores = [
+            score_func(children[idx[0]].coalition, children[idx[0]].data)
+            for idx in pending.values()
+        ]
+    for (key, idx), score in zip(pending.items(), scores):
+        for i in idx:
+            results[i] = score
+        if reward_cache is not None:
+            reward_cache.put(key, score)
     return results
 
 
@@ -171,6 +439,13 @@ class MCTS(object):
         high2low (:obj:`bool`): Whether to expand children tree node from high degree nodes to low degree nodes.
         node_idx (:obj:`int`): The target node index to extract the neighborhood.
         score_func (:obj:`Callable`): The reward function for tree node, such as mc_shapely and mc_l_shapely.
+        reward_cache (:obj:`RewardCache`, :obj:`None`): Cache of the coalition rewards.
+        reward_config (:obj:`Tuple`): Label and reward parameters of the cache keys.
+        batch_score_func (:obj:`Callable`): The reward function of a list of coalitions.
+        n_parallel (:obj:`int`): The number of rollouts run concurrently, whose new
+          leaves are scored together with batch_score_func.
+        virtual_loss (:obj:`float`): The loss temporarily given to the nodes selected by
+          the in-flight rollouts, so that concurrent rollouts select different paths.
     """
 
     def __init__(
@@ -187,6 +462,11 @@ class MCTS(object):
         node_idx: int = None,
         score_func: Callable = None,
         device="cpu",
+        reward_cache=None,
+        reward_config=(),
+        batch_score_func: Callable = None,
+        n_parallel: int = 1,
+        virtual_loss: float = 1.0,
     ):
 
         self.X = X
@@ -204,6 +484,9 @@ class MCTS(object):
         self.data = Batch.from_data_list([self.data])
         self.num_nodes = self.graph.number_of_nodes()
         self.score_func = score_func
+        self.batch_score_func = batch_score_func
+        self.n_parallel = n_parallel
+        self.virtual_loss = virtual_loss
         self.n_rollout = n_rollout
         self.min_atoms = min_atoms
         self.c_puct = c_puct
@@ -232,6 +515,9 @@ class MCTS(object):
 
             self.subset = subset
 
+        self.adj = graph_to_csr(self.graph, self.num_nodes)
+        self.reward_cache = reward_cache
+        self.reward_key = (graph_hash(self.data, self.new_node_idx), *reward_config)
         self.root_coalition = sorted([node for node in range(self.num_nodes)])
         self.MCTSNodeClass = partial(
             MCTSNode,
@@ -241,10 +527,11 @@ class MCTS(object):
             device=self.device,
         )
         self.root = self.MCTSNodeClass(self.root_coalition)
-        self.state_map = {str(self.root.coalition): self.root}
+        self.state_map = {coalition_key(self.root.coalition): self.root}
 
-    def set_score_func(self, score_func):
+    def set_score_func(self, score_func, batch_score_func=None):
         self.score_func = score_func
+        self.batch_score_func = batch_score_func
 
     @staticmethod
     def __subgraph__(node_idx, x, edge_index, num_hops, **kwargs):
@@ -268,6 +555,62 @@ class MCTS(object):
 
         return x, edge_index, subset, edge_mask, kwargs
 
+    def expand(self, tree_node):
+        """Create the (unscored) children of tree_node."""
+        cur_graph_coalition = tree_node.coalition
+        # nodes of the coalition sorted by their degree in the coalition subgraph
+        coalition = np.asarray(cur_graph_coalition)
+        degrees = np.asarray(self.adj[coalition][:, coalition].sum(axis=1)).ravel()
+        order = np.argsort(-degrees if self.high2low else degrees, kind="stable")
+        all_nodes = coalition[order].tolist()
+
+        if self.new_node_idx:
+            expand_nodes = [node for node in all_nodes if node != self.new_node_idx]
+        else:
+            expand_nodes = all_nodes
+
+        if len(all_nodes) > self.expand_atoms:
+            expand_nodes = expand_nodes[: self.expand_atoms]
+
+        # for each node, pruning it and get the remaining sub-graph
+        # here we check the resulting sub-graphs and only keep the largest one
+        # (or the one of the explained node)
+        new_graph_coalitions = prune_coalition(
+            self.adj,
+            cur_graph_coalition,
+            expand_nodes,
+            target=self.new_node_idx if self.new_node_idx else None,
+        )
+
+        child_keys = set()
+        for new_graph_coalition in new_graph_coalitions:
+            # check the state map and merge the same sub-graph
+            new_key = coalition_key(new_graph_coalition)
+            new_node = self.state_map.get(new_key)
+            if new_node is None:
+                new_node = self.MCTSNodeClass(new_graph_coalition)
+                self.state_map[new_key] = new_node
+
+            if new_key not in child_keys:
+                tree_node.children.append(new_node)
+                child_keys.add(new_key)
+
+    def score_children(self, tree_nodes):
+        children = [child for tree_node in tree_nodes for child in tree_node.children]
+        scores = compute_scores(
+            self.score_func,
+            children,
+            self.reward_cache,
+            self.reward_key,
+            self.batch_score_func,
+        )
+        for child, score in zip(children, scores):
+            child.P = score
+
+    def select_child(self, tree_node):
+        sum_count = sum([c.N for c in tree_node.children])
+        return max(tree_node.children, key=lambda x: x.Q() + x.U(sum_count))
+
     def mcts_rollout(self, tree_node):
         cur_graph_coalition = tree_node.coalition
         if len(cur_graph_coalition) <= self.min_atoms:
@@ -275,84 +618,73 @@ class MCTS(object):
 
         # Expand if this node has never been visited
         if len(tree_node.children) == 0:
-            node_degree_list = list(self.graph.subgraph(cur_graph_coalition).degree)
-            node_degree_list = sorted(
-                node_degree_list, key=lambda x: x[1], reverse=self.high2low
-            )
-            all_nodes = [x[0] for x in node_degree_list]
-
-            if self.new_node_idx:
-                expand_nodes = [node for node in all_nodes if node != self.new_node_idx]
-            else:
-                expand_nodes = all_nodes
-
-            if len(all_nodes) > self.expand_atoms:
-                expand_nodes = expand_nodes[: self.expand_atoms]
-
-            for each_node in expand_nodes:
-                # for each node, pruning it and get the remaining sub-graph
-                # here we check the resulting sub-graphs and only keep the largest one
-                subgraph_coalition = [node for node in all_nodes if node != each_node]
+            self.expand(tree_node)
+            self.score_children([tree_node])
 
-                subgraphs = [
-                    self.graph.subgraph(c)
-                    for c in nx.connected_components(
-                        self.graph.subgraph(subgraph_coalition)
-                    )
-                ]
-
-                if self.new_node_idx:
-                    for sub in subgraphs:
-                        if self.new_node_idx in list(sub.nodes()):
-                            main_sub = sub
-                else:
-                    main_sub = subgraphs[0]
-                    for sub in subgraphs:
-                        if sub.number_of_nodes() > main_sub.number_of_nodes():
-                            main_sub = sub
-
-                new_graph_coalition = sorted(list(main_sub.nodes()))
-
-                # check the state map and merge the same sub-graph
-                find_same = False
-                for old_graph_node in self.state_map.values():
-                    if Counter(old_graph_node.coalition) == Counter(
-                        new_graph_coalition
-                    ):
-                        new_node = old_graph_node
-                        find_same = True
-
-                if not find_same:
-                    new_node = self.MCTSNodeClass(new_graph_coalition)
-                    self.state_map[str(new_graph_coalition)] = new_node
-
-                find_same_child = False
-                for cur_child in tree_node.children:
-                    if Counter(cur_child.coalition) == Counter(new_graph_coalition):
-                        find_same_child = True
-
-                if not find_same_child:
-                    tree_node.children.append(new_node)
-            scores = compute_scores(self.score_func, tree_node.children)
-            for child, score in zip(tree_node.children, scores):
-                child.P = score
-
-        sum_count = sum([c.N for c in tree_node.children])
-        selected_node = max(tree_node.children, key=lambda x: x.Q() + x.U(sum_count))
+        selected_node = self.select_child(tree_node)
         v = self.mcts_rollout(selected_node)
         selected_node.W += v
         selected_node.N += 1
         return v
 
+    def mcts_parallel_rollouts(self, num_rollouts):
+        """Run num_rollouts rollouts concurrently, level by level.
+
+        A node selected by an in-flight rollout gets a virtual visit and a virtual loss
+        until the rollout is backed up, which diverts the other rollouts from its path.
+        The children of all the nodes expanded at a level are scored together.
+        """
+        paths = [[self.root] for _ in range(num_rollouts)]
+        active = list(range(num_rollouts))
+        while active:
+            # the same node may be reached by several rollouts
+            to_expand = {
+                id(paths[i][-1]): paths[i][-1]
+                for i in active
+                if len(paths[i][-1].coalition) > self.min_atoms
+                and len(paths[i][-1].children) == 0
+            }
+            for tree_node in to_expand.values():
+                self.expand(tree_node)
+            self.score_children(list(to_expand.values()))
+
+            next_active = []
+            for i in active:
+                tree_node = paths[i][-1]
+                if len(tree_node.coalition) <= self.min_atoms:
+                    continue
+                selected_node = self.select_child(tree_node)
+                selected_node.N += 1
+                selected_node.W -= self.virtual_loss
+                paths[i].append(selected_node)
+                next_active.append(i)
+            active = next_active
+
+        for path in paths:
+            v = path[-1].P
+            for tree_node in path[1:]:
+                # the virtual visit is kept as the actual one
+                tree_node.W += v + self.virtual_loss
+
     def mcts(self, verbose=True):
         if verbose:
             print(f"The nodes in graph is {self.graph.number_of_nodes()}")
-        for rollout_idx in range(self.n_rollout):
-            self.mcts_rollout(self.root)
-            if verbose:
-                print(
-                    f"At the {rollout_idx} rollout, {len(self.state_map)} states that have been explored."
+        if self.n_parallel > 1:
+            for rollout_idx in range(0, self.n_rollout, self.n_parallel):
+                self.mcts_parallel_rollouts(
+                    min(self.n_parallel, self.n_rollout - rollout_idx)
                 )
+                if verbose:
+                    print(
+                        f"At the {rollout_idx} rollout, {len(self.state_map)} states that have been explored."
+                    )
+        else:
+            for rollout_idx in range(self.n_rollout):
+                self.mcts_rollout(self.root)
+                if verbose:
+                    print(
+                        f"At the {rollout_idx} rollout, {len(self.state_map)} states that have been explored."
+                    )
 
         explanations = [node for _, node in self.state_map.items()]
         explanations = sorted(explanations, key=lambda x: x.P, reverse=True)
@@ -386,6 +718,19 @@ class SubgraphX(object):
         save_dir(:obj:`str`, :obj:`None`): Root directory to save the explanation results (default: :obj:`None`)
         filename(:obj:`str`): The filename of results
         vis(:obj:`bool`): Whether to show the visualization (default: :obj:`True`)
+        rng(:obj:`np.random.Generator`, :obj:`None`): Random generator of the monte
+          carlo sampling (default: :obj:`None`, the global numpy random state)
+        reward_cache(:obj:`RewardCache`, :obj:`None`): Cache of the coalition rewards,
+          which can be shared by several explainers (default: :obj:`None`, no cache)
+        n_parallel(:obj:`int`): Number of concurrent rollouts with virtual loss, whose
+          new tree nodes are scored in one batch (default: :obj:`1`, sequential search)
+        virtual_loss(:obj:`float`): Virtual loss of the concurrent rollouts
+          (default: :obj:`1.0`)
+        l_shapley_budget(:obj:`int`): Number of sampled subsets above which
+          :obj:`l_shapley` switches from enumeration to stratified sampling
+          (default: :obj:`4096`)
+        max_batch_nodes(:obj:`int`): Max number of nodes of a batch of subgraphs scored
+          in one forward by the shapley rewards (default: :obj:`65536`)
     Example:
         >>> # For graph classification task
         >>> subgraphx = SubgraphX(model=model, num_classes=2)
@@ -412,6 +757,12 @@ class SubgraphX(object):
         save_dir: Optional[str] = None,
         filename: str = "example",
         vis: bool = True,
+        rng=None,
+        reward_cache=None,
+        n_parallel: int = 1,
+        virtual_loss: float = 1.0,
+        l_shapley_budget: int = 2**12,
+        max_batch_nodes: int = 2**16,
     ):
 
         self.model = model
@@ -429,12 +780,20 @@ class SubgraphX(object):
         self.c_puct = c_puct
         self.expand_atoms = expand_atoms
         self.high2low = high2low
+        self.n_parallel = n_parallel
+        self.virtual_loss = virtual_loss
 
         # reward function hyper-parameters
         self.local_radius = local_radius
         self.sample_num = sample_num
         self.reward_method = reward_method
         self.subgraph_building_method = subgraph_building_method
+        self.l_shapley_budget = l_shapley_budget
+        self.max_batch_nodes = max_batch_nodes
+        self.rng = rng
+        self.reward_cache = reward_cache
+        # variances of the sampled l_shapley rewards
+        self.reward_variances = []
 
         # saving and visualization
         self.vis = vis
@@ -464,6 +823,38 @@ class SubgraphX(object):
             local_radius=self.local_radius,
             sample_num=self.sample_num,
             subgraph_building_method=self.subgraph_building_method,
+            rng=self.rng,
+            l_shapley_budget=self.l_shapley_budget,
+            max_batch_nodes=self.max_batch_nodes,
+            variances=self.reward_variances,
+        )
+
+    def get_batch_reward_func(self, value_func, node_idx=None):
+        if self.explain_graph:
+            node_idx = None
+        else:
+            assert node_idx is not None
+        return batch_reward_func(
+            reward_method=self.reward_method,
+            value_func=value_func,
+            node_idx=node_idx,
+            local_radius=self.local_radius,
+            sample_num=self.sample_num,
+            subgraph_building_method=self.subgraph_building_method,
+            rng=self.rng,
+            l_shapley_budget=self.l_shapley_budget,
+            max_batch_nodes=self.max_batch_nodes,
+            variances=self.reward_variances,
+        )
+
+    def get_reward_config(self, label):
+        return (
+            int(label),
+            self.reward_method,
+            self.local_radius,
+            self.sample_num,
+            self.subgraph_building_method,
+            self.l_shapley_budget,
         )
 
     def get_mcts_class(
@@ -473,6 +864,8 @@ class SubgraphX(object):
         edge_attr,
         node_idx: int = None,
         score_func: Callable = None,
+        label: int = None,
+        batch_score_func: Callable = None,
     ):
         if self.explain_graph:
             node_idx = None
@@ -491,6 +884,11 @@ class SubgraphX(object):
             c_puct=self.c_puct,
             expand_atoms=self.expand_atoms,
             high2low=self.high2low,
+            reward_cache=self.reward_cache,
+            reward_config=self.get_reward_config(label),
+            batch_score_func=batch_score_func,
+            n_parallel=self.n_parallel,
+            virtual_loss=self.virtual_loss,
         )
 
     def read_from_MCTSInfo_list(self, MCTSInfo_list):
@@ -546,7 +944,12 @@ class SubgraphX(object):
                 value_func = GnnNetsGC2valueFunc(self.model, target_class=label)
                 payoff_func = self.get_reward_func(value_func)
                 self.mcts_state_map = self.get_mcts_class(
-                    x, edge_index, edge_attr, score_func=payoff_func
+                    x,
+                    edge_index,
+                    edge_attr,
+                    score_func=payoff_func,
+                    label=label,
+                    batch_score_func=self.get_batch_reward_func(value_func),
                 )
                 results = self.mcts_state_map.mcts(verbose=self.verbose)
 
@@ -559,7 +962,7 @@ class SubgraphX(object):
                 results = self.read_from_MCTSInfo_list(saved_MCTSInfo_list)
 
             self.mcts_state_map = self.get_mcts_class(
-                x, edge_index, edge_attr, node_idx=node_idx
+                x, edge_index, edge_attr, node_idx=node_idx, label=label
             )
             self.new_node_idx = self.mcts_state_map.new_node_idx
             # mcts will extract the subgraph and relabel the nodes
@@ -572,7 +975,10 @@ class SubgraphX(object):
                 payoff_func = self.get_reward_func(
                     value_func, node_idx=self.mcts_state_map.new_node_idx
                 )
-                self.mcts_state_map.set_score_func(payoff_func)
+                batch_payoff_func = self.get_batch_reward_func(
+                    value_func, node_idx=self.mcts_state_map.new_node_idx
+                )
+                self.mcts_state_map.set_score_func(payoff_func, batch_payoff_func)
                 results = self.mcts_state_map.mcts(verbose=self.verbose)
 
             self.mapping_inv = self.mcts_state_map.mapping_inv
@@ -111,7 +111,12 @@ def get_dataset(dataset_root, **kwargs):
 
 
 def get_dataloader(
-    dataset, batch_size, random_split_flag=True, data_split_ratio=None, seed=2
+    dataset,
+    batch_size,
+    random_split_flag=True,
+    data_split_ratio=None,
+    seed=2,
+    shared_topology=False,
 ):
     """
     Args:
@@ -120,6 +125,7 @@ def get_dataloader(
         random_split_flag: bool
         data_split_ratio: list, training, validation and testing ratio
         seed: random seed to split the dataset randomly
+        shared_topology: bool, batch the graphs over their shared base topology (power-grid datasets)
     Returns:
         a dictionary of training, validation, and testing dataLoader
     """
@@ -168,6 +174,24 @@ def get_dataloader(
     # test.data, test.slices = test.collate([data for data in test])
 
     dataloader = dict()
+    if shared_topology:
+        # the power-grid datasets depend on mat73
+        from dataset.pow_utils.shared_topology import (
+            SharedTopologyStore,
+            SharedTopologyLoader,
+        )
+
+        store = SharedTopologyStore.from_dataset(dataset)
+        dataloader["train"] = SharedTopologyLoader(
+            store, train_indices, batch_size=batch_size, shuffle=True
+        )
+        dataloader["eval"] = SharedTopologyLoader(
+            store, dev_indices, batch_size=batch_size, shuffle=False
+        )
+        dataloader["test"] = SharedTopologyLoader(
+            store, test_indices, batch_size=batch_size, shuffle=False
+        )
+        return dataloader, train_dataset, eval_dataset, test_dataset
     dataloader["train"] = DataLoader(train, batch_size=batch_size, shuffle=True)
     dataloader["eval"] = DataLoader(eval, batch_size=batch_size, shuffle=False)
     dataloader["test"] = DataLoader(test, batch_size=batch_size, shuffle=False)
@@ -0,0 +1,370 @@
+"""inference.py
+    Inference-only backends for the trained GNNs of gnn/model.py.
+
+    The message passing part of the network (`get_emb`) is exported and run by the
+    selected backend, while the readout and the final `mlps` stay in torch: the
+    number of graphs in a batch is data dependent and would otherwise be frozen
+    in the exported graph.
+"""
+import contextlib
+import copy
+import os
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch_geometric.utils import subgraph
+from gnn.model import GNNBase
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+EMB_INPUT_NAMES = ["x", "edge_index", "edge_attr", "edge_weight"]
+
+
+class EmbeddingExportWrapper(nn.Module):
+    """Expose `get_emb` of a GNN_basic model with explicit tensor inputs."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, edge_index, edge_attr, edge_weight):
+        return self.model.get_emb(
+            x=x, edge_index=edge_index, edge_attr=edge_attr, edge_weight=edge_weight
+        )
+
+
+class InferenceModel(GNNBase):
+    """Drop-in replacement of a trained GNN_basic for inference-only workloads.
+
+    Subclasses implement `_embed`, the readout and `mlps` of the torch model are reused.
+    """
+
+    def __init__(self, model):
+        super().__init__(model.edge_dim)
+        self.input_dim = model.input_dim
+        self.output_dim = model.output_dim
+        self.num_layers = model.num_layers
+        self.hidden_dim = model.hidden_dim
+        self.readout = model.readout
+        self.readout_layer = model.readout_layer
+        self.mlps = model.mlps
+        self.eval()
+
+    def _embed(self, x, edge_index, edge_attr, edge_weight):
+        raise NotImplementedError
+
+    def _logits(self, x, edge_index, edge_attr, edge_weight, batch):
+        emb = self._embed(x, edge_index, edge_attr, edge_weight)
+        return self.mlps(self.readout_layer(emb, batch))
+
+    def _inputs(self, *args, **kwargs):
+        """_argsparse, with edge_attr defaulting to ones as in its kwargs path."""
+        x, edge_index, edge_attr, edge_weight, batch = self._argsparse(*args, **kwargs)
+        if edge_attr is None:
+            edge_attr = torch.ones(
+                (edge_index.shape[1], self.edge_dim),
+                dtype=torch.float32,
+                device=x.device,
+            )
+        return x, edge_index, edge_attr, edge_weight, batch
+
+    def forward(self, *args, **kwargs):
+        x, edge_index, edge_attr, edge_weight, batch = self._inputs(*args, **kwargs)
+        with torch.no_grad():
+            logits = self._logits(
+                x.float(),
+                edge_index.long(),
+                edge_attr.float(),
+                edge_weight.float(),
+                batch,
+            )
+        self.logits = logits.float().to(x.device)
+        self.probs = F.softmax(self.logits, dim=1)
+        return F.log_softmax(self.logits, dim=1)
+
+    def get_emb(self, *args, **kwargs):
+        x, edge_index, edge_attr, edge_weight, _ = self._inputs(*args, **kwargs)
+        with torch.no_grad():
+            emb = self._embed(
+                x.float(), edge_index.long(), edge_attr.float(), edge_weight.float()
+            )
+        return emb.float().to(x.device)
+
+    def get_pred_label(self, pred):
+        return pred.argmax(dim=1)
+
+    def get_prob(self, *args, **kwargs):
+        self.forward(*args, **kwargs)
+        return self.probs
+
+
+class ONNXModel(InferenceModel):
+    """Run the message passing layers of a GNN_basic model with onnxruntime (CPU)."""
+
+    def __init__(self, model, onnx_path, num_threads=None):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required for the onnx backend.")
+        super().__init__(model)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.onnx_path = onnx_path
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        # inputs that are not used by the network are pruned at export time
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def _embed(self, x, edge_index, edge_attr, edge_weight):
+        inputs = dict(zip(EMB_INPUT_NAMES, [x, edge_index, edge_attr, edge_weight]))
+        feed = {
+            name: inputs[name].detach().cpu().numpy() for name in self.input_names
+        }
+        (emb,) = self.session.run(["node_emb"], feed)
+        return torch.from_numpy(emb).to(x.device)
+
+
+class TorchScriptModel(InferenceModel):
+    """Run the message passing layers of a GNN_basic model from a traced TorchScript artifact."""
+
+    def __init__(self, model, script_path, device):
+        super().__init__(model)
+        self.script_path = script_path
+        self.script_module = torch.jit.load(script_path, map_location=device)
+
+    def _embed(self, x, edge_index, edge_attr, edge_weight):
+        return self.script_module(x, edge_index, edge_attr, edge_weight)
+
+
+class CompiledModel(InferenceModel):
+    """Run the message passing layers of a GNN_basic model with torch.compile (dynamic shapes)."""
+
+    def __init__(self, model):
+        if not hasattr(torch, "compile"):
+            raise ImportError("the compile backend requires torch.compile (torch>=2.0)")
+        super().__init__(model)
+        self.compiled_emb = torch.compile(EmbeddingExportWrapper(model), dynamic=True)
+
+    def _embed(self, x, edge_index, edge_attr, edge_weight):
+        return self.compiled_emb(x, edge_index, edge_attr, edge_weight)
+
+
+class LowPrecisionModel(InferenceModel):
+    """Run a GNN_basic model on CPU in bfloat16 or with int8 dynamically quantized Linear layers.
+
+    int8 quantization applies to the nn.Linear layers, i.e. `mlps` and the GIN MLPs;
+    the PyG convolutions of GCN, GAT and TRANSFORMER keep their fp32 weights.
+    """
+
+    def __init__(self, model, precision):
+        if precision not in ["bf16", "int8"]:
+            raise ValueError(f"Unknown inference precision: {precision}")
+        if precision == "bf16" and not hasattr(torch, "autocast"):
+            raise ImportError("bf16 inference requires torch.autocast (torch>=1.10)")
+        quantization = getattr(torch, "ao", torch).quantization
+        if precision == "int8" and not hasattr(quantization, "quantize_dynamic"):
+            raise ImportError("int8 inference requires torch dynamic quantization")
+        gnn = copy.deepcopy(model).cpu().eval()
+        if precision == "int8":
+            gnn = quantization.quantize_dynamic(gnn, {nn.Linear}, dtype=torch.qint8)
+        super().__init__(gnn)
+        self.gnn = gnn
+        self.precision = precision
+
+    def _autocast(self):
+        if self.precision != "bf16":
+            return contextlib.nullcontext()
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+
+    def _embed(self, x, edge_index, edge_attr, edge_weight):
+        with self._autocast():
+            emb = self.gnn.get_emb(
+                x=x.cpu(),
+                edge_index=edge_index.cpu(),
+                edge_attr=edge_attr.cpu(),
+                edge_weight=edge_weight.cpu(),
+            )
+        return emb.float()
+
+    def _logits(self, x, edge_index, edge_attr, edge_weight, batch):
+        emb = self._embed(x, edge_index, edge_attr, edge_weight)
+        with self._autocast():
+            logits = self.mlps(self.readout_layer(emb, batch.cpu()))
+        return logits.float()
+
+
+def get_example_inputs(model, data, device="cpu"):
+    x, edge_index, edge_attr, edge_weight, _ = model._argsparse(data)
+    return (
+        x.float().to(device),
+        edge_index.long().to(device),
+        edge_attr.float().to(device),
+        edge_weight.float().to(device),
+    )
+
+
+def export_onnx(model, data, onnx_path, opset_version=18):
+    """Export the message passing layers of model to onnx_path, with dynamic node and edge counts."""
+    wrapper = EmbeddingExportWrapper(copy.deepcopy(model).cpu().eval())
+    dynamic_axes = {
+        "x": {0: "num_nodes"},
+        "edge_index": {1: "num_edges"},
+        "edge_attr": {0: "num_edges"},
+        "edge_weight": {0: "num_edges"},
+        "node_emb": {0: "num_nodes"},
+    }
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            get_example_inputs(model, data),
+            onnx_path,
+            input_names=EMB_INPUT_NAMES,
+            output_names=["node_emb"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    return onnx_path
+
+
+def export_torchscript(model, data, script_path, device):
+    """Trace the message passing layers of model and save the frozen TorchScript module."""
+    wrapper = EmbeddingExportWrapper(copy.deepcopy(model).to(device).eval())
+    with torch.no_grad():
+        traced = torch.jit.trace(
+            wrapper, get_example_inputs(model, data, device), check_trace=False
+        )
+    traced = torch.jit.freeze(traced.eval())
+    torch.jit.save(traced, script_path)
+    return script_path
+
+
+def is_artifact_fresh(artifact_path, ckpt_path):
+    """An artifact is reused only if it is more recent than the checkpoint it was built from."""
+    if not os.path.isfile(artifact_path):
+        return False
+    if not os.path.isfile(ckpt_path):
+        return True
+    return os.path.getmtime(artifact_path) >= os.path.getmtime(ckpt_path)
+
+
+def check_parity(model, inference_model, data_list):
+    """Compare the class probabilities of inference_model with the ones of the torch model."""
+    model.eval()
+    num_agree, num_preds, max_err, sum_err = 0, 0, 0.0, 0.0
+    with torch.no_grad():
+        for data in data_list:
+            ref_probs = model.get_prob(data)
+            probs = inference_model.get_prob(data).to(ref_probs.device).float()
+            err = (ref_probs - probs).abs()
+            max_err = max(max_err, err.max().item())
+            sum_err += err.max(dim=-1)[0].sum().item()
+            num_agree += (ref_probs.argmax(-1) == probs.argmax(-1)).sum().item()
+            num_preds += ref_probs.shape[0]
+    return {
+        "label_agreement": num_agree / max(num_preds, 1),
+        "max_prob_error": max_err,
+        "mean_prob_error": sum_err / max(num_preds, 1),
+    }
+
+
+def get_parity_samples(dataset, device, graph_classification, num_samples=8):
+    """Graphs of different sizes, to check that node and edge counts are not frozen in the artifact."""
+    if graph_classification:
+        idx = np.linspace(0, len(dataset) - 1, min(num_samples, len(dataset)))
+        return [dataset[int(i)].to(device) for i in np.unique(idx.astype(int))]
+    data = dataset.data.to(device)
+    sub_data = data.clone()
+    subset = torch.arange(data.num_nodes // 2, device=device)
+    sub_data.x = data.x[subset]
+    sub_data.edge_index, sub_data.edge_attr = subgraph(
+        subset,
+        data.edge_index,
+        edge_attr=data.edge_attr,
+        relabel_nodes=True,
+        num_nodes=data.num_nodes,
+    )
+    return [data, sub_data]
+
+
+def get_inference_model(model, dataset, device, args, save_dir, save_name):
+    """Return the model used for inference-only workloads (fidelity, perturbation explainers).
+
+    Falls back to the (eager) torch model if the backend is unavailable or fails the parity check.
+    """
+    backend = args.backend.lower()
+    precision = args.inference_precision.lower()
+    if backend == "torch" and precision == "fp32":
+        return model
+    if backend != "torch" and precision != "fp32":
+        warnings.warn(
+            f"inference_precision={precision} is only supported by the torch backend, ignored."
+        )
+        precision = "fp32"
+    if backend == "compile" and not hasattr(torch, "compile"):
+        warnings.warn(
+            f"torch {torch.__version__} has no torch.compile, using the torch model."
+        )
+        return model
+    model.eval()
+    graph_classification = eval(args.graph_classification)
+    samples = get_parity_samples(dataset, device, graph_classification)
+    ckpt_path = os.path.join(save_dir, f"{save_name}_best.pth")
+    try:
+        if backend == "onnx":
+            onnx_path = os.path.join(save_dir, f"{save_name}_best.onnx")
+            if not is_artifact_fresh(onnx_path, ckpt_path):
+                export_onnx(model, samples[0], onnx_path)
+            inference_model = ONNXModel(model, onnx_path)
+        elif backend == "torchscript":
+            script_path = os.path.join(save_dir, f"{save_name}_best.jit.pt")
+            if not is_artifact_fresh(script_path, ckpt_path):
+                export_torchscript(model, samples[0], script_path, device)
+            inference_model = TorchScriptModel(model, script_path, device)
+        elif backend == "compile":
+            inference_model = CompiledModel(model)
+        elif backend == "torch":
+            inference_model = LowPrecisionModel(model, precision)
+        else:
+            raise ValueError(f"Unknown inference backend: {args.backend}")
+    except Exception as e:
+        # e.g. onnxruntime errors, or features missing from the installed torch
+        warnings.warn(
+            f"{backend} backend unavailable ({type(e).__name__}: {e}), "
+            f"using the torch model."
+        )
+        return model
+    try:
+        scores = check_parity(model, inference_model, samples)
+    except Exception as e:
+        # the backend loaded but cannot run these graphs, e.g. unsupported ops
+        warnings.warn(
+            f"{backend} backend failed on the parity samples "
+            f"({type(e).__name__}: {e}), using the torch model."
+        )
+        return model
+    name = backend if precision == "fp32" else f"{precision} {backend}"
+    print(f"Agreement of the {name} model with the fp32 torch model: {scores}")
+    if precision == "fp32" and scores["max_prob_error"] > args.parity_atol:
+        warnings.warn(
+            f"{name} model does not match the torch model "
+            f"(max prob error {scores['max_prob_error']:.2e}), using the torch model."
+        )
+        return model
+    if scores["label_agreement"] < args.min_label_agreement:
+        warnings.warn(
+            f"{name} model only agrees on {scores['label_agreement']:.2%} of the "
+            f"predicted labels, using the torch model."
+        )
+        return model
+    inference_model.parity = scores
+    return inference_model
@@ -5,6 +5,7 @@ from torch_geometric.nn import GCNConv, GATConv, NNConv, GINEConv, TransformerCo
 from torch_geometric.data.batch import Batch
 from torch_geometric.nn.glob import global_mean_pool, global_add_pool, global_max_pool
 from utils.gen_utils import from_adj_to_edge_index_torch
+from gnn.shared_forward import get_shared_batch, shared_topology_emb
 
 
 def get_gnnNets(input_dim, output_dim, model_params):
@@ -222,8 +223,15 @@ class GNN_basic(GNNBase):
         # GNN layers
         raise NotImplementedError
 
-    def forward(self, *args, **kwargs):
+    def _batch(self, *args, **kwargs):
+        shared_batch = get_shared_batch(args, kwargs)
+        if shared_batch is not None:
+            return shared_batch.batch
         _, _, _, _, batch = self._argsparse(*args, **kwargs)
+        return batch
+
+    def forward(self, *args, **kwargs):
+        batch = self._batch(*args, **kwargs)
         # node embedding for GNN
         emb = self.get_emb(*args, **kwargs)
         x = self.readout_layer(emb, batch)
@@ -234,7 +242,20 @@ class GNN_basic(GNNBase):
     def loss(self, pred, label):
         return F.cross_entropy(pred, label)
 
+    def explain_masks_set(self):
+        """Whether an explainer has set edge masks on the convolutions (hooks of propagate)."""
+        return any(
+            getattr(layer, "__explain__", False)
+            or getattr(layer, "explain", False)
+            or getattr(layer, "__edge_mask__", None) is not None
+            or getattr(layer, "_edge_mask", None) is not None
+            for layer in self.convs
+        )
+
     def get_emb(self, *args, **kwargs):
+        shared_batch = get_shared_batch(args, kwargs)
+        if shared_batch is not None:
+            return shared_topology_emb(self, shared_batch)
         x, edge_index, edge_attr, edge_weight, _ = self._argsparse(*args, **kwargs)
         for layer in self.convs:
             x = layer(x, edge_index, edge_attr * edge_weight[:, None])
@@ -243,6 +264,10 @@ class GNN_basic(GNNBase):
         return x
 
     def get_graph_rep(self, *args, **kwargs):
+        shared_batch = get_shared_batch(args, kwargs)
+        if shared_batch is not None:
+            x = shared_topology_emb(self, shared_batch)
+            return self.readout_layer(x, shared_batch.batch)
         x, edge_index, edge_attr, edge_weight, batch = self._argsparse(*args, **kwargs)
         for layer in self.convs:
             x = layer(x, edge_index, edge_attr * edge_weight[:, None])
@@ -255,7 +280,7 @@ class GNN_basic(GNNBase):
         return pred.argmax(dim=1)
 
     def get_prob(self, *args, **kwargs):
-        _, _, _, _, batch = self._argsparse(*args, **kwargs)
+        batch = self._batch(*args, **kwargs)
         # node embedding for GNN
         emb = self.get_emb(*args, **kwargs)
         x = self.readout_layer(emb, batch)
@@ -297,6 +322,7 @@ class GCN(GNN_basic):
             output_dim,
             model_params,
         )
+        self.adj_cache = None
 
     def get_layers(self):
         self.convs = nn.ModuleList()
@@ -309,6 +335,38 @@ class GCN(GNN_basic):
         self.mlps = nn.Linear(mlp_dim, self.output_dim)
         return
 
+    def set_adj_cache(self, adj_cache):
+        """Use a CachedAdjacency for the forwards on its graph (None to disable)."""
+        self.adj_cache = adj_cache
+
+    def get_emb(self, *args, **kwargs):
+        if get_shared_batch(args, kwargs) is not None:
+            return super().get_emb(*args, **kwargs)
+        x, edge_index, edge_attr, edge_weight, _ = self._argsparse(*args, **kwargs)
+        if (
+            self.adj_cache is None
+            or (
+                torch.is_grad_enabled()
+                and (
+                    edge_weight.requires_grad
+                    or edge_attr.requires_grad
+                    or x.requires_grad
+                )
+            )
+            or edge_attr.size(-1) != 1
+            or self.explain_masks_set()
+            or not self.adj_cache.matches(edge_index)
+        ):
+            return super().get_emb(*args, **kwargs)
+        adj_t = self.adj_cache.get(edge_weight, edge_attr)
+        for layer in self.convs:
+            x = adj_t @ layer.lin(x)
+            if layer.bias is not None:
+                x = x + layer.bias
+            x = F.relu(x)
+            x = F.dropout(x, self.dropout, training=self.training)
+        return x
+
 
 class GIN(GNN_basic):
     def __init__(
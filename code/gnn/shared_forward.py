@@ -0,0 +1,198 @@
+"""shared_forward.py
+Message passing over a batch of graphs that share one base topology.
+
+A SharedTopologyBatch holds the base edge list [2, E] once, with per-graph node
+features [B, N, F], edge features [B, E, D], edge weights [B, E] and a keep mask
+[B, E] of the edges present in each graph. The convolutions of gnn/model.py are
+evaluated on [B, N, H] node states by gathering and index_add over the base edges:
+the outputs are the ones of the block-diagonal batch of the graphs, without its
+[2, B * E] edge_index and the scatter over B * E edges.
+"""
+
+import math
+import torch
+import torch.nn.functional as F
+from torch_geometric.nn import GATConv, GCNConv, GINEConv, TransformerConv
+from torch_geometric.utils import softmax
+
+
+class SharedTopologyBatch(object):
+    """Batch of graphs over a shared base topology, as consumed by GNN_basic models."""
+
+    def __init__(self, edge_index, x, edge_attr, edge_keep, edge_weight=None, y=None):
+        self.edge_index = edge_index  # [2, E]
+        self.x = x  # [B, N, F]
+        self.edge_attr = edge_attr  # [B, E, D]
+        self.edge_keep = edge_keep  # [B, E], True if the edge is in the graph
+        self.edge_weight = edge_weight  # [B, E], None for ones
+        self.y = y  # [B]
+        self.num_graphs, self.num_nodes = x.shape[:2]
+
+    @property
+    def batch(self):
+        """Graph index of the nodes, in the order of the block-diagonal batch."""
+        return torch.arange(self.num_graphs, device=self.x.device).repeat_interleave(
+            self.num_nodes
+        )
+
+    def to(self, device):
+        for key in ["edge_index", "x", "edge_attr", "edge_keep", "edge_weight", "y"]:
+            value = getattr(self, key)
+            if value is not None:
+                setattr(self, key, value.to(device))
+        return self
+
+
+def get_shared_batch(args, kwargs):
+    """The SharedTopologyBatch passed to a forward of a model, None if there is none."""
+    data = args[0] if len(args) == 1 else kwargs.get("data")
+    return data if isinstance(data, SharedTopologyBatch) else None
+
+
+def scatter_sum(src, index, num_nodes):
+    """Sum the messages src [B, E, ...] of the edges into their target nodes [B, N, ...]."""
+    out = src.new_zeros((src.shape[0], num_nodes) + src.shape[2:])
+    return out.index_add_(1, index, src)
+
+
+def masked_softmax(alpha, index, keep, num_nodes):
+    """Softmax of the attention scores alpha [B, E, H] over the kept incoming edges."""
+    alpha = alpha.masked_fill(~keep[..., None], torch.finfo(alpha.dtype).min)
+    return softmax(alpha, index, num_nodes=num_nodes, dim=1) * keep[..., None]
+
+
+def gcn_conv(conv, x, edge_index, edge_attr, keep):
+    B, N = x.shape[:2]
+    src, dst = edge_index
+    # scalar edge weights, as in GNN_basic.get_emb (edge_dim == 1)
+    weight = edge_attr.reshape(B, -1) * keep
+    h = conv.lin(x)
+    if conv.add_self_loops:
+        loop = src == dst
+        fill = 2.0 if conv.improved else 1.0
+        loop_weight = x.new_full((B, N), fill)
+        # remaining self-loops keep their weight (the last one of a node), as in
+        # add_remaining_self_loops; base topologies have few or no self-loops
+        for e in loop.nonzero().view(-1).tolist():
+            node = src[e]
+            loop_weight[:, node] = torch.where(
+                keep[:, e], weight[:, e], loop_weight[:, node]
+            )
+        src, dst, weight = src[~loop], dst[~loop], weight[:, ~loop]
+    else:
+        loop_weight = x.new_zeros((B, N))
+    if conv.normalize:
+        deg = loop_weight.index_add(1, dst, weight)
+        deg_inv_sqrt = deg.pow(-0.5)
+        deg_inv_sqrt = deg_inv_sqrt.masked_fill(deg_inv_sqrt == float("inf"), 0)
+        weight = deg_inv_sqrt[:, src] * weight * deg_inv_sqrt[:, dst]
+        loop_weight = deg_inv_sqrt * loop_weight * deg_inv_sqrt
+    out = scatter_sum(h[:, src] * weight[..., None], dst, N)
+    out = out + h * loop_weight[..., None]
+    if conv.bias is not None:
+        out = out + conv.bias
+    return out
+
+
+def gine_conv(conv, x, edge_index, edge_attr, keep):
+    src, dst = edge_index
+    if conv.lin is not None:
+        edge_attr = conv.lin(edge_attr)
+    msg = F.relu(x[:, src] + edge_attr) * keep[..., None]
+    out = scatter_sum(msg, dst, x.shape[1])
+    return conv.nn(out + (1 + conv.eps) * x)
+
+
+def gat_conv(conv, x, edge_index, edge_attr, keep):
+    B, N = x.shape[:2]
+    H, C = conv.heads, conv.out_channels
+    # PyG >= 2.3 shares one `lin` between sources and targets, older versions `lin_src`
+    lin = conv.lin if getattr(conv, "lin", None) is not None else conv.lin_src
+    h = lin(x).view(B, N, H, C)
+    alpha_src = (h * conv.att_src).sum(-1)
+    alpha_dst = (h * conv.att_dst).sum(-1)
+    src, dst = edge_index
+    if conv.add_self_loops:
+        # remove_self_loops then add_self_loops(fill_value="mean") on the kept edges
+        loop = src == dst
+        src, dst = src[~loop], dst[~loop]
+        keep, edge_attr = keep[:, ~loop], edge_attr[:, ~loop]
+        weight = keep.to(edge_attr.dtype)[..., None]
+        loop_attr = scatter_sum(edge_attr * weight, dst, N)
+        loop_attr = loop_attr / scatter_sum(weight, dst, N).clamp(min=1)
+        loop_index = torch.arange(N, device=x.device)
+        src, dst = torch.cat([src, loop_index]), torch.cat([dst, loop_index])
+        keep = torch.cat([keep, keep.new_ones((B, N))], dim=1)
+        edge_attr = torch.cat([edge_attr, loop_attr], dim=1)
+    alpha = alpha_src[:, src] + alpha_dst[:, dst]
+    if conv.lin_edge is not None:
+        edge_emb = conv.lin_edge(edge_attr).view(B, -1, H, C)
+        alpha = alpha + (edge_emb * conv.att_edge).sum(-1)
+    alpha = F.leaky_relu(alpha, conv.negative_slope)
+    alpha = masked_softmax(alpha, dst, keep, N)
+    alpha = F.dropout(alpha, p=conv.dropout, training=conv.training)
+    out = scatter_sum(h[:, src] * alpha[..., None], dst, N)
+    out = out.reshape(B, N, H * C) if conv.concat else out.mean(dim=2)
+    if getattr(conv, "res", None) is not None:
+        out = out + conv.res(x)
+    if conv.bias is not None:
+        out = out + conv.bias
+    return out
+
+
+def transformer_conv(conv, x, edge_index, edge_attr, keep):
+    B, N = x.shape[:2]
+    H, C = conv.heads, conv.out_channels
+    src, dst = edge_index
+    query = conv.lin_query(x).view(B, N, H, C)[:, dst]
+    key = conv.lin_key(x).view(B, N, H, C)[:, src]
+    value = conv.lin_value(x).view(B, N, H, C)[:, src]
+    if conv.lin_edge is not None:
+        edge_emb = conv.lin_edge(edge_attr).view(B, -1, H, C)
+        key, value = key + edge_emb, value + edge_emb
+    alpha = (query * key).sum(-1) / math.sqrt(C)
+    alpha = masked_softmax(alpha, dst, keep, N)
+    alpha = F.dropout(alpha, p=conv.dropout, training=conv.training)
+    out = scatter_sum(value * alpha[..., None], dst, N)
+    out = out.reshape(B, N, H * C) if conv.concat else out.mean(dim=2)
+    if conv.root_weight:
+        x_r = conv.lin_skip(x)
+        if conv.lin_beta is not None:
+            beta = conv.lin_beta(torch.cat([out, x_r, out - x_r], dim=-1)).sigmoid()
+            out = beta * x_r + (1 - beta) * out
+        else:
+            out = out + x_r
+    return out
+
+
+SHARED_CONVS = {
+    GCNConv: gcn_conv,
+    GINEConv: gine_conv,
+    GATConv: gat_conv,
+    TransformerConv: transformer_conv,
+}
+
+
+def supports_shared_topology(model):
+    """Whether model can run on SharedTopologyBatch inputs."""
+    convs = getattr(model, "convs", None)
+    if convs is None or not hasattr(model, "explain_masks_set"):
+        return False
+    # the explainer hooks of propagate are not applied on the shared topology
+    return all(type(layer) in SHARED_CONVS for layer in convs) and (
+        not model.explain_masks_set()
+    )
+
+
+def shared_topology_emb(model, data):
+    """Node embeddings [B * N, H] of a GNN_basic model, in the order of the block-diagonal batch."""
+    x, edge_attr = data.x.float(), data.edge_attr.float()
+    if data.edge_weight is not None:
+        edge_attr = edge_attr * data.edge_weight[..., None]
+    for layer in model.convs:
+        x = SHARED_CONVS[type(layer)](
+            layer, x, data.edge_index, edge_attr, data.edge_keep
+        )
+        x = F.relu(x)
+        x = F.dropout(x, model.dropout, training=model.training)
+    return x.reshape(-1, x.shape[-1])
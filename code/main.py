@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 import random
 from gnn.model import get_gnnNets
+from gnn.inference import get_inference_model
 from train_gnn import TrainModel
 from gendata import get_dataset
 from utils.parser_utils import (
@@ -91,6 +92,7 @@ def main(args, args_group):
             "random_split_flag": eval(args.random_split_flag),
             "data_split_ratio": args.data_split_ratio,
             "seed": args.seed,
+            "shared_topology": eval(args.shared_topology),
         }
     model = get_gnnNets(args.num_node_features, args.num_classes, model_params)
     model_save_name = f"{args.model_name}_{args.num_layers}l_{str(device)}"
@@ -124,9 +126,26 @@ def main(args, args_group):
         )
     _, _, _, _, _ = trainer.test()
 
-    explain_main(dataset, trainer.model, device, args, unseen=False)
+    inference_model = get_inference_model(
+        trainer.model, dataset, device, args, trainer.save_dir, trainer.save_name
+    )
+    explain_main(
+        dataset,
+        trainer.model,
+        device,
+        args,
+        unseen=False,
+        inference_model=inference_model,
+    )
     if eval(args.unseen) and eval(args.graph_classification):
-        explain_main(unseen_dataset, trainer.model, device, args, unseen=True)
+        explain_main(
+            unseen_dataset,
+            trainer.model,
+            device,
+            args,
+            unseen=True,
+            inference_model=inference_model,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+import torch
+from torch_geometric.data import Data
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from gnn.model import get_gnnNets  # noqa: E402
+
+
+def random_graph(num_nodes=8, num_node_features=4, edge_dim=1, num_edges=20, y=0):
+    """Small random directed graph without self-loops."""
+    row = torch.randint(num_nodes, (num_edges,))
+    col = (row + torch.randint(1, num_nodes, (num_edges,))) % num_nodes
+    edge_index = torch.stack([row, col])
+    return Data(
+        x=torch.randn(num_nodes, num_node_features),
+        edge_index=edge_index,
+        edge_attr=torch.rand(num_edges, edge_dim),
+        y=torch.tensor([y]),
+    )
+
+
+def build_model(model_name="gcn", input_dim=4, output_dim=3, edge_dim=1, **params):
+    model_params = {
+        "model_name": model_name,
+        "edge_dim": edge_dim,
+        "num_layers": 2,
+        "hidden_dim": 8,
+        "dropout": 0.0,
+        "readout": "mean",
+        **params,
+    }
+    model = get_gnnNets(input_dim, output_dim, model_params)
+    model.eval()
+    return model
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
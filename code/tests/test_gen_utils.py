@@ -0,0 +1,27 @@
+import torch
+
+from conftest import random_graph
+from utils.gen_utils import prepare_data
+
+
+def test_prepare_data_shares_matching_tensors():
+    data = random_graph()
+    prepared = prepare_data(data, "cpu")
+    assert prepared is not data
+    assert prepared.x.data_ptr() == data.x.data_ptr()
+    assert prepared.edge_index.data_ptr() == data.edge_index.data_ptr()
+    assert prepared.edge_attr.data_ptr() == data.edge_attr.data_ptr()
+    # setting an attribute of the copy leaves the original data untouched
+    prepared.x = torch.zeros_like(prepared.x)
+    assert not torch.equal(data.x, prepared.x)
+
+
+def test_prepare_data_aligns_dtypes_and_detaches():
+    data = random_graph()
+    data.x = data.x.double().requires_grad_(True)
+    data.edge_index = data.edge_index.int()
+    prepared = prepare_data(data, "cpu")
+    assert prepared.x.dtype == torch.float and not prepared.x.requires_grad
+    assert prepared.edge_index.dtype == torch.long
+    assert torch.allclose(prepared.x, data.x.detach().float())
+    assert torch.equal(prepared.edge_index, data.edge_index.long())
@@ -0,0 +1,90 @@
+import torch
+
+from conftest import build_model, random_graph
+from explainer.gnnexplainer import EarlyStopping, TargetedGNNExplainer
+
+
+def explainer(model, **kwargs):
+    params = dict(epochs=30, lr=0.01, return_type="log_prob", allow_node_mask=False)
+    return TargetedGNNExplainer(model, log=False, **{**params, **kwargs})
+
+
+def explain_one_by_one(model, graphs, targets, init_edge_masks, **kwargs):
+    masks = []
+    for data, target, init_edge_mask in zip(graphs, targets, init_edge_masks):
+        masks.append(
+            explainer(model, **kwargs).explain_graph_with_target(
+                data.x,
+                data.edge_index,
+                data.edge_attr,
+                target,
+                init_edge_mask=init_edge_mask,
+            )
+        )
+    return masks
+
+
+def test_batched_gnnexplainer_matches_single_graphs():
+    model = build_model("gin")
+    graphs = [random_graph(num_nodes=n, num_edges=3 * n) for n in [6, 9, 7]]
+    init_edge_masks = [torch.rand(d.num_edges) for d in graphs]
+    # the explained classes are not the predicted ones
+    with torch.no_grad():
+        preds = [int(model(d.x, d.edge_index, d.edge_attr).argmax()) for d in graphs]
+    targets = torch.tensor([(p + 1) % 3 for p in preds])
+    batched = explainer(model).explain_graphs_with_target(
+        graphs, targets, init_edge_masks=init_edge_masks
+    )
+    single = explain_one_by_one(model, graphs, targets, init_edge_masks)
+    for (_, edge_mask), (_, expected) in zip(batched, single):
+        assert torch.allclose(edge_mask, expected, atol=1e-5)
+
+    # without targets, the predicted classes are explained
+    batched = explainer(model).explain_graphs_with_target(
+        graphs, None, init_edge_masks=init_edge_masks
+    )
+    single = explain_one_by_one(model, graphs, preds, init_edge_masks)
+    for (_, edge_mask), (_, expected) in zip(batched, single):
+        assert torch.allclose(edge_mask, expected, atol=1e-5)
+
+
+def test_batched_early_stopping_is_per_graph():
+    model = build_model("gin")
+    graphs = [random_graph(num_nodes=n, num_edges=3 * n) for n in [6, 9, 7, 5]]
+    init_edge_masks = [torch.rand(d.num_edges) for d in graphs]
+    targets = torch.tensor([0, 1, 2, 0])
+    params = dict(epochs=400, patience=5, min_epochs=20, loss_tol=1e-3, mask_tol=5e-3)
+    batched_explainer = explainer(model, **params)
+    batched = batched_explainer.explain_graphs_with_target(
+        graphs, targets, init_edge_masks=init_edge_masks
+    )
+    stop_epochs = []
+    for data, target, init_edge_mask, (_, edge_mask) in zip(
+        graphs, targets, init_edge_masks, batched
+    ):
+        single_explainer = explainer(model, **params)
+        _, expected = single_explainer.explain_graph_with_target(
+            data.x, data.edge_index, data.edge_attr, target, init_edge_mask
+        )
+        stop_epochs.append(single_explainer.stop_epoch)
+        # the masks of a graph are frozen at its own stop epoch
+        assert torch.allclose(edge_mask, expected, atol=1e-5)
+    assert batched_explainer.stop_epoch == stop_epochs
+    assert len(set(stop_epochs)) > 1
+
+
+def test_early_stopping_counts_stale_epochs_per_explanation():
+    early_stopping = EarlyStopping(patience=2, min_epochs=0, mask_tol=0.1)
+    masks = [torch.zeros(4)]
+    rows = [torch.tensor([0, 0, 1, 1])]
+    assert not early_stopping.step(1, [1.0, 1.0], masks, rows)
+    # explanation 0 improves, explanation 1 is stale
+    assert not early_stopping.step(2, [0.5, 1.0], masks, rows)
+    assert early_stopping.stopped.tolist() == [False, False]
+    assert not early_stopping.step(3, [0.5, 1.0], masks, rows)
+    assert early_stopping.stopped.tolist() == [False, True]
+    # a mask entry of explanation 0 moves
+    assert not early_stopping.step(4, [0.5, 1.0], [torch.tensor([5.0, 0, 0, 0])], rows)
+    assert not early_stopping.step(5, [0.5, 1.0], [torch.tensor([5.0, 0, 0, 0])], rows)
+    assert early_stopping.step(6, [0.5, 1.0], [torch.tensor([5.0, 0, 0, 0])], rows)
+    assert early_stopping.stop_epochs.tolist() == [6, 3]
@@ -0,0 +1,60 @@
+import torch
+from captum.attr import LayerGradCam
+from torch_geometric.data import Batch
+
+from conftest import build_model, random_graph
+from explainer.gradcam import GraphLayerGradCam, multi_layer_grad_cam
+
+
+def test_multi_layer_grad_cam_matches_graph_layer_grad_cam():
+    model = build_model("gcn")
+    data = random_graph()
+    args = (data.edge_index, data.edge_attr)
+    layer_attrs = multi_layer_grad_cam(
+        model, model.convs, data.x, 2, args, average_over_nodes=True
+    )
+    for layer, attr in zip(model.convs, layer_attrs):
+        expected = GraphLayerGradCam(model, layer).attribute(
+            data.x, 2, additional_forward_args=args
+        )
+        assert torch.allclose(attr, expected, atol=1e-6)
+
+
+def test_multi_layer_grad_cam_matches_layer_grad_cam():
+    model = build_model("gat", readout="identity")
+    data = random_graph()
+    args = (data.edge_index, data.edge_attr)
+    layer_attrs = multi_layer_grad_cam(model, model.convs, data.x, 1, args)
+    for layer, attr in zip(model.convs, layer_attrs):
+        expected = LayerGradCam(model, layer).attribute(
+            data.x, 1, additional_forward_args=args
+        )
+        assert torch.allclose(attr, expected, atol=1e-6)
+
+
+def test_multi_layer_grad_cam_per_graph_of_a_batch():
+    model = build_model("gcn")
+    data_list = [random_graph(num_nodes=n) for n in [6, 8, 10]]
+    targets = torch.tensor([0, 2, 1])
+    batch = Batch.from_data_list(data_list)
+    layer_attrs = multi_layer_grad_cam(
+        model,
+        model.convs,
+        batch.x,
+        targets,
+        (batch.edge_index, batch.edge_attr, batch.batch),
+        average_over_nodes=True,
+        batch=batch.batch,
+    )
+    for i, (data, target) in enumerate(zip(data_list, targets.tolist())):
+        expected = multi_layer_grad_cam(
+            model,
+            model.convs,
+            data.x,
+            target,
+            (data.edge_index, data.edge_attr),
+            average_over_nodes=True,
+        )
+        nodes = batch.batch == i
+        for attr, graph_attr in zip(layer_attrs, expected):
+            assert torch.allclose(attr[nodes], graph_attr, atol=1e-6)
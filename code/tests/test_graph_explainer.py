@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+import torch
+
+from conftest import build_model, random_graph
+
+graph_explainer = pytest.importorskip("explainer.graph_explainer")
+
+
+@pytest.mark.parametrize("method", ["sa", "ig", "gradcam"])
+def test_batched_gradient_explainers_match_single(method):
+    model = build_model("gcn")
+    data_list = [random_graph(num_nodes=n) for n in [6, 8, 10]]
+    targets = torch.tensor([0, 2, 1])
+    explain = getattr(graph_explainer, "explain_%s_graph" % method)
+    explain_batch = getattr(graph_explainer, "explain_%s_graph_batch" % method)
+    masks = explain_batch(model, data_list, targets, "cpu")
+    for data, target, (edge_mask, node_feat_mask) in zip(data_list, targets, masks):
+        expected_edge_mask, expected_node_feat_mask = explain(
+            model, data, int(target), "cpu"
+        )
+        assert np.allclose(edge_mask, expected_edge_mask, atol=1e-5)
+        if expected_node_feat_mask is not None:
+            assert np.allclose(node_feat_mask, expected_node_feat_mask, atol=1e-5)
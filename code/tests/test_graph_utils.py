@@ -0,0 +1,36 @@
+import numpy as np
+import torch
+
+from conftest import build_model, random_graph
+from utils.graph_utils import edge_index_to_csr, leave_one_out_batch
+
+
+def test_leave_one_out_batch_matches_single_forwards():
+    model = build_model("gin")
+    data = random_graph(num_nodes=8, num_edges=20)
+    removed_edges = torch.tensor([0, 5, 19])
+    x, edge_index, edge_attr, batch = leave_one_out_batch(
+        data.x, data.edge_index, data.edge_attr, removed_edges
+    )
+    assert edge_index.shape[1] == 3 * (data.num_edges - 1)
+    with torch.no_grad():
+        out = model(x, edge_index, edge_attr, batch)
+        for i, edge in enumerate(removed_edges.tolist()):
+            keep = torch.arange(data.num_edges) != edge
+            expected = model(data.x, data.edge_index[:, keep], data.edge_attr[keep])
+            assert torch.allclose(out[i], expected[0], atol=1e-6)
+
+
+def test_edge_index_to_csr_cache_is_per_graph():
+    cache = {}
+    first, second = random_graph(num_nodes=8), random_graph(num_nodes=8)
+    adj = edge_index_to_csr(first.edge_index, 8, cache=cache)
+    assert edge_index_to_csr(first.edge_index, 8, cache=cache) is adj
+    # another graph with the same number of nodes gets its own adjacency
+    other = edge_index_to_csr(second.edge_index, 8, cache=cache)
+    expected = np.zeros((8, 8))
+    expected[tuple(second.edge_index.numpy())] = 1
+    assert np.array_equal(other.toarray(), expected)
+    # as does the same tensor after an in-place update
+    first.edge_index[:, 0] = first.edge_index[:, 1]
+    assert edge_index_to_csr(first.edge_index, 8, cache=cache) is not adj
@@ -0,0 +1,124 @@
+import argparse
+import warnings
+
+import pytest
+import torch
+from torch_geometric.data import Batch, Data
+
+import gnn.inference as inference
+from conftest import build_model, random_graph
+
+
+def inference_args(backend="torch", precision="fp32"):
+    return argparse.Namespace(
+        backend=backend,
+        inference_precision=precision,
+        graph_classification="True",
+        parity_atol=1e-4,
+        min_label_agreement=0.9,
+    )
+
+
+def test_onnx_backend_matches_torch_model(tmp_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    if int(torch.__version__.split(".")[0]) >= 2:
+        # the default exporter of torch 2 is built on onnxscript
+        pytest.importorskip("onnxscript")
+    model = build_model("gcn")
+    dataset = [random_graph(num_nodes=n) for n in [5, 8, 13]]
+    inference_model = inference.get_inference_model(
+        model, dataset, "cpu", inference_args("onnx"), str(tmp_path), "gcn"
+    )
+    assert isinstance(inference_model, inference.ONNXModel)
+    assert inference_model.parity["max_prob_error"] < 1e-4
+
+
+def test_torchscript_backend_matches_torch_model(tmp_path):
+    model = build_model("gin")
+    dataset = [random_graph(num_nodes=n, num_edges=3 * n) for n in [5, 8, 13]]
+    inference_model = inference.get_inference_model(
+        model, dataset, "cpu", inference_args("torchscript"), str(tmp_path), "gin"
+    )
+    assert isinstance(inference_model, inference.TorchScriptModel)
+    assert inference_model.parity["label_agreement"] == 1.0
+
+
+def test_backend_accepts_batches_without_edge_attr(tmp_path):
+    model = build_model("gin")
+    dataset = [random_graph(num_nodes=n, num_edges=3 * n) for n in [5, 8, 13]]
+    inference_model = inference.get_inference_model(
+        model, dataset, "cpu", inference_args("torchscript"), str(tmp_path), "gin"
+    )
+    data = dataset[1]
+    batch = Batch.from_data_list([Data(x=data.x, edge_index=data.edge_index)] * 2)
+    with torch.no_grad():
+        expected = model(x=batch.x, edge_index=batch.edge_index, batch=batch.batch)
+        expected_emb = model.get_emb(x=batch.x, edge_index=batch.edge_index)
+    assert torch.allclose(inference_model(batch), expected, atol=1e-5)
+    assert torch.allclose(inference_model.get_emb(batch), expected_emb, atol=1e-5)
+
+
+def test_backend_failure_falls_back_to_torch_model(tmp_path, monkeypatch):
+    class BackendError(Exception):
+        """Stands for the pybind errors of onnxruntime, which are not RuntimeErrors."""
+
+    def failing_backend(*args, **kwargs):
+        raise BackendError("cannot load the model")
+
+    monkeypatch.setattr(inference, "export_onnx", failing_backend)
+    model = build_model("gcn")
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        inference_model = inference.get_inference_model(
+            model, [random_graph()], "cpu", inference_args("onnx"), str(tmp_path), "m"
+        )
+    assert inference_model is model
+    assert any("BackendError" in str(w.message) for w in caught)
+
+
+@pytest.mark.parametrize("precision", ["bf16", "int8"])
+def test_low_precision_model_agrees_with_torch_model(precision):
+    model = build_model("gin")
+    low_precision = inference.LowPrecisionModel(model, precision)
+    data = Batch.from_data_list([random_graph(num_nodes=12, num_edges=40)])
+    with torch.no_grad():
+        probs = low_precision.get_prob(data)
+        ref_probs = model.get_prob(data)
+    assert probs.dtype == torch.float32
+    assert (probs - ref_probs).abs().max() < 0.1
+
+
+def test_missing_low_precision_support_falls_back(tmp_path, monkeypatch):
+    monkeypatch.delattr(torch, "autocast")
+    model = build_model("gcn")
+    with pytest.warns(UserWarning, match="ImportError"):
+        inference_model = inference.get_inference_model(
+            model, [random_graph()], "cpu", inference_args("torch", "bf16"), "", "m"
+        )
+    assert inference_model is model
+
+
+def test_parity_failure_after_build_falls_back(tmp_path, monkeypatch):
+    def failing_embed(*args, **kwargs):
+        raise RuntimeError("unsupported op")
+
+    monkeypatch.setattr(inference.LowPrecisionModel, "_embed", failing_embed)
+    model = build_model("gcn")
+    with pytest.warns(UserWarning, match="parity samples"):
+        inference_model = inference.get_inference_model(
+            model, [random_graph()], "cpu", inference_args("torch", "int8"), "", "m"
+        )
+    assert inference_model is model
+
+
+def test_compile_backend_without_torch_compile(monkeypatch):
+    monkeypatch.delattr(torch, "compile", raising=False)
+    model = build_model("gcn")
+    with pytest.warns(UserWarning, match="torch.compile"):
+        inference_model = inference.get_inference_model(
+            model, [random_graph()], "cpu", inference_args("compile"), "", "m"
+        )
+    assert inference_model is model
+    with pytest.raises(ImportError):
+        inference.CompiledModel(model)
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from conftest import build_model, random_graph
+from utils.graph_utils import CachedAdjacency
+
+
+def cached_gcn(data):
+    model = build_model("gcn")
+    model.set_adj_cache(CachedAdjacency(data.edge_index, data.num_nodes))
+    return model
+
+
+def test_cached_gcn_matches_eager_gcn():
+    data = random_graph(num_nodes=10, num_edges=30)
+    # a self-loop with its own weight, handled as in add_remaining_self_loops
+    data.edge_index[:, 0] = 3
+    model = cached_gcn(data)
+    with torch.no_grad():
+        for edge_weight in [None, torch.rand(30), torch.rand(30)]:
+            kwargs = dict(
+                x=data.x, edge_index=data.edge_index, edge_attr=data.edge_attr
+            )
+            if edge_weight is not None:
+                kwargs["edge_weight"] = edge_weight
+            cached = model.get_emb(**kwargs)
+            model.set_adj_cache(None)
+            eager = model.get_emb(**kwargs)
+            model.set_adj_cache(CachedAdjacency(data.edge_index, data.num_nodes))
+            assert torch.allclose(cached, eager, atol=1e-5)
+
+
+def test_cached_adjacency_reuses_unchanged_inputs():
+    data = random_graph(num_nodes=10, num_edges=30)
+    cache = CachedAdjacency(data.edge_index, data.num_nodes)
+    edge_weight = torch.rand(30)
+    adj_t = cache.get(edge_weight, data.edge_attr)
+    assert cache.get(edge_weight, data.edge_attr) is adj_t
+    edge_weight[0] = 0.0
+    assert cache.get(edge_weight, data.edge_attr) is not adj_t
+    assert cache.matches(data.edge_index.clone())
+    assert not cache.matches(data.edge_index[:, 1:])
+
+
+def test_cache_disabled_with_explain_masks():
+    data = random_graph(num_nodes=10, num_edges=30)
+    model = cached_gcn(data)
+    model.adj_cache.get = None  # any use of the cache fails
+    for layer in model.convs:
+        layer.__explain__ = True
+    with torch.no_grad():
+        model.get_emb(data.x, data.edge_index, data.edge_attr)
+    for layer in model.convs:
+        layer.__explain__ = False
+    with pytest.raises(TypeError):
+        with torch.no_grad():
+            model.get_emb(data.x, data.edge_index, data.edge_attr)
+    assert not model.explain_masks_set()
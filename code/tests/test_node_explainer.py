@@ -0,0 +1,121 @@
+import networkx as nx
+import numpy as np
+import pytest
+import torch
+from torch_geometric.utils import to_networkx
+
+from conftest import build_model, random_graph
+from explainer import node_explainer
+
+
+def single_gradient(model, data, node_idx, target):
+    x = data.x.clone().requires_grad_(True)
+    out = model(x, data.edge_index, edge_attr=data.edge_attr)
+    (grad,) = torch.autograd.grad(out[node_idx, target], x)
+    return grad
+
+
+def test_node_output_gradients_match_single_backwards():
+    model = build_model("gcn", readout="identity")
+    data = random_graph(num_nodes=10, num_edges=30)
+    nodes, targets = [0, 3, 7], [1, 0, 2]
+    grads = node_explainer.node_output_gradients(model, data, nodes, targets, "cpu")
+    for grad, node_idx, target in zip(grads, nodes, targets):
+        expected = single_gradient(model, data, node_idx, target)
+        assert torch.allclose(grad, expected, atol=1e-6)
+
+
+def test_node_output_gradients_without_is_grads_batched(monkeypatch):
+    grad = torch.autograd.grad
+
+    def grad_torch_1_9(*args, is_grads_batched=None, **kwargs):
+        if is_grads_batched is not None:
+            raise TypeError("grad() got an unexpected keyword 'is_grads_batched'")
+        return grad(*args, **kwargs)
+
+    monkeypatch.setattr(torch.autograd, "grad", grad_torch_1_9)
+    model = build_model("gcn", readout="identity")
+    data = random_graph(num_nodes=10, num_edges=30)
+    grads = node_explainer.node_output_gradients(model, data, [2, 5], [0, 1], "cpu")
+    expected = single_gradient(model, data, 5, 1)
+    assert len(grads) == 2
+    assert np.allclose(grads[1].numpy(), expected.numpy(), atol=1e-6)
+
+
+def test_occlusion_node_matches_full_graph_occlusion():
+    model = build_model("gcn", readout="identity")
+    data = random_graph(num_nodes=12, num_edges=24)
+    node_idx, target = 3, 1
+    edge_mask, _ = node_explainer.explain_occlusion_node(
+        model, data, node_idx, target, "cpu", num_layers=2, perturbation_batch_size=4
+    )
+    # occlusion of the edges between nodes at most 2 hops from node_idx, on the full graph
+    graph = to_networkx(data)
+    hops = nx.shortest_path_length(graph, target=node_idx)
+    expected = np.zeros(data.num_edges)
+    with torch.no_grad():
+        for i, (u, v) in enumerate(data.edge_index.t().tolist()):
+            if hops.get(u, 3) <= 2 and hops.get(v, 3) <= 2:
+                keep = torch.arange(data.num_edges) != i
+                out = model(data.x, data.edge_index[:, keep], data.edge_attr[keep])
+                expected[i] = 1 - out[node_idx, target].item()
+    assert np.count_nonzero(expected) > 0
+    assert np.allclose(edge_mask, expected, atol=1e-5)
+
+
+def test_distance_masks_match_networkx_shortest_paths():
+    data = random_graph(num_nodes=15, num_edges=25)
+    graph = to_networkx(data)
+    nodes = [0, 4, 9]
+    for max_depth in [None, 2]:
+        masks = node_explainer.explain_distance_node_batch(
+            None, data, nodes, [0, 0, 0], "cpu", distance_max_depth=max_depth
+        )
+        for node_idx, (edge_mask, _) in zip(nodes, masks):
+            length = nx.shortest_path_length(graph, target=node_idx)
+            if max_depth is not None:
+                length = {k: v for k, v in length.items() if v <= max_depth}
+            expected = [
+                1 / (length[v] + 1) if v in length else 0.0
+                for v in data.edge_index[1].tolist()
+            ]
+            assert np.allclose(edge_mask, expected)
+
+
+def test_distance_masks_of_two_graphs_sharing_a_cache():
+    explainer_cache = {}
+    for seed in range(2):
+        torch.manual_seed(seed)
+        data = random_graph(num_nodes=15, num_edges=25)
+        ((edge_mask, _),) = node_explainer.explain_distance_node_batch(
+            None, data, [0], [0], "cpu", explainer_cache=explainer_cache
+        )
+        length = nx.shortest_path_length(to_networkx(data), target=0)
+        expected = [
+            1 / (length[v] + 1) if v in length else 0.0
+            for v in data.edge_index[1].tolist()
+        ]
+        assert np.allclose(edge_mask, expected)
+
+
+@pytest.mark.parametrize("push_eps", [None, 1e-7])
+def test_pagerank_masks_of_two_graphs_sharing_a_cache(push_eps):
+    explainer_cache = {}
+    graphs = [random_graph(num_nodes=15, num_edges=30) for _ in range(2)]
+    for data in graphs + graphs:
+        masks = node_explainer.explain_pagerank_node_batch(
+            None,
+            data,
+            [0, 6],
+            [0, 0],
+            "cpu",
+            explainer_cache=explainer_cache,
+            pagerank_push_eps=push_eps,
+        )
+        expected = node_explainer.explain_pagerank_node_batch(
+            None, data, [0, 6], [0, 0], "cpu", pagerank_push_eps=push_eps
+        )
+        for (edge_mask, _), (expected_mask, _) in zip(masks, expected):
+            assert np.allclose(edge_mask, expected_mask)
+    # one adjacency per graph
+    assert len(explainer_cache) == 2
@@ -0,0 +1,36 @@
+import networkx as nx
+import numpy as np
+
+from explainer.pagerank import personalized_pagerank, personalized_pagerank_push
+
+
+def random_digraph(seed):
+    # directed, with dangling nodes
+    graph = nx.gnm_random_graph(30, 60, seed=seed, directed=True)
+    adj = nx.to_scipy_sparse_array(graph, nodelist=range(30), format="csr")
+    return graph, adj
+
+
+def nx_personalized_pagerank(graph, source):
+    personalization = {node: float(node == source) for node in graph}
+    ppr = nx.pagerank(graph, personalization=personalization, tol=1e-12, max_iter=1000)
+    return np.array([ppr[node] for node in range(graph.number_of_nodes())])
+
+
+def test_personalized_pagerank_matches_networkx():
+    graph, adj = random_digraph(0)
+    sources = [0, 5, 17]
+    ppr = personalized_pagerank(adj, sources, tol=1e-12, max_iter=1000)
+    for source, row in zip(sources, ppr):
+        assert np.allclose(row, nx_personalized_pagerank(graph, source), atol=1e-8)
+
+
+def test_personalized_pagerank_push_approximation():
+    graph, adj = random_digraph(1)
+    for eps in [1e-4, 1e-7]:
+        for source in [0, 3]:
+            ppr = personalized_pagerank_push(adj, source, eps=eps)
+            expected = nx_personalized_pagerank(graph, source)
+            # the remaining residuals are below eps * out_degree
+            assert np.abs(ppr - expected).sum() <= eps * (adj.nnz + adj.shape[0])
+            assert np.all(ppr <= expected + 1e-12)
@@ -0,0 +1,47 @@
+import numpy as np
+import torch
+from scipy import stats
+
+from conftest import build_model, random_graph
+from explainer.pgmexplainer import Graph_Explainer, chi_square_tests
+
+
+def test_predict_proba_matches_single_forwards():
+    model = build_model("gcn")
+    data = random_graph()
+    explainer = Graph_Explainer(
+        model, data.edge_index, data.edge_attr, data.x, num_layers=2, batch_size=3
+    )
+    X_perturb = np.random.default_rng(0).random((7,) + tuple(data.x.shape))
+    probs = explainer.predict_proba(X_perturb)
+    with torch.no_grad():
+        for x, prob in zip(X_perturb, probs):
+            out = model(
+                torch.tensor(x, dtype=torch.float), data.edge_index, data.edge_attr
+            )
+            assert np.allclose(prob, out.softmax(dim=-1)[0].numpy(), atol=1e-6)
+
+
+def test_chi_square_tests_match_chi2_contingency():
+    rng = np.random.default_rng(0)
+    samples = rng.integers(1, 4, size=(60, 5)) * 10 + rng.integers(1, 3, size=(60, 5))
+    # a constant column (dof 0) and two binary ones (dof 1 with Yates' correction)
+    samples[:, 1] = 11
+    samples[:, 2:4] = rng.integers(1, 3, size=(60, 2))
+    dofs = set()
+    for target in [samples[:, 0], samples[:, 2]]:
+        chi2, p_values, dof = chi_square_tests(samples, target)
+        _, cols = np.unique(target, return_inverse=True)
+        for k in range(samples.shape[1]):
+            _, rows = np.unique(samples[:, k], return_inverse=True)
+            table = np.zeros((rows.max() + 1, cols.max() + 1))
+            np.add.at(table, (rows, cols), 1)
+            if min(table.shape) == 1:
+                assert dof[k] == 0 and chi2[k] == 0.0 and p_values[k] == 1.0
+                continue
+            expected_chi2, expected_p, expected_dof, _ = stats.chi2_contingency(table)
+            assert dof[k] == expected_dof
+            assert np.isclose(chi2[k], expected_chi2)
+            assert np.isclose(p_values[k], expected_p)
+        dofs.update(dof.tolist())
+    assert {0, 1}.issubset(dofs)
@@ -0,0 +1,88 @@
+from itertools import permutations
+
+import numpy as np
+import pytest
+import torch
+from torch_geometric.utils import scatter, to_networkx
+
+from conftest import random_graph
+from explainer.shapley import get_local_region, l_shapley
+from explainer.subgraphx import batch_reward_func
+
+
+def pooled_value_func(data):
+    """Non-linear score of each graph of a batch."""
+    pooled = scatter(data.x.sum(-1), data.batch, dim=0, reduce="sum")
+    return torch.tanh(pooled)
+
+
+def brute_force_l_shapley(coalition, data, local_radius):
+    """Mean marginal contribution of the coalition over all the orders of the players."""
+    graph = to_networkx(data)
+    local_region = get_local_region(graph, coalition, local_radius)
+    players = [node for node in local_region if node not in coalition]
+    base_mask = np.ones(data.num_nodes)
+    base_mask[local_region] = 0.0
+
+    def value(mask):
+        x = data.x * torch.as_tensor(mask, dtype=torch.float32)[:, None]
+        return torch.tanh(x.sum()).item()
+
+    values = []
+    order = players + ["coalition"]
+    for permutation in permutations(order):
+        mask = base_mask.copy()
+        mask[[p for p in permutation[: permutation.index("coalition")]]] = 1.0
+        include = mask.copy()
+        include[coalition] = 1.0
+        values.append(value(include) - value(mask))
+    return np.mean(values)
+
+
+def test_l_shapley_exact_and_sampled():
+    data = random_graph(num_nodes=8, num_edges=10)
+    coalition, local_radius = [int(data.edge_index[0, 0])], 2
+    players = len(get_local_region(to_networkx(data), coalition, local_radius)) - 1
+    assert 0 < players <= 6
+    expected = brute_force_l_shapley(coalition, data, local_radius)
+    value, variance = l_shapley(
+        coalition, data, local_radius, pooled_value_func, return_variance=True
+    )
+    assert np.isclose(value, expected, atol=1e-5)
+    assert variance == 0.0
+    # sampling the sizes with more than 2 subsets
+    estimate, variance = l_shapley(
+        coalition,
+        data,
+        local_radius,
+        pooled_value_func,
+        budget=2,
+        rng=np.random.default_rng(0),
+        return_variance=True,
+    )
+    assert np.isfinite(estimate) and variance >= 0.0
+
+
+@pytest.mark.parametrize("reward_method", ["l_shapley", "mc_shapley", "mc_l_shapley"])
+def test_max_batch_nodes_reaches_the_marginal_contributions(reward_method):
+    data = random_graph(num_nodes=8)
+    scores = []
+    for max_batch_nodes in [2**16, 16]:
+        sizes = []
+
+        def value_func(batch_data):
+            sizes.append(int(batch_data.batch.max()) + 1)
+            return pooled_value_func(batch_data)
+
+        score_func = batch_reward_func(
+            reward_method,
+            value_func,
+            local_radius=2,
+            sample_num=10,
+            rng=np.random.default_rng(0),
+            max_batch_nodes=max_batch_nodes,
+        )
+        scores.append(score_func([[0, 1], [2]], data))
+        # two 8-node subgraphs per forward
+        assert (max(sizes) == 2) == (max_batch_nodes == 16)
+    assert np.allclose(scores[0], scores[1], atol=1e-6)
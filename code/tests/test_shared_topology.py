@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+
+from conftest import build_model
+from dataset.pow_utils.shared_topology import (
+    SharedTopologyLoader,
+    SharedTopologyStore,
+    occurrence_rank,
+)
+from gnn.shared_forward import SharedTopologyBatch, supports_shared_topology
+
+
+def random_store(num_graphs=6, num_nodes=7, num_edges=24, edge_dim=1):
+    row = torch.randint(num_nodes, (num_edges,))
+    col = torch.randint(num_nodes, (num_edges,))
+    # a parallel edge and a self-loop
+    row[1], col[1] = row[0], col[0]
+    row[2] = col[2] = 3
+    return SharedTopologyStore(
+        torch.stack([row, col]),
+        torch.randn(num_graphs, num_nodes, 4),
+        torch.rand(num_graphs, num_edges, edge_dim),
+        torch.rand(num_graphs, num_edges) > 0.3,
+        torch.randint(2, (num_graphs,)),
+    )
+
+
+def test_occurrence_rank():
+    keys = torch.tensor([3, 1, 3, 3, 2, 1])
+    assert occurrence_rank(keys).tolist() == [0, 0, 1, 2, 0, 1]
+
+
+@pytest.mark.parametrize(
+    "model_name,edge_dim", [("gcn", 1), ("gat", 2), ("gin", 2), ("transformer", 2)]
+)
+def test_shared_forward_matches_block_diagonal_batch(model_name, edge_dim):
+    store = random_store(edge_dim=edge_dim)
+    model = build_model(model_name, edge_dim=edge_dim, output_dim=2, readout="max")
+    assert supports_shared_topology(model)
+    indices = [4, 0, 2, 5]
+    num_edges = [int(store.edge_mask[i].sum()) for i in indices]
+    edge_keep = [torch.rand(n) > 0.5 for n in num_edges]
+    edge_weight = [torch.rand(n) for n in num_edges]
+    with torch.no_grad():
+        for kwargs in [{}, {"edge_keep": edge_keep}, {"edge_weight": edge_weight}]:
+            dense = store.get_dense_batch(indices, **kwargs)
+            assert isinstance(dense, SharedTopologyBatch)
+            expected = model.get_prob(store.get_batch(indices, **kwargs))
+            assert torch.allclose(model.get_prob(dense), expected, atol=1e-5)
+            assert torch.allclose(model(data=dense).exp(), expected, atol=1e-5)
+
+
+def test_shared_topology_loader():
+    store = random_store()
+    model = build_model("gin", output_dim=2)
+    loader = SharedTopologyLoader(store, [0, 1, 2, 3, 4], batch_size=2)
+    batches = list(loader)
+    assert len(batches) == len(loader) == 3
+    assert [b.num_graphs for b in batches] == [2, 2, 1]
+    assert np.array_equal(torch.cat([b.y for b in batches]), store.y[:5])
+    loss = model.loss(model(batches[0]), batches[0].y)
+    loss.backward()
+    assert all(p.grad is not None for p in model.convs.parameters())
+
+
+@pytest.mark.parametrize("mask_nature", ["hard", "hard_full", "soft"])
+def test_related_pred_graph_shared_matches_baseline(mask_nature):
+    Explain = pytest.importorskip("explain").Explain
+    store = random_store()
+    explain = Explain.__new__(Explain)
+    explain.device = "cpu"
+    explain.mask_nature = mask_nature
+    explain.inference_model = build_model("gat", output_dim=2)
+    explain.dataset = [store.get_batch([i]) for i in range(len(store))]
+    explain.explained_y = [1, 3, 4, 5]
+    edge_masks = [np.random.rand(int(store.edge_mask[i].sum())) - 0.3 for i in [1, 3]]
+    edge_masks += [None, np.array([])]
+    node_feat_masks = [None] * 4
+    explain.shared_topology = None
+    baseline = explain.related_pred_graph(edge_masks, node_feat_masks)
+    explain.shared_topology = store
+    shared = explain.related_pred_graph(edge_masks, node_feat_masks)
+    assert baseline.keys() == shared.keys()
+    for key in baseline:
+        assert np.allclose(baseline[key], shared[key], atol=1e-5), key
@@ -0,0 +1,196 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+import torch
+from torch_geometric.utils import scatter
+
+from conftest import build_model, random_graph
+from explainer import subgraphx
+
+
+def test_one_random_stream_per_run():
+    kwargs = {"seed": 3, "explainer_cache": {}}
+    rng = subgraphx.get_rng(**kwargs)
+    assert subgraphx.get_rng(**kwargs) is rng
+    first, second = rng.random(4), subgraphx.get_rng(**kwargs).random(4)
+    # the instances of a run do not replay the same samples
+    assert not np.allclose(first, second)
+    expected = np.random.default_rng(3).random(8)
+    assert np.allclose(np.concatenate([first, second]), expected)
+    # without a run cache, each explainer gets a generator seeded from the run seed
+    assert np.allclose(subgraphx.get_rng(seed=3).random(4), expected[:4])
+
+
+def test_l_shapley_variance_in_explainer_stats():
+    data = random_graph(num_nodes=10, num_edges=30)
+    explainer = subgraphx.SubgraphX(
+        build_model(output_dim=2),
+        2,
+        "cpu",
+        num_hops=2,
+        local_radius=3,
+        reward_method="l_shapley",
+        vis=False,
+        rng=np.random.default_rng(0),
+        l_shapley_budget=4,
+    )
+
+    def value_func(batch_data):
+        pooled = scatter(batch_data.x.sum(-1), batch_data.batch, dim=0, reduce="sum")
+        return torch.tanh(pooled)
+
+    coalitions = [[int(node)] for node in data.edge_index[0, :3]]
+    explainer.get_batch_reward_func(value_func)(coalitions, data)
+    # one variance per reward, sampled above the budget
+    assert len(explainer.reward_variances) == len(coalitions)
+    assert max(explainer.reward_variances) > 0.0
+    stats = {}
+    subgraphx.record_reward_variance(explainer.reward_variances, explainer_stats=stats)
+    assert np.allclose(
+        stats["l_shapley_variance"], [np.mean(explainer.reward_variances)]
+    )
+    # nothing is recorded without l_shapley rewards
+    subgraphx.record_reward_variance([], explainer_stats=stats)
+    assert len(stats["l_shapley_variance"]) == 1
+
+
+def test_mcts_expansion_merges_identical_coalitions():
+    # a 4-cycle 0-1-2-3 and an edge 4-5
+    edges = [(0, 1), (1, 2), (2, 3), (3, 0), (4, 5)]
+    edge_index = torch.tensor(edges + [(v, u) for u, v in edges]).t()
+    mcts = subgraphx.MCTS(
+        torch.randn(6, 4), edge_index, torch.ones(edge_index.shape[1], 1), num_hops=2
+    )
+    mcts.expand(mcts.root)
+    keys = [subgraphx.coalition_key(child.coalition) for child in mcts.root.children]
+    # removing 4 or 5 leaves the same main component {0, 1, 2, 3}
+    assert len(keys) == len(set(keys)) == 5
+    cycle = mcts.state_map[frozenset([0, 1, 2, 3])]
+    assert cycle in mcts.root.children
+    # the states reached from several parents are the same tree nodes
+    mcts.expand(cycle)
+    assert mcts.state_map[frozenset([1, 2, 3])] in cycle.children
+    assert mcts.state_map[frozenset([1, 2, 3])] in mcts.root.children
+    assert all(
+        subgraphx.coalition_key(node.coalition) == key
+        for key, node in mcts.state_map.items()
+    )
+
+
+def nx_prune(graph, coalition, removed_node, target=None):
+    """Main connected component of the coalition without removed_node, with networkx."""
+    subgraph = graph.subgraph([node for node in coalition if node != removed_node])
+    components = list(nx.connected_components(subgraph))
+    if target is not None:
+        return sorted(next(c for c in components if target in c))
+    # largest component, ties to the one of the smallest node
+    return sorted(max(components, key=lambda c: (len(c), -min(c))))
+
+
+def test_prune_coalition_matches_networkx_components():
+    rng = np.random.default_rng(0)
+    for trial in range(10):
+        graph = nx.gnm_random_graph(12, 14, seed=trial)
+        adj = subgraphx.graph_to_csr(graph, 12)
+        coalition = sorted(rng.choice(12, size=9, replace=False).tolist())
+        removed_nodes = coalition[::2]
+        pruned = subgraphx.prune_coalition(adj, coalition, removed_nodes)
+        assert pruned == [nx_prune(graph, coalition, node) for node in removed_nodes]
+        target = coalition[1]
+        pruned = subgraphx.prune_coalition(adj, coalition, removed_nodes, target)
+        assert pruned == [
+            nx_prune(graph, coalition, node, target) for node in removed_nodes
+        ]
+
+
+def test_reward_cache_lru_and_stats():
+    cache = subgraphx.RewardCache(max_size=2)
+    cache.put("a", 1.0)
+    cache.put("b", 2.0)
+    assert cache.get("a") == 1.0
+    # "b" is the least recently used entry
+    cache.put("c", 3.0)
+    assert cache.get("b") is None and cache.get("c") == 3.0
+    assert cache.stats == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "size": 2}
+    stats = {}
+    subgraphx.record_reward_cache_stats(cache, 1, 0, explainer_stats=stats)
+    assert stats["reward_cache_hit_rate"] == [0.5]
+    # one cache per run
+    kwargs = {"explainer_cache": {}}
+    assert subgraphx.get_reward_cache(**kwargs) is subgraphx.get_reward_cache(**kwargs)
+
+
+def test_compute_scores_reuses_cached_rewards():
+    calls = []
+
+    def score_func(coalition, data):
+        calls.append(tuple(coalition))
+        return float(sum(coalition))
+
+    def children(coalitions):
+        return [subgraphx.MCTSNode(coalition, data=None) for coalition in coalitions]
+
+    cache = subgraphx.RewardCache()
+    scores = subgraphx.compute_scores(
+        score_func, children([[0, 1], [1, 0], [2]]), cache, ("graph", 0)
+    )
+    assert scores == [1.0, 1.0, 2.0] and calls == [(0, 1), (2,)]
+    scores = subgraphx.compute_scores(
+        score_func, children([[2], [3]]), cache, ("graph", 0)
+    )
+    assert scores == [2.0, 3.0] and calls == [(0, 1), (2,), (3,)]
+    # another graph or label does not share the rewards
+    subgraphx.compute_scores(score_func, children([[2]]), cache, ("graph", 1))
+    assert calls[-1] == (2,) and len(calls) == 4
+
+
+def test_parallel_rollouts_take_distinct_paths():
+    data = random_graph(num_nodes=10, num_edges=30)
+    batches = []
+
+    def batch_score_func(coalitions, data):
+        batches.append(len(coalitions))
+        return [len(coalition) / 10 for coalition in coalitions]
+
+    mcts = subgraphx.MCTS(
+        data.x,
+        data.edge_index,
+        data.edge_attr,
+        num_hops=2,
+        min_atoms=3,
+        score_func=lambda coalition, data: batch_score_func([coalition], data)[0],
+        batch_score_func=batch_score_func,
+        n_parallel=3,
+        virtual_loss=100.0,
+    )
+    mcts.mcts_parallel_rollouts(3)
+    visited = [child for child in mcts.root.children if child.N > 0]
+    # the virtual loss diverts the concurrent rollouts to different children
+    assert len(visited) == 3 and all(child.N == 1 for child in visited)
+    # and is removed at the backup: W is the reward of the leaf of the rollout
+    assert all(child.W > 0 for child in visited)
+    # the children of the nodes expanded at a level are scored in one batch
+    assert batches[0] == len(mcts.root.children)
+    assert len(batches) < len(mcts.state_map)
+
+
+@pytest.mark.parametrize("model_name", ["gcn", "gat", "gin", "transformer"])
+def test_explain_subgraphx_graph_with_a_gnn(model_name):
+    graph_explainer = pytest.importorskip("explainer.graph_explainer")
+    data = random_graph(num_nodes=8, num_edges=20)
+    model = build_model(model_name, output_dim=2)
+    edge_mask, _ = graph_explainer.explain_subgraphx_graph(
+        model,
+        data,
+        0,
+        "cpu",
+        num_classes=2,
+        num_layers=2,
+        num_top_edges=6,
+        seed=0,
+        explainer_cache={},
+        explainer_stats={},
+    )
+    assert edge_mask.shape == (data.num_edges,)
+    assert np.isfinite(edge_mask).all() and edge_mask.any()
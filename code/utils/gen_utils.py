@@ -1,3 +1,4 @@
+import copy
 import random
 
 import numpy as np
@@ -23,6 +24,19 @@ def list_to_dict(preds):
     return preds_dict
 
 
+def prepare_data(data, device):
+    """Shallow copy of data with x, edge_index and edge_attr detached and on device.
+
+    Tensors that already have the right device and dtype are shared, not copied: the data
+    can be prepared once per run and the explainers clone what they modify.
+    """
+    data = copy.copy(data)
+    data.x = data.x.detach().to(device=device, dtype=torch.float)
+    data.edge_index = data.edge_index.detach().to(device=device, dtype=torch.long)
+    data.edge_attr = data.edge_attr.detach().to(device=device, dtype=torch.float)
+    return data
+
+
 def sample_large_graph(data):
     if data.num_edges > 50000:
         print("Too many edges, sampling large graph...")
@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from scipy import sparse
 from torch.autograd import Variable
 
 from utils.gen_utils import from_adj_to_edge_index
@@ -82,3 +83,174 @@ def compute_masked_edges_batch(edge_masks_set, edge_index_set, device):
         maskout_edge_index_set.append(maskout_edge_index)
 
     return masked_edge_index_set, maskout_edge_index_set
+
+
+class CachedAdjacency(object):
+    """Sparse (CSR) adjacency of a fixed graph with the GCN normalisation, for repeated forwards.
+
+    Rows are target nodes and columns source nodes, so that a GCNConv propagation is
+    `adj_t @ x`. Self-loops are handled as in `add_remaining_self_loops`. The structure is
+    built once; new edge weights (e.g. edge masks) only update the CSR values. Inputs are
+    first compared by identity and version counter, so that repeated forwards with the
+    same tensors do not compare E values.
+    """
+
+    def __init__(self, edge_index, num_nodes):
+        self.edge_index = edge_index
+        self.num_nodes = num_nodes
+        self.device = None
+        self.edge_weight = None
+        self.adj_t = None
+        self.inputs = None
+
+    def matches(self, edge_index):
+        if edge_index is self.edge_index:
+            return True
+        if edge_index.shape != self.edge_index.shape:
+            return False
+        if edge_index.device != self.edge_index.device:
+            self.edge_index = self.edge_index.to(edge_index.device)
+        if not torch.equal(edge_index, self.edge_index):
+            return False
+        # the next forwards with this tensor only need the identity check
+        self.edge_index = edge_index
+        return True
+
+    def _build(self, device):
+        N = self.num_nodes
+        edge_index = self.edge_index.to(device)
+        row, col = edge_index
+        self.loop_mask = row == col
+        loop_index = torch.arange(N, device=device)
+        src = torch.cat([row[~self.loop_mask], loop_index])
+        tgt = torch.cat([col[~self.loop_mask], loop_index])
+        # sort by target node (CSR rows), then by source node
+        self.perm = torch.argsort(tgt * N + src)
+        self.src, self.tgt = src, tgt
+        self.crow_indices = torch.zeros(N + 1, dtype=torch.long, device=device)
+        self.crow_indices[1:] = torch.cumsum(torch.bincount(tgt, minlength=N), 0)
+        self.col_indices = src[self.perm]
+        self.device = device
+
+    def _same_inputs(self, inputs):
+        return self.inputs is not None and all(
+            a is b and (a is None or a._version == version)
+            for a, (b, version) in zip(inputs, self.inputs)
+        )
+
+    def get(self, edge_weight=None, edge_attr=None):
+        """Return the normalised adjacency `adj_t` for the given edge weights (default: ones).
+
+        The weight of an edge is `edge_weight * edge_attr`, edge_attr being of shape [E, 1].
+        """
+        inputs = (edge_weight, edge_attr)
+        if self.adj_t is not None and self._same_inputs(inputs):
+            return self.adj_t
+        device = self.edge_index.device
+        for tensor in inputs:
+            if tensor is not None:
+                device = tensor.device
+        if self.device != device:
+            self._build(device)
+            self.edge_weight, self.adj_t = None, None
+        weight = torch.ones(self.edge_index.shape[1], device=device)
+        if edge_weight is not None:
+            weight = weight * edge_weight.reshape(-1)
+        if edge_attr is not None:
+            if edge_attr.dim() > 1 and edge_attr.size(-1) != 1:
+                raise ValueError("CachedAdjacency only supports scalar edge weights.")
+            weight = weight * edge_attr.reshape(-1)
+        self.inputs = tuple(
+            (tensor, None if tensor is None else tensor._version) for tensor in inputs
+        )
+        if self.adj_t is not None and torch.equal(weight, self.edge_weight):
+            return self.adj_t
+        edge_weight = weight
+        N = self.num_nodes
+        loop_weight = torch.ones(N, dtype=edge_weight.dtype, device=device)
+        loop_weight[self.edge_index[0].to(device)[self.loop_mask]] = edge_weight[
+            self.loop_mask
+        ]
+        weight = torch.cat([edge_weight[~self.loop_mask], loop_weight])
+        deg = torch.zeros(N, dtype=weight.dtype, device=device).index_add_(
+            0, self.tgt, weight
+        )
+        deg_inv_sqrt = deg.pow(-0.5)
+        deg_inv_sqrt[deg_inv_sqrt == float("inf")] = 0
+        norm = deg_inv_sqrt[self.src] * weight * deg_inv_sqrt[self.tgt]
+        self.adj_t = torch.sparse_csr_tensor(
+            self.crow_indices, self.col_indices, norm[self.perm], size=(N, N)
+        )
+        self.edge_weight = edge_weight.detach().clone()
+        return self.adj_t
+
+
+def leave_one_out_batch(x, edge_index, edge_attr, removed_edges):
+    """Batch of copies of a graph, where the i-th copy is the graph without edge removed_edges[i].
+
+    Returns x, edge_index, edge_attr and batch of the block-diagonal batch.
+    """
+    device = edge_index.device
+    num_copies, num_nodes = len(removed_edges), x.shape[0]
+    keep = torch.ones(
+        (num_copies, edge_index.shape[1]), dtype=torch.bool, device=device
+    )
+    keep[torch.arange(num_copies, device=device), removed_edges] = False
+    offset = torch.arange(num_copies, device=device) * num_nodes
+    batch_edge_index = (edge_index[None] + offset[:, None, None]).permute(1, 0, 2)
+    batch_edge_attr = edge_attr[None].expand(num_copies, *edge_attr.shape)
+    return (
+        x.repeat(num_copies, 1),
+        batch_edge_index[:, keep],
+        batch_edge_attr[keep],
+        torch.arange(num_copies, device=device).repeat_interleave(num_nodes),
+    )
+
+
+def repeat_graph_batch(xs, edge_index, edge_attr):
+    """Batch of copies of a graph with different node features xs [num_copies, N, F].
+
+    Returns x, edge_index, edge_attr and batch of the block-diagonal batch.
+    """
+    device = edge_index.device
+    num_copies, num_nodes = xs.shape[0], xs.shape[1]
+    offset = torch.arange(num_copies, device=device) * num_nodes
+    batch_edge_index = (edge_index[None] + offset[:, None, None]).permute(1, 0, 2)
+    return (
+        xs.reshape(num_copies * num_nodes, -1),
+        batch_edge_index.reshape(2, -1),
+        edge_attr.repeat(num_copies, 1),
+        torch.arange(num_copies, device=device).repeat_interleave(num_nodes),
+    )
+
+
+def edge_index_to_csr(edge_index, num_nodes, transpose=False, cache=None):
+    """Binary CSR adjacency of edge_index: adj[i, j] = 1 for an edge i -> j (j -> i if
+    transpose). It is stored in the dict cache if given, and reused from it.
+
+    The cache key identifies the edge_index tensor (storage, layout and version): the
+    cached entry keeps a reference to it, so that its storage is not reused by another
+    graph while the entry exists.
+    """
+    key = (
+        "csr_adjacency",
+        edge_index.data_ptr(),
+        tuple(edge_index.shape),
+        edge_index.stride(),
+        str(edge_index.device),
+        edge_index._version,
+        num_nodes,
+        transpose,
+    )
+    if cache is not None and key in cache:
+        return cache[key][1]
+    row, col = edge_index.cpu().numpy()
+    if transpose:
+        row, col = col, row
+    adj = sparse.csr_matrix(
+        (np.ones(len(row)), (row, col)), shape=(num_nodes, num_nodes)
+    )
+    adj.data[:] = 1
+    if cache is not None:
+        cache[key] = (edge_index, adj)
+    return adj
@@ -164,6 +164,12 @@ def arg_parse():
     parser_dataset_params.add_argument("--test_ratio", dest="test_ratio", type=float)
     parser_dataset_params.add_argument("--val_ratio", dest="val_ratio", type=float)
     parser_dataset_params.add_argument("--random_split_flag", type=str, default="True")
+    parser_dataset_params.add_argument(
+        "--shared_topology",
+        help="batch the graphs as one base topology plus per-graph edge masks (uk, ieee24, ieee39, ieee118)",
+        type=str,
+        default="False",
+    )
 
     # optimization parameters
     parser_optimizer_params = parser.add_argument_group("optimizer_params")
@@ -218,6 +224,33 @@ def arg_parse():
         help="Edge feature dimension (only for GAT, GIN and TRANSFORMER model).",
     )
 
+    # inference parameters (fidelity evaluation and perturbation-based explainers)
+    parser_inference_params = parser.add_argument_group("inference_params")
+    parser_inference_params.add_argument(
+        "--backend",
+        help="[torch, onnx, torchscript, compile]. Backend used for inference-only workloads.",
+        type=str,
+        default="torch",
+    )
+    parser_inference_params.add_argument(
+        "--inference_precision",
+        help="[fp32, bf16, int8]. Low precision CPU inference (torch backend only).",
+        type=str,
+        default="fp32",
+    )
+    parser_inference_params.add_argument(
+        "--parity_atol",
+        help="max probability error tolerated between the backend and the torch model",
+        type=float,
+        default=1e-4,
+    )
+    parser_inference_params.add_argument(
+        "--min_label_agreement",
+        help="min fraction of predicted labels shared with the fp32 torch model",
+        type=float,
+        default=0.99,
+    )
+
     # explainer parameters
     parser_explainer_params = parser.add_argument_group("explainer_params")
     parser_explainer_params.add_argument("--explainer_name", help="explainer", type=str)
@@ -289,6 +322,97 @@ def arg_parse():
         default=0,
     )
 
+    parser_explainer_params.add_argument(
+        "--explained_batch_size",
+        help="number of instances explained together by the explainers with a batched variant "
+        "(graph tasks: sa, ig, gradcam, gnnexplainer; node tasks: sa, ig, distance, pagerank)",
+        type=int,
+        default=1,
+    )
+    parser_explainer_params.add_argument(
+        "--perturbation_batch_size",
+        help="max number of perturbed copies of a graph scored in a single forward",
+        type=int,
+        default=256,
+    )
+
+    parser_explainer_params.add_argument(
+        "--max_batch_nodes",
+        help="memory budget: max number of nodes in a batched forward of the explainers",
+        type=int,
+        default=2**16,
+    )
+
+    # hyperparameters for Integrated Gradients
+    parser_explainer_params.add_argument(
+        "--ig_steps",
+        help="(max) number of interpolation steps of Integrated Gradients",
+        type=int,
+        default=50,
+    )
+    parser_explainer_params.add_argument(
+        "--ig_tolerance",
+        help="if set, double the IG steps until the completeness delta is below this tolerance",
+        type=float,
+        default=None,
+    )
+
+    # hyperparameters for the distance baseline
+    parser_explainer_params.add_argument(
+        "--distance_max_depth",
+        help="if set, nodes farther than this number of hops get a zero distance mask "
+        "(the hop distances of --explained_batch_size nodes are found in one search)",
+        type=int,
+        default=None,
+    )
+
+    # hyperparameters for the pagerank baseline
+    parser_explainer_params.add_argument(
+        "--pagerank_tol",
+        help="tolerance of the personalized pagerank power iteration",
+        type=float,
+        default=1e-6,
+    )
+    parser_explainer_params.add_argument(
+        "--pagerank_push_eps",
+        help="if set, approximate personalized pagerank by local pushes with this residual threshold",
+        type=float,
+        default=None,
+    )
+
+    # hyperparameters for SubgraphX
+    parser_explainer_params.add_argument(
+        "--subgraphx_reward_cache_size",
+        help="max number of coalition rewards cached across the SubgraphX explanations (0: no cache)",
+        type=int,
+        default=2**16,
+    )
+    parser_explainer_params.add_argument(
+        "--subgraphx_parallel_rollouts",
+        help="number of concurrent SubgraphX rollouts (virtual loss), scored in one batch",
+        type=int,
+        default=1,
+    )
+    parser_explainer_params.add_argument(
+        "--subgraphx_reward_method",
+        help="reward of the SubgraphX coalitions",
+        type=str,
+        default="mc_shapley",
+        choices=[
+            "gnn_score",
+            "mc_shapley",
+            "l_shapley",
+            "mc_l_shapley",
+            "nc_mc_l_shapley",
+        ],
+    )
+    parser_explainer_params.add_argument(
+        "--subgraphx_l_shapley_budget",
+        help="number of subsets above which l_shapley is estimated by stratified sampling",
+        type=int,
+        default=2**12,
+    )
+
     # hyperparameters for GNNExplainer
     parser_explainer_params.add_argument(
         "--edge_size",
@@ -302,6 +426,43 @@ def arg_parse():
         type=float,
         help="Constraining edge mask entropy: mask is uniform or discriminative",
     )
+    parser_explainer_params.add_argument(
+        "--gnnexplainer_epochs",
+        help="max number of epochs of the GNNExplainer mask optimisation",
+        type=int,
+        default=1000,
+    )
+    parser_explainer_params.add_argument(
+        "--gnnexplainer_patience",
+        help="stop after this many epochs without loss improvement nor mask change (None: no early stopping)",
+        type=int,
+        default=None,
+    )
+    parser_explainer_params.add_argument(
+        "--gnnexplainer_min_epochs",
+        help="min number of epochs before early stopping",
+        type=int,
+        default=100,
+    )
+    parser_explainer_params.add_argument(
+        "--gnnexplainer_loss_tol",
+        help="min relative loss improvement for an epoch to count as progress",
+        type=float,
+        default=1e-4,
+    )
+    parser_explainer_params.add_argument(
+        "--gnnexplainer_mask_tol",
+        help="min change of a mask entry for an epoch to count as progress",
+        type=float,
+        default=1e-3,
+    )
+    parser_explainer_params.add_argument(
+        "--gnnexplainer_init",
+        help="initialisation of the edge mask: random or warm start from saliency",
+        type=str,
+        default="random",
+        choices=["random", "saliency"],
+    )
 
     parser.set_defaults(
         datadir=DATA_DIR,  # io_parser